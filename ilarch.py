@@ -11,7 +11,8 @@ import sys
 from larch.core.dynamicpage.page import EventHandleError, DynamicPage
 from larch.core.incremental_view import IncrementalView
 from larch.core.subject import Subject
-from larch.core.dynamicpage import messages
+from larch.core.dynamicpage import messages, transport
+from larch.core.dynamicpage.sync_scheduler import SyncScheduler
 from larch.inspector import present_exception
 
 from IPython import display as ip_display
@@ -49,11 +50,23 @@ class ILarch(widgets.DOMWidget):
 
 	max_inflight_messages_ = Integer(default_value=3)
 
-	def __init__(self, page, **kwargs):
+	def __init__(self, page, transport_encodings=None, min_frame_interval=1.0/30.0, max_frame_interval=1.0, **kwargs):
+		"""
+		Constructor
+
+		:param page: the dynamic page to display
+		:param transport_encodings: [optional] the names of the message packet encodings that may be used, most preferred first (see larch.core.dynamicpage.transport). The encoding is chosen when the client reports the encodings that it supports; JSON is used until then.
+		:param min_frame_interval: [optional] the minimum time, in seconds, between synchronisations caused by tasks queued on the page outside of event handling (e.g. by background threads)
+		:param max_frame_interval: [optional] the maximum time between such synchronisations, that the interval will grow to if the client is slow to apply updates
+		"""
 		self.__page = page
+		self.__transport_encodings = transport_encodings
+		self.__packet_encoder = transport.JsonPacketEncoder()
+		max_inflight = kwargs.get('max_inflight_messages_', self.__class__.max_inflight_messages_.default_value)
+		self.__sync_scheduler = SyncScheduler(self.__send_sync_request, min_interval=min_frame_interval,
+						      max_interval=max_frame_interval, max_inflight=max_inflight)
 		page.register_queue_synchronize_callback(self.__on_queue_synchronize)
 		view_id, initial_content, doc_init_scripts, initialisers, deps = page.initial_content()
-		self.__synchronize_op_in_progress = False
 
 		for dep in deps:
 			dep.ipython_setup()
@@ -68,48 +81,49 @@ class ILarch(widgets.DOMWidget):
 
 
 	def send_larch_msg_packet(self, messages):
-		self.send({
-            		'msg_type'   : 'larch_msg_packet',
-			'messages': messages
-		})
+		packet, buffers = self.__packet_encoder.encode(messages)
+		packet['msg_type'] = 'larch_msg_packet'
+		self.send(packet, buffers)
 
 
 
 	def __on_queue_synchronize(self, page):
-		if not self.__synchronize_op_in_progress:
-			self.send({
-				'msg_type'   : 'larch_sync_request'
-			})
+		self.__sync_scheduler.on_tasks_queued()
 
-	def _synchronize(self):
-		self.__synchronize_op_in_progress = True
-		error_messages = []
+	def __send_sync_request(self):
+		self.send({
+			'msg_type'   : 'larch_sync_request'
+		})
 
-		# Synchronise the view
-		deps = []
+	def _synchronize(self, answers_request=False):
+		self.__sync_scheduler.begin_sync(answers_request)
 		try:
-			client_messages, deps = self.__page.synchronize()
-		except Exception, e:
-			# Catch internal server error
-			err_html = present_exception.exception_to_html_src(e, sys.exc_info()[1], sys.exc_info()[2])
-			msg = messages.error_during_update_message(err_html)
-			error_messages.append(msg)
-			client_messages = []
+			error_messages = []
+
+			# Synchronise the view
+			deps = []
+			try:
+				client_messages, deps = self.__page.synchronize()
+			except Exception, e:
+				# Catch internal server error
+				err_html = present_exception.exception_to_html_src(e, sys.exc_info()[1], sys.exc_info()[2])
+				msg = messages.error_during_update_message(err_html)
+				error_messages.append(msg)
+				client_messages = []
 
-		self.__synchronize_op_in_progress = False
+			for dep in deps:
+				dep.ipython_setup()
 
-		for dep in deps:
-			dep.ipython_setup()
-
-		# Send messages to the client
-		msgs_out = client_messages + error_messages
-		if len(msgs_out) > 0:
-			self.send_larch_msg_packet(msgs_out)
+			# Send messages to the client
+			msgs_out = client_messages + error_messages
+			if len(msgs_out) > 0:
+				self.send_larch_msg_packet(msgs_out)
+		finally:
+			# Even if an error occurred (e.g. while sending), so that the scheduler does not stop scheduling synchronisations
+			self.__sync_scheduler.end_sync()
 
 
 	def _on_events(self, block_id, ev_msgs):
-		self.__synchronize_op_in_progress = True
-
 		error_messages = []
 
 		# Handle the events
@@ -134,8 +148,6 @@ class ILarch(widgets.DOMWidget):
 		for dep in deps:
 			dep.ipython_setup()
 
-		self.__synchronize_op_in_progress = False
-
 		# Send messages to the client
 		return client_messages + error_messages
 
@@ -144,11 +156,19 @@ class ILarch(widgets.DOMWidget):
 		msg_type = msg.get('msg_type', '')
 		if msg_type == 'larch_events':
 			message_block = msg['data']
-			replies = self._on_events(message_block['id'], message_block['messages'])
-			if len(replies) > 0  or  message_block['ack_immediately']:
-				self.send_larch_msg_packet(replies)
+			self.__sync_scheduler.begin_sync(False)
+			try:
+				replies = self._on_events(message_block['id'], message_block['messages'])
+				if len(replies) > 0  or  message_block['ack_immediately']:
+					self.send_larch_msg_packet(replies)
+			finally:
+				self.__sync_scheduler.end_sync()
 		elif msg_type == 'larch_sync':
-			self._synchronize()
+			self._synchronize(True)
+		elif msg_type == 'larch_transport':
+			# Sent when a view is rendered; sync requests sent before then, or to a previous view, will not be answered
+			self.__packet_encoder = transport.negotiate(msg.get('encodings', []), self.__transport_encodings)
+			self.__sync_scheduler.reset()
 
 
 
@@ -0,0 +1,252 @@
+##-*************************
+##-* This program is free software; you can use it, redistribute it and/or
+##-* modify it under the terms of the GNU Affero General Public License
+##-* version 3 as published by the Free Software Foundation. The full text of
+##-* the GNU Affero General Public License version 3 can be found in the file
+##-* named 'LICENSE.txt' that accompanies this program. This source code is
+##-* (C)copyright Geoffrey French 2011-2014.
+##-*************************
+import threading
+import unittest
+
+from larch.incremental import IncrementalMonitor
+from larch.pres.pres import Pres
+from larch.pres.html import Html
+from larch.core.dynamicpage.segment import HtmlContent
+from larch.live import TrackedLiveList
+
+
+
+def _default_item_fn(x):
+	return Html('<div class="live_list_item">', Pres.coerce(x), '</div>')
+
+
+
+class live_list (Pres):
+	def __init__(self, ls, item_fn=None):
+		"""
+		Present the contents of a TrackedLiveList, updating the presentation in place as the list is modified
+
+		Each element is presented in its own segment. Changes to the list are received as deltas (see
+		TrackedLiveList.add_delta_listener) and only the segments of the affected elements are inserted or removed;
+		the enclosing fragment is not re-computed and the presentations of the other elements are not re-sent to the client.
+
+		:param ls: the TrackedLiveList to present
+		:param item_fn: [optional] a function of the form function(element) that returns the presentation of an element; each element is presented as an inner fragment in a div by default
+		"""
+		self.__ls = ls
+		self.__item_fn = item_fn   if item_fn is not None   else _default_item_fn
+
+
+	def build(self, pres_ctx):
+		view = _LiveListView(self.__ls, self.__item_fn, pres_ctx)
+		return HtmlContent(['<div class="live_list">', view.container.reference(), '</div>'])
+
+
+
+
+def _same_items(xs, ys):
+	# Compare by identity; the elements may be expensive to compare, or compare equal while being presented differently
+	if len(xs) != len(ys):
+		return False
+	for x, y in zip(xs, ys):
+		if x is not y:
+			return False
+	return True
+
+
+
+class _LiveListView (object):
+	def __init__(self, ls, item_fn, pres_ctx):
+		self.__ls = ls
+		self.__item_fn = item_fn
+		self.__pres_ctx = pres_ctx
+		self.__fragment_view = pres_ctx.fragment_view
+
+		self.__lock = threading.Lock()
+		self.__pending_deltas = []
+
+		# The presentation does not depend on the list; it is updated in place by applying deltas. The listener is held
+		# by the fragment for as long as its current content exists, so the list does not keep the page alive.
+		# It is added before the contents are copied, so that no change is missed; a change made by another thread in
+		# between may be both in the copy and delivered as a delta, which __apply_deltas detects.
+		self.__fragment_view.add_scoped_listener(ls, self.__on_delta)
+		prev = IncrementalMonitor.block_access_tracking()
+		try:
+			# The elements that are presented, in order
+			self.__items = ls.static_items
+			self.__item_segments = [self.__build_item_segment(x)   for x in self.__items]
+		finally:
+			IncrementalMonitor.unblock_access_tracking(prev)
+
+		self.container = self.__fragment_view.create_sub_segment(HtmlContent([seg.reference()   for seg in self.__item_segments]))
+
+
+	def __build_item_segment(self, x):
+		content = Pres.coerce(self.__item_fn(x)).build(self.__pres_ctx)
+		return self.__fragment_view.create_sub_segment(content)
+
+
+	def __on_delta(self, ls, delta):
+		# May be invoked on any thread; apply the deltas in a page task
+		with self.__lock:
+			queue = len(self.__pending_deltas) == 0
+			self.__pending_deltas.append(delta)
+		if queue:
+			self.__fragment_view.queue_task(self.__apply_deltas)
+
+
+	def __apply_deltas(self):
+		with self.__lock:
+			deltas = self.__pending_deltas
+			self.__pending_deltas = []
+
+		if self.container.id not in self.__fragment_view.dynamic_page._table:
+			# The enclosing fragment has been re-computed or disposed of, taking the container with it
+			return
+
+		prev = IncrementalMonitor.block_access_tracking()
+		try:
+			for delta in deltas:
+				i = delta.index
+				n_old = len(delta.old)
+				if i > len(self.__items)  or  not _same_items(self.__items[i:i+n_old], delta.old):
+					# The delta does not apply to the presented elements; it was already in the copy of the contents
+					# taken when the view was built
+					break
+				self.__splice(i, n_old, delta.new)
+
+			items = self.__ls.static_items
+			if not _same_items(self.__items, items):
+				# Deltas were missed or applied twice; bring the presentation up to date with the list by replacing the
+				# elements between the unchanged start and end
+				n = min(len(items), len(self.__items))
+				start = 0
+				while start < n  and  items[start] is self.__items[start]:
+					start += 1
+				end = 0
+				while end < n - start  and  items[-1-end] is self.__items[-1-end]:
+					end += 1
+				self.__splice(start, len(self.__items) - start - end, items[start:len(items)-end])
+		finally:
+			IncrementalMonitor.unblock_access_tracking(prev)
+
+		# Dispose of the fragments of the removed elements, unless they were presented again
+		self.__fragment_view.view.clean()
+
+
+	def __splice(self, i, n_old, new):
+		# Discard the removed elements first, so that the fragments of elements that are moved can be re-used
+		for seg in self.__item_segments[i:i+n_old]:
+			self.__fragment_view.discard_content(HtmlContent([seg.reference()]))
+		inserted = [self.__build_item_segment(x)   for x in new]
+		self.__items[i:i+n_old] = new
+		self.__item_segments[i:i+n_old] = inserted
+		self.container.splice_children(i, n_old, inserted)
+
+
+
+
+
+class Test_live_list (unittest.TestCase):
+	class _Model (object):
+		def __init__(self, ls, title):
+			self.ls = ls
+			self.title = title
+
+		def __present__(self, fragment):
+			return Html('<h1>{0}</h1>'.format(self.title.value), live_list(self.ls, lambda x: Html('<i>{0}</i>'.format(x))))
+
+
+	class _RacingList (TrackedLiveList):
+		# Modifies itself when its contents are copied, as if another thread did so just after the live list view
+		# registered its delta listener
+		def __init__(self, xs):
+			super(Test_live_list._RacingList, self).__init__(xs)
+			self.race = None
+
+		@property
+		def static_items(self):
+			race, self.race = self.race, None
+			if race is not None:
+				race()
+			return super(Test_live_list._RacingList, self).static_items
+
+
+	def _page(self, ls):
+		from larch.live import LiveValue
+		from larch.core.incremental_view import IncrementalView
+		from larch.core.subject import Subject
+		from larch.core.dynamicpage.page import DynamicPage
+		self.title = LiveValue('a')
+		page = DynamicPage(None, 'x')
+		IncrementalView(Subject(self._Model(ls, self.title)), page)
+		page.initial_content()
+		page.synchronize()
+		return page
+
+
+	@staticmethod
+	def _changes(page):
+		client_messages, deps = page.synchronize()
+		return client_messages[0]['changes']   if len(client_messages) > 0   else None
+
+
+	@staticmethod
+	def _items(page):
+		html = page.initial_content()[1]
+		items = []
+		pos = html.find('<i>')
+		while pos != -1:
+			end = html.index('</i>', pos)
+			items.append(html[pos+3:end])
+			pos = html.find('<i>', end)
+		return items
+
+
+	def test_append(self):
+		ls = TrackedLiveList(['x', 'y'])
+		page = self._page(ls)
+		ls.append('z')
+		changes = self._changes(page)
+		self.assertEqual(1, len(changes['spliced']))
+		self.assertEqual([], changes['modified'])
+		self.assertTrue('<i>z</i>' in changes['spliced'][0][3])
+		self.assertEqual(['x', 'y', 'z'], self._items(page))
+
+
+	def test_insert_then_delete(self):
+		ls = TrackedLiveList(['x', 'y'])
+		page = self._page(ls)
+		ls.insert(1, 'z')
+		del ls[1]
+		# The inserted segment was removed before the client received it, so the container is sent in its entirety
+		changes = self._changes(page)
+		self.assertEqual([], changes['spliced'])
+		self.assertEqual(1, len(changes['modified']))
+		self.assertEqual(['x', 'y'], self._items(page))
+
+
+	def test_enclosing_fragment_recomputed(self):
+		ls = TrackedLiveList(['x', 'y'])
+		page = self._page(ls)
+		self.title.value = 'b'
+		page.synchronize()
+		self.assertEqual(1, len(ls._TrackedLiveList__delta_listeners))
+		ls.append('z')
+		page.synchronize()
+		self.assertEqual(['x', 'y', 'z'], self._items(page))
+
+
+	def test_change_during_copy(self):
+		ls = self._RacingList(['x', 'y'])
+		ls.race = lambda: ls.insert(0, 'w')
+		page = self._page(ls)
+		self.assertEqual(['w', 'x', 'y'], self._items(page))
+		ls.race = lambda: ls.append('z')
+		self.title.value = 'b'
+		page.synchronize()
+		self.assertEqual(['w', 'x', 'y', 'z'], self._items(page))
+		del ls[0]
+		page.synchronize()
+		self.assertEqual(['x', 'y', 'z'], self._items(page))
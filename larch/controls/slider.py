@@ -184,7 +184,7 @@ class live_slider (CompositePres):
 			self.__live.value = value
 			refreshing[0] = False
 
-		self.__live.add_listener(on_live_change)
+		pres_ctx.fragment_view.add_scoped_listener(self.__live, on_live_change)
 
 		slide_fn = __on_slide if self.__update_on_slide   else None
 		s = slider(__on_slide, slide_fn, self.__width, value=self.__live.static_value, min=self.__min, max=self.__max, step=self.__step,
@@ -236,7 +236,7 @@ class live_range_slider(CompositePres):
 			self.__live.value = value
 			refreshing[0] = False
 
-		self.__live.add_listener(on_live_change)
+		pres_ctx.fragment_view.add_scoped_listener(self.__live, on_live_change)
 
 
 		slide_fn = __on_slide if self.__update_on_slide   else None
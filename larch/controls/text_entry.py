@@ -85,7 +85,7 @@ class live_text_entry (CompositePres):
 			self.__live.value = value
 			refreshing[0] = False
 
-		self.__live.add_listener(on_change)
+		pres_ctx.fragment_view.add_scoped_listener(self.__live, on_change)
 
 		s = text_entry(self.__live.static_value, self.__immediate_events, width=self.__width)
 		s.edit.connect(__on_edit)
@@ -6,6 +6,7 @@
 ##-* named 'LICENSE.txt' that accompanies this program. This source code is
 ##-* (C)copyright Geoffrey French 2011-2014.
 ##-*************************
+import sys
 import unittest
 
 from larch.pres.html import Html
@@ -89,6 +90,47 @@ class Change (object):
 		raise CannotMergeChangeError
 
 
+	def can_compact_from(self, change):
+		"""Determine if @change can be combined into @self when the change history is compacted
+
+		Compaction combines consecutive undo steps, so changes may be combined here that would not be merged while
+		they are being recorded. Defaults to can_merge_from.
+
+		Returns - True if the changes can be combined, False if not
+		"""
+		return self.can_merge_from(change)
+
+
+	def compact_from(self, change):
+		"""Combine @change into @self when the change history is compacted
+
+		Raises CannotMergeChangeError if the changes cannot be combined
+		"""
+		self.merge_from(change)
+
+
+	def estimate_size(self):
+		"""Estimate the number of bytes of memory retained by the change
+
+		The default estimate covers the change object and its attribute dictionary; override to account for
+		data that is retained only by the change history (e.g. removed elements)
+		"""
+		size = sys.getsizeof(self)
+		d = getattr(self, '__dict__', None)
+		if d is not None:
+			size += sys.getsizeof(d)
+		return size
+
+
+	def journal_op(self, reverted):
+		"""Describe the operation applied by the change, for recording in a ChangeJournal
+
+		:param reverted: if True, describe the operation that reverts the change
+		:return: a tuple (target, op) where target is the object that is modified and op is a picklable value that is passed to target.__journal_replay__, or None if the operation cannot be described. op may be None if the target is known but the operation cannot be described.
+		"""
+		return None
+
+
 	def __present__(self, fragment):
 		return Html('<span>', self.description, '</span>')
 
@@ -126,9 +168,37 @@ class FnChange (Change):
 
 
 
+def _estimate_change_size(change):
+	estimate_fn = getattr(change, 'estimate_size', None)
+	if estimate_fn is not None:
+		return estimate_fn()
+	else:
+		return Change.estimate_size.__func__(change)
+
+
+def _can_compact(change_a, change_b):
+	can_compact_fn = getattr(change_a, 'can_compact_from', None)
+	if can_compact_fn is not None:
+		return can_compact_fn(change_b)
+	else:
+		return change_a.can_merge_from(change_b)
+
+
+def _compact(change_a, change_b):
+	compact_fn = getattr(change_a, 'compact_from', None)
+	if compact_fn is not None:
+		compact_fn(change_b)
+	else:
+		change_a.merge_from(change_b)
+
+
+
 class _ChangeHistoryEntry (object):
 	def __init__(self):
 		self._changes = []
+		# Estimated sizes of the changes, in bytes
+		self._sizes = []
+		self.estimated_size = 0
 
 	def apply(self):
 		for change in self._changes:
@@ -147,7 +217,45 @@ class _ChangeHistoryEntry (object):
 
 
 	def append(self, change):
+		size = _estimate_change_size(change)
 		self._changes.append(change)
+		self._sizes.append(size)
+		self.estimated_size += size
+
+
+	def top_modified(self):
+		# Re-estimate the size of the top change after a change was merged into it
+		size = _estimate_change_size(self._changes[-1])
+		self.estimated_size += size - self._sizes[-1]
+		self._sizes[-1] = size
+
+
+	def compact(self):
+		# Combine consecutive changes where possible
+		changes = self._changes
+		if len(changes) > 1:
+			compacted = [changes[0]]
+			for change in changes[1:]:
+				if _can_compact(compacted[-1], change):
+					_compact(compacted[-1], change)
+				else:
+					compacted.append(change)
+			if len(compacted) != len(changes):
+				self._changes = compacted
+				self._sizes = [_estimate_change_size(c)   for c in compacted]
+				self.estimated_size = sum(self._sizes)
+
+
+	def extend(self, entry):
+		# Append the changes in @entry, to be applied after those of @self
+		if not self.is_empty  and  not entry.is_empty  and  _can_compact(self.top(), entry._changes[0]):
+			_compact(self.top(), entry._changes[0])
+			self.top_modified()
+			changes = entry._changes[1:]
+		else:
+			changes = entry._changes
+		for change in changes:
+			self.append(change)
 
 
 	def __present__(self, fragment):
@@ -162,7 +270,12 @@ class _ChangeHistoryEntry (object):
 
 
 class ChangeHistory (object):
-	def __init__(self):
+	def __init__(self, max_entries=None, max_bytes=None):
+		"""Constructor
+
+		:param max_entries: [optional] the maximum number of undo steps to retain; unlimited by default
+		:param max_bytes: [optional] the maximum estimated size, in bytes, of the retained changes; unlimited by default
+		"""
 		self._past = []
 		self._future = []
 		self._commands_are_blocked = False
@@ -170,28 +283,95 @@ class ChangeHistory (object):
 		self._freeze_count = 0
 		self._listener = None
 		self._pres_state_listeners = None
+		self._max_entries = max_entries
+		self._max_bytes = max_bytes
+		# Estimated size of the entries in both the past and future
+		self._estimated_size = 0
+		self._num_evicted = 0
+		self._journal = None
 
 
 	def set_listener(self, listener):
 		self._listener = listener
 
 
+	def set_journal(self, journal):
+		"""Record the changes that are added, undone and redone in a ChangeJournal
+
+		:param journal: the journal, or None
+		"""
+		if self._journal is not None:
+			self._journal.history = None
+		self._journal = journal
+		if journal is not None:
+			journal.history = self
+
+
+	def set_budget(self, max_entries=None, max_bytes=None):
+		"""Set the limits on the size of the history
+
+		When a limit is exceeded, the oldest undo steps are discarded, followed by the furthest redo steps if the size
+		limit is still exceeded. The most recent undo step is always retained.
+
+		:param max_entries: [optional] the maximum number of undo steps to retain; unlimited if None
+		:param max_bytes: [optional] the maximum estimated size, in bytes, of the retained changes; unlimited if None
+		"""
+		self._max_entries = max_entries
+		self._max_bytes = max_bytes
+		if self._enforce_budget():
+			self._on_modified()
+
+
+	max_entries = property(lambda self: self._max_entries)
+	max_bytes = property(lambda self: self._max_bytes)
+	estimated_size = property(lambda self: self._estimated_size)
+
+
+	def memory_usage(self):
+		"""Report the memory used by the history
+
+		:return: a dictionary with the keys:
+			'undo_entries' - the number of undo steps
+			'redo_entries' - the number of redo steps
+			'changes' - the number of changes within all steps
+			'estimated_bytes' - the estimated size of the retained changes
+			'evicted_entries' - the number of undo and redo steps discarded to stay within the budget
+			'max_entries', 'max_bytes' - the budget
+		"""
+		return {'undo_entries': len(self._past),
+			'redo_entries': len(self._future),
+			'changes': sum([len(entry._changes)   for entry in self._past]) + sum([len(entry._changes)   for entry in self._future]),
+			'estimated_bytes': self._estimated_size,
+			'evicted_entries': self._num_evicted,
+			'max_entries': self._max_entries,
+			'max_bytes': self._max_bytes}
+
+
 	def add_change(self, change):
 		if not self._commands_are_blocked:
-			del self._future[:]
+			if self._journal is not None:
+				self._journal._on_change(change, False)
+			self._clear_future()
 			top = self._top_change()
 
 			# Attempt to merge @change into @top
 			if top is not None  and  top.can_merge_from(change):
+				entry = self._past[-1]
+				size = entry.estimated_size
 				top.merge_from(change)
+				entry.top_modified()
+				self._estimated_size += entry.estimated_size - size
 			else:
 				if self._is_frozen:
-					self._past[-1].append(change)
+					entry = self._past[-1]
 				else:
 					entry = _ChangeHistoryEntry()
-					entry.append(change)
 					self._past.append(entry)
+				size = entry.estimated_size
+				entry.append(change)
+				self._estimated_size += entry.estimated_size - size
 
+			self._enforce_budget()
 			self._on_modified()
 
 
@@ -227,10 +407,37 @@ class ChangeHistory (object):
 	def clear(self):
 		del self._past[:]
 		del self._future[:]
+		self._estimated_size = 0
 
 		self._on_modified()
 
 
+	def compact(self, keep_recent=0):
+		"""Compact the undo history, combining runs of consecutive undo steps whose changes can be combined (see
+		Change.can_compact_from) into single steps
+
+		Undoing a combined step reverts all of the changes that it was combined from.
+
+		:param keep_recent: [optional] the number of most recent undo steps to leave as they are
+		"""
+		# Do not compact the top entry while it is frozen; changes are still being added to it
+		n = len(self._past) - max(keep_recent, 1   if self._is_frozen   else 0)
+		if n > 0:
+			compacted = []
+			for entry in self._past[:n]:
+				entry.compact()
+				if len(compacted) > 0  and  not entry.is_empty  and  not compacted[-1].is_empty  and\
+						_can_compact(compacted[-1].top(), entry._changes[0]):
+					compacted[-1].extend(entry)
+				else:
+					compacted.append(entry)
+			self._past[:n] = compacted
+			self._estimated_size = sum([entry.estimated_size   for entry in self._past]) + \
+					       sum([entry.estimated_size   for entry in self._future])
+			self._enforce_budget()
+			self._on_modified()
+
+
 	def freeze(self):
 		if not self._is_frozen:
 			# Add a new empty multi entry
@@ -310,6 +517,40 @@ class ChangeHistory (object):
 
 
 
+	def _clear_future(self):
+		for entry in self._future:
+			self._estimated_size -= entry.estimated_size
+		del self._future[:]
+
+
+	def _enforce_budget(self):
+		# Discard the oldest undo steps, followed by the furthest redo steps, until the history is within budget.
+		# The most recent undo step is always retained. Returns True if any steps were discarded.
+		max_entries = self._max_entries
+		max_bytes = self._max_bytes
+		n = 0
+		while len(self._past) - n > 1  and\
+				((max_entries is not None  and  len(self._past) - n > max_entries)  or
+				 (max_bytes is not None  and  self._estimated_size > max_bytes)):
+			self._estimated_size -= self._past[n].estimated_size
+			n += 1
+		if n > 0:
+			del self._past[:n]
+			self._num_evicted += n
+
+		m = 0
+		if max_bytes is not None:
+			while m < len(self._future)  and  self._estimated_size > max_bytes:
+				self._estimated_size -= self._future[m].estimated_size
+				m += 1
+			if m > 0:
+				del self._future[:m]
+				self._num_evicted += m
+
+		return n > 0  or  m > 0
+
+
+
 	def _block_changes(self):
 		self._commands_are_blocked = True
 
@@ -323,11 +564,17 @@ class ChangeHistory (object):
 		self._block_changes()
 		entry.apply()
 		self._unblock_changes()
+		if self._journal is not None:
+			for change in entry._changes:
+				self._journal._on_change(change, False)
 
 	def _revert_entry(self, entry):
 		self._block_changes()
 		entry.revert()
 		self._unblock_changes()
+		if self._journal is not None:
+			for change in reversed(entry._changes):
+				self._journal._on_change(change, True)
 
 
 
@@ -707,6 +954,76 @@ class Test_change_history (unittest.TestCase):
 
 
 
+	def test_budget(self):
+		h = ChangeHistory(max_entries=3)
+		d = Test_change_history._Data( 0, -1 )
+
+		h.track( d )
+
+		for x in xrange(1, 6):
+			d.x = x
+		self.assertEqual( h.num_undo_changes, 3 )
+		self.assertEqual( 2, h.memory_usage()['evicted_entries'] )
+
+		h.undo()
+		h.undo()
+		h.undo()
+		self.assertEqual( d.x, 2 )
+		self.assertFalse( h.can_undo() )
+
+		h.redo()
+		self.assertEqual( d.x, 3 )
+		size = h.estimated_size
+		self.assertTrue( size > 0 )
+
+		h.set_budget(max_bytes=0)
+		self.assertEqual( h.num_undo_changes, 1 )
+		self.assertEqual( h.num_redo_changes, 0 )
+		self.assertTrue( h.estimated_size < size )
+
+		d.x = 10
+		self.assertEqual( h.num_redo_changes, 0 )
+		self.assertEqual( h.num_undo_changes, 1 )
+
+		h.clear()
+		self.assertEqual( 0, h.estimated_size )
+
+
+
+	def test_compact(self):
+		h = ChangeHistory()
+		d = Test_change_history._Data( 0, 0 )
+
+		h.track( d )
+
+		h.freeze()
+		d.x = 1
+		d.y = 1
+		h.thaw()
+		h.freeze()
+		d.y = 2
+		h.thaw()
+		d.x = 2
+		d.x = 3
+		self.assertEqual( h.num_undo_changes, 4 )
+		self.assertEqual( 5, h.memory_usage()['changes'] )
+
+		# The y change in the second step can be combined into the first step; the x changes cannot be combined
+		h.compact( keep_recent=1 )
+		self.assertEqual( h.num_undo_changes, 3 )
+		self.assertEqual( 4, h.memory_usage()['changes'] )
+
+		h.undo()
+		h.undo()
+		self.assertEqual( (d.x, d.y), (1, 2) )
+		h.undo()
+		self.assertEqual( (d.x, d.y), (0, 0) )
+		h.redo()
+		self.assertEqual( (d.x, d.y), (1, 2) )
+
+
+
+
 	def test_stop_tracking(self):
 		h = ChangeHistory()
 		d = Test_change_history._Data( 0, -1 )
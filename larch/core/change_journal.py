@@ -0,0 +1,449 @@
+##-*************************
+##-* This program is free software; you can use it, redistribute it and/or
+##-* modify it under the terms of the GNU Affero General Public License
+##-* version 3 as published by the Free Software Foundation. The full text of
+##-* the GNU Affero General Public License version 3 can be found in the file
+##-* named 'LICENSE.txt' that accompanies this program. This source code is
+##-* (C)copyright Geoffrey French 2011-2014.
+##-*************************
+"""
+Append-only journal of the changes made to tracked objects
+
+A ChangeJournal records the changes that a ChangeHistory applies - including those applied by undo and redo - to a
+file, so that the state of a set of named objects can be recovered after the process exits or crashes. The file
+consists of a header followed by records:
+	checkpoint - the complete state of every registered object
+	op - an operation applied to one registered object
+
+A checkpoint is written every checkpoint_interval operations; loading restores the last checkpoint and replays the
+operations that follow it. An incomplete record at the end of the file (e.g. due to a crash while writing) is discarded.
+
+Registered objects must provide the methods:
+	__journal_state__() - returns the state of the object as a picklable value
+	__journal_restore__(state) - restores the object to a state returned by __journal_state__
+	__journal_replay__(op) - applies an operation
+and changes describe the operations that they apply via Change.journal_op. Changes to objects that are not registered
+are not recorded. Changes to registered objects that cannot be described as an operation, and changes that do not
+identify the object that they modify (e.g. FnChange), cause a checkpoint to be written instead.
+
+If the last checkpoint is damaged, the journal is loaded from the checkpoint that precedes it.
+"""
+import os
+import struct
+import zlib
+import threading
+import tempfile
+import shutil
+import cPickle
+import unittest
+
+
+
+_MAGIC = 'LARCHJNL1\n'
+
+_CHECKPOINT = 1
+_OP = 2
+
+# Record header: kind, payload length, payload CRC32
+_HEADER = struct.Struct('<BII')
+
+
+
+class ChangeJournalError (Exception):
+	pass
+
+
+
+class ChangeJournal (object):
+	def __init__(self, path, checkpoint_interval=1000, sync=False):
+		"""
+		Constructor
+
+		:param path: the path of the journal file
+		:param checkpoint_interval: [optional] the number of operations recorded between automatic checkpoints
+		:param sync: [optional] if True, the file is flushed to disk (fsync) after each record is written; otherwise records are flushed to the operating system
+		"""
+		self.__path = path
+		self.__checkpoint_interval = checkpoint_interval
+		self.__sync = sync
+
+		self.__name_to_object = {}
+		self.__id_to_name = {}
+
+		self.__lock = threading.RLock()
+		self.__file = None
+		self.__ops_since_checkpoint = 0
+		self.history = None
+
+
+	path = property(lambda self: self.__path)
+
+
+	def register(self, name, x):
+		"""
+		Register an object whose changes should be journaled
+
+		:param name: the name under which the object's state is stored
+		:param x: the object
+		"""
+		if name in self.__name_to_object:
+			raise ChangeJournalError, 'An object is already registered under the name \'{0}\''.format(name)
+		self.__name_to_object[name] = x
+		self.__id_to_name[id(x)] = name
+
+
+	def load(self):
+		"""
+		Restore the registered objects from the journal file and open it for writing
+
+		The objects are restored to the state of the last intact checkpoint, after which the operations that follow it
+		are replayed. If the file does not exist, it is created, starting with a checkpoint of the current state of the
+		registered objects.
+
+		Raises ChangeJournalError if the file contains checkpoints, none of which are intact; the file is left unchanged.
+
+		:return: True if state was restored from an existing file, False if the file was created
+		"""
+		with self.__lock:
+			if self.__file is not None:
+				raise ChangeJournalError, 'Journal has already been loaded'
+
+			restored = False
+			end = None
+			if os.path.exists(self.__path):
+				with open(self.__path, 'rb') as f:
+					if f.read(len(_MAGIC)) != _MAGIC:
+						raise ChangeJournalError, '{0} is not a change journal'.format(self.__path)
+					records, end = _read_records(f)
+				if records is not None:
+					self.__replay(records)
+					restored = True
+
+			if end is None:
+				# Create the file with a checkpoint
+				self.__rewrite()
+			else:
+				self.__file = open(self.__path, 'r+b')
+				# Discard any incomplete record at the end of the file
+				self.__file.truncate(end)
+				self.__file.seek(end)
+			return restored
+
+
+	def checkpoint(self):
+		"""
+		Write a checkpoint of the state of the registered objects
+		"""
+		with self.__lock:
+			self.__write(_CHECKPOINT, self.__state())
+			self.__ops_since_checkpoint = 0
+
+
+	def compact(self):
+		"""
+		Replace the journal file with one that consists of a single checkpoint of the current state of the registered objects
+		"""
+		with self.__lock:
+			if self.__file is not None:
+				self.__file.close()
+				self.__file = None
+			self.__rewrite()
+
+
+	def close(self):
+		with self.__lock:
+			if self.__file is not None:
+				self.__file.close()
+				self.__file = None
+
+
+
+	def _on_change(self, change, reverted):
+		"""
+		Record a change; invoked by the change history after the change has been applied or reverted
+		"""
+		journal_op_fn = getattr(change, 'journal_op', None)
+		target_and_op = journal_op_fn(reverted)   if journal_op_fn is not None   else None
+		with self.__lock:
+			if target_and_op is None:
+				# The object that the change modifies is not known; it may be a registered one
+				self.checkpoint()
+				return
+			target, op = target_and_op
+			name = self.__id_to_name.get(id(target))
+			if name is None:
+				# Not journaled
+				return
+			if op is None  or  self.__ops_since_checkpoint >= self.__checkpoint_interval:
+				# The change cannot be described as an operation, or a checkpoint is due; write the complete state instead
+				self.checkpoint()
+			else:
+				self.__write(_OP, (name, op))
+				self.__ops_since_checkpoint += 1
+
+
+
+	def __state(self):
+		return {name: x.__journal_state__()   for name, x in self.__name_to_object.items()}
+
+
+	def __replay(self, records):
+		history = self.history
+		if history is not None:
+			history._block_changes()
+		try:
+			for kind, payload in records:
+				if kind == _CHECKPOINT:
+					for name, state in payload.items():
+						x = self.__name_to_object.get(name)
+						if x is not None:
+							x.__journal_restore__(state)
+				else:
+					name, op = payload
+					x = self.__name_to_object.get(name)
+					if x is not None:
+						x.__journal_replay__(op)
+		finally:
+			if history is not None:
+				history._unblock_changes()
+		self.__ops_since_checkpoint = len(records) - 1
+
+
+	def __rewrite(self):
+		# Write a new file consisting of a checkpoint, replacing the existing file
+		directory = os.path.dirname(os.path.abspath(self.__path))
+		fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.journal')
+		with os.fdopen(fd, 'wb') as f:
+			f.write(_MAGIC)
+			_write_record(f, _CHECKPOINT, self.__state())
+			f.flush()
+			os.fsync(f.fileno())
+		try:
+			os.rename(temp_path, self.__path)
+		except OSError:
+			# Windows cannot rename over an existing file
+			os.remove(self.__path)
+			os.rename(temp_path, self.__path)
+		self.__ops_since_checkpoint = 0
+		self.__file = open(self.__path, 'ab')
+
+
+	def __write(self, kind, payload):
+		if self.__file is None:
+			raise ChangeJournalError, 'Journal has not been loaded'
+		_write_record(self.__file, kind, payload)
+		self.__file.flush()
+		if self.__sync:
+			os.fsync(self.__file.fileno())
+
+
+
+
+def _write_record(f, kind, payload):
+	data = cPickle.dumps(payload, cPickle.HIGHEST_PROTOCOL)
+	f.write(_HEADER.pack(kind, len(data), zlib.crc32(data) & 0xffffffff))
+	f.write(data)
+
+
+def _read_records(f):
+	"""
+	Read the records from the last intact checkpoint onwards; f must be positioned after the header
+
+	Only the headers of the records that precede the checkpoint are read. Reading stops at the first damaged or
+	incomplete record.
+
+	:return: a tuple (records, end) where records is a list of (kind, payload) pairs and end is the offset of the end of the last record read, or (None, None) if there is no complete checkpoint
+	"""
+	start = f.tell()
+	size = os.fstat(f.fileno()).st_size
+	checkpoints = []
+	pos = start
+	while pos + _HEADER.size <= size:
+		f.seek(pos)
+		kind, length, crc = _HEADER.unpack(f.read(_HEADER.size))
+		if pos + _HEADER.size + length > size:
+			break
+		if kind == _CHECKPOINT:
+			checkpoints.append(pos)
+		pos += _HEADER.size + length
+
+	if len(checkpoints) == 0:
+		return None, None
+
+	# Fall back to earlier checkpoints if the later ones are damaged
+	for pos in reversed(checkpoints):
+		f.seek(pos)
+		records = []
+		end = pos
+		while True:
+			header = f.read(_HEADER.size)
+			if len(header) < _HEADER.size:
+				break
+			kind, length, crc = _HEADER.unpack(header)
+			data = f.read(length)
+			if len(data) < length  or  zlib.crc32(data) & 0xffffffff != crc:
+				break
+			records.append((kind, cPickle.loads(data)))
+			end = f.tell()
+		if len(records) > 0:
+			return records, end
+
+	raise ChangeJournalError, 'The change journal has no intact checkpoint'
+
+
+
+
+
+class Test_change_journal (unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.path = os.path.join(self.dir, 'doc.journal')
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+
+	def _open(self, checkpoint_interval=1000):
+		from larch.live import TrackedLiveList
+		from larch.core.change_history import ChangeHistory
+		ls = TrackedLiveList()
+		history = ChangeHistory()
+		journal = ChangeJournal(self.path, checkpoint_interval=checkpoint_interval)
+		journal.register('ls', ls)
+		restored = journal.load()
+		history.set_journal(journal)
+		history.track(ls)
+		return ls, history, journal, restored
+
+
+	def test_replay(self):
+		ls, history, journal, restored = self._open()
+		self.assertFalse(restored)
+		ls.extend(range(10))
+		del ls[2:4]
+		ls.insert(0, 'a')
+		ls.reverse()
+		ls.append('b')
+		history.undo()
+		history.undo()
+		history.redo()
+		ls[1] = 'c'
+		expected = ls[:]
+		journal.close()
+
+		ls2, history2, journal2, restored = self._open()
+		self.assertTrue(restored)
+		self.assertEqual(expected, ls2[:])
+		self.assertFalse(history2.can_undo())
+		ls2.append('d')
+		journal2.close()
+
+		ls3, history3, journal3, restored = self._open()
+		self.assertEqual(expected + ['d'], ls3[:])
+		journal3.close()
+
+
+	def test_checkpoint_and_compact(self):
+		ls, history, journal, restored = self._open(checkpoint_interval=5)
+		for i in xrange(23):
+			ls.append(i)
+		size = os.path.getsize(self.path)
+		journal.compact()
+		self.assertTrue(os.path.getsize(self.path) < size)
+		ls.append(23)
+		journal.close()
+
+		ls2, history2, journal2, restored = self._open()
+		self.assertEqual(range(24), ls2[:])
+		journal2.close()
+
+
+	def test_incomplete_record(self):
+		ls, history, journal, restored = self._open()
+		ls.extend(range(5))
+		ls.append(5)
+		journal.close()
+
+		# Truncate part of the last record, as if writing it was interrupted
+		with open(self.path, 'r+b') as f:
+			f.truncate(os.path.getsize(self.path) - 3)
+
+		ls2, history2, journal2, restored = self._open()
+		self.assertEqual(range(5), ls2[:])
+		ls2.append('x')
+		journal2.close()
+
+		ls3, history3, journal3, restored = self._open()
+		self.assertEqual(range(5) + ['x'], ls3[:])
+		journal3.close()
+
+
+	def _record_offsets(self, kind):
+		offsets = []
+		with open(self.path, 'rb') as f:
+			f.seek(len(_MAGIC))
+			while True:
+				pos = f.tell()
+				header = f.read(_HEADER.size)
+				if len(header) < _HEADER.size:
+					break
+				k, length, crc = _HEADER.unpack(header)
+				if k == kind:
+					offsets.append(pos)
+				f.seek(length, os.SEEK_CUR)
+		return offsets
+
+
+	def _damage(self, pos):
+		# Modify the first byte of the payload of the record at pos
+		with open(self.path, 'r+b') as f:
+			f.seek(pos + _HEADER.size)
+			b = f.read(1)
+			f.seek(pos + _HEADER.size)
+			f.write(chr(ord(b) ^ 0xff))
+
+
+	def test_damaged_checkpoint(self):
+		ls, history, journal, restored = self._open(checkpoint_interval=5)
+		# The sixth change results in a checkpoint
+		for i in xrange(10):
+			ls.append(i)
+		journal.close()
+		checkpoints = self._record_offsets(_CHECKPOINT)
+		self.assertEqual(2, len(checkpoints))
+		self._damage(checkpoints[1])
+
+		# Loaded from the first checkpoint and the operations that follow it, up to the damaged checkpoint
+		ls2, history2, journal2, restored = self._open(checkpoint_interval=5)
+		self.assertTrue(restored)
+		self.assertEqual(range(5), ls2[:])
+		ls2.append('x')
+		journal2.close()
+
+		ls3, history3, journal3, restored = self._open()
+		self.assertEqual(range(5) + ['x'], ls3[:])
+		journal3.close()
+
+		# With no intact checkpoint, loading fails and leaves the file alone
+		for pos in self._record_offsets(_CHECKPOINT):
+			self._damage(pos)
+		with open(self.path, 'rb') as f:
+			contents = f.read()
+		self.assertRaises(ChangeJournalError, self._open)
+		with open(self.path, 'rb') as f:
+			self.assertEqual(contents, f.read())
+
+
+	def test_unregistered_changes(self):
+		from larch.live import TrackedLiveList
+		ls, history, journal, restored = self._open()
+		other = TrackedLiveList()
+		history.track(other)
+		size = os.path.getsize(self.path)
+		other.extend(range(100))
+		other.append(1)
+		self.assertEqual(size, os.path.getsize(self.path))
+		ls.append(1)
+		self.assertEqual(1, len(self._record_offsets(_OP)))
+		self.assertEqual(1, len(self._record_offsets(_CHECKPOINT)))
+		journal.close()
@@ -0,0 +1,466 @@
+##-*************************
+##-* This program is free software; you can use it, redistribute it and/or
+##-* modify it under the terms of the GNU Affero General Public License
+##-* version 3 as published by the Free Software Foundation. The full text of
+##-* the GNU Affero General Public License version 3 can be found in the file
+##-* named 'LICENSE.txt' that accompanies this program. This source code is
+##-* (C)copyright Geoffrey French 2011-2014.
+##-*************************
+"""
+Asynchronous event handling for dynamic page services
+
+DynamicPageService.event handles a block of events and synchronises the page before returning, so the web server
+thread that invokes it waits for the event handlers. AsyncDynamicPageService instead places event blocks in a
+per-view queue and returns immediately. The events are handled by a pool of worker threads, and the resulting
+messages are placed in a per-view channel, from which the client retrieves them with a long-poll request (see the
+poll method). Each view is processed by at most one worker at a time, so its events are handled in order, while a
+slow event handler only holds up its own view.
+
+Tasks queued on a page outside of event handling (e.g. by a background thread modifying a LiveValue) also cause the
+page to be synchronised by a worker, so their messages are pushed to the client through the channel. This starts once
+the client has first polled or sent events, by which time the initial content of the page has been generated.
+
+The client must poll for messages continually, issuing a new poll request as soon as the previous one returns. The
+clients included with larch (the ILarch comm transport) do not poll; a web app that uses this service must provide a
+client transport that does.
+
+To make a concrete service asynchronous, derive from both AsyncDynamicPageService and the service, with
+AsyncDynamicPageService first, e.g.:
+	class AsyncProjectionService (AsyncDynamicPageService, ProjectionService)
+"""
+import json
+import sys
+import threading
+import traceback
+import collections
+import Queue
+import unittest
+
+from larch.core.dynamicpage.service import DynamicPageService
+from larch.core.dynamicpage import messages
+from larch.inspector import present_exception
+
+
+
+class MessageChannel (object):
+	"""
+	A queue of messages awaiting retrieval by the client
+	"""
+	def __init__(self):
+		self.__cond = threading.Condition()
+		self.__messages = []
+		self.__closed = False
+
+
+	def put(self, msgs):
+		with self.__cond:
+			self.__messages.extend(msgs)
+			self.__cond.notify_all()
+
+
+	def get(self, timeout=None):
+		"""
+		Retrieve all of the messages in the channel, waiting for some to arrive if the channel is empty
+
+		:param timeout: [optional] the maximum time to wait, in seconds; waits indefinitely if None
+		:return: a list of messages; empty if none arrived within the timeout or the channel was closed
+		"""
+		with self.__cond:
+			if len(self.__messages) == 0  and  not self.__closed:
+				self.__cond.wait(timeout)
+			msgs = self.__messages
+			self.__messages = []
+			return msgs
+
+
+	def close(self):
+		with self.__cond:
+			self.__closed = True
+			self.__cond.notify_all()
+
+
+	is_closed = property(lambda self: self.__closed)
+
+
+
+class _WorkerPool (object):
+	def __init__(self, num_threads):
+		self.__num_threads = num_threads
+		self.__jobs = Queue.Queue()
+		self.__threads = []
+		self.__lock = threading.Lock()
+
+
+	def submit(self, job):
+		with self.__lock:
+			if len(self.__threads) == 0:
+				for i in xrange(self.__num_threads):
+					thread = threading.Thread(target=self.__work, name='larch-page-worker-{0}'.format(i))
+					thread.daemon = True
+					thread.start()
+					self.__threads.append(thread)
+		self.__jobs.put(job)
+
+
+	def shutdown(self):
+		with self.__lock:
+			for thread in self.__threads:
+				self.__jobs.put(None)
+			for thread in self.__threads:
+				thread.join()
+			del self.__threads[:]
+
+
+	def __work(self):
+		while True:
+			job = self.__jobs.get()
+			if job is None:
+				return
+			try:
+				job()
+			except Exception:
+				# Keep the thread alive to handle further jobs
+				print 'Error in page worker:'
+				traceback.print_exc()
+
+
+
+class _ViewWorker (object):
+	"""
+	Handles the events and synchronisation of a view; runs on at most one pool thread at a time
+	"""
+	def __init__(self, service, dynamic_page, pool):
+		self.__service = service
+		self.__dynamic_page = dynamic_page
+		self.__pool = pool
+		self.channel = MessageChannel()
+
+		self.__lock = threading.Lock()
+		self.__pending_events = collections.deque()
+		self.__sync_requested = False
+		self.__scheduled = False
+		# Tasks are not executed until the client has connected, so that they do not modify the page while its initial
+		# content is being generated
+		self.__started = False
+
+		dynamic_page.register_queue_synchronize_callback(self.__on_queue_synchronize)
+
+
+	def start(self):
+		with self.__lock:
+			if not self.__started:
+				self.__started = True
+				if self.__sync_requested:
+					self.__schedule()
+
+
+	def post_events(self, events_json):
+		with self.__lock:
+			self.__started = True
+			self.__pending_events.append(events_json)
+			self.__schedule()
+
+
+	def close(self):
+		self.__dynamic_page.unregister_queue_synchronize_callback(self.__on_queue_synchronize)
+		self.channel.close()
+
+
+	def __on_queue_synchronize(self, page):
+		with self.__lock:
+			self.__sync_requested = True
+			if self.__started:
+				self.__schedule()
+
+
+	def __schedule(self):
+		# Called with the lock held
+		if not self.__scheduled:
+			self.__scheduled = True
+			self.__pool.submit(self.__run)
+
+
+	def __run(self):
+		finished = False
+		try:
+			while True:
+				with self.__lock:
+					if len(self.__pending_events) == 0  and  not self.__sync_requested:
+						self.__scheduled = False
+						finished = True
+						return
+					# Handle all of the event blocks that have arrived together, with a single synchronisation
+					event_blocks_json = list(self.__pending_events)
+					self.__pending_events.clear()
+					self.__sync_requested = False
+
+				try:
+					# Errors in individual blocks are reported by _handle_event_blocks
+					msgs = self.__service._handle_event_blocks(self.__dynamic_page, event_blocks_json)
+				except Exception, e:
+					# Report the error to the client and carry on with the blocks that arrive next
+					err_html = present_exception.exception_to_html_src(e, sys.exc_info()[1], sys.exc_info()[2])
+					msgs = [messages.error_during_update_message(err_html)]
+				if len(msgs) > 0:
+					self.channel.put(msgs)
+		finally:
+			if not finished:
+				# Unexpected error; allow the view to be scheduled again, so that it does not stop handling events
+				with self.__lock:
+					self.__scheduled = False
+
+
+
+class AsyncDynamicPageService (DynamicPageService):
+	def __init__(self, *args, **kwargs):
+		"""
+		Constructor
+
+		Keyword arguments:
+			num_workers - [optional] the number of worker threads that handle events
+			poll_timeout - [optional] the time in seconds for which a poll request waits for messages
+		Any other arguments are passed to the constructor of the next service class
+		"""
+		num_workers = kwargs.pop('num_workers', 4)
+		self.__poll_timeout = kwargs.pop('poll_timeout', 30.0)
+		super(AsyncDynamicPageService, self).__init__(*args, **kwargs)
+		self.__pool = _WorkerPool(num_workers)
+		self.__workers = {}
+		self.__workers_lock = threading.Lock()
+
+
+	def new_view(self, subject):
+		view = super(AsyncDynamicPageService, self).new_view(subject)
+		worker = _ViewWorker(self, view.dynamic_page, self.__pool)
+		with self.__workers_lock:
+			self.__workers[view.dynamic_page._view_id] = worker
+		return view
+
+
+	def event(self, view_id, event_data):
+		"""
+		Event response. Map the URL <root_url>/event/<view_id> to this. The events are queued for handling by a worker;
+		the resulting messages are retrieved by the client using the poll method.
+
+		:param view_id: view_id field from URL
+		:param event_data: event_data field from POST data
+		:return: JSON string to send to the client browser; an empty list of messages unless the view is invalid
+		"""
+		worker = self.__get_worker(view_id)
+		if worker is None:
+			return json.dumps([messages.invalid_page_message()])
+
+		block_json = json.loads(event_data)
+		worker.post_events(block_json['messages'])
+		return json.dumps([])
+
+
+	def form(self, view_id, form_data):
+		"""
+		Form response. Map the URL <root_url>/form/<view_id> to this. Handled asynchronously, as with the event method.
+		"""
+		worker = self.__get_worker(view_id)
+		if worker is None:
+			return json.dumps([messages.invalid_page_message()])
+
+		ev_data = {}
+		ev_data.update(form_data)
+		segment_id = ev_data.pop('__larch_segment_id')
+		worker.post_events([{'segment_id': segment_id, 'event_name': 'form_submit', 'ev_data': ev_data}])
+		return json.dumps([])
+
+
+	def poll(self, view_id, timeout=None):
+		"""
+		Long-poll response. Map the URL <root_url>/poll/<view_id> to this. Waits for messages for the given view.
+
+		:param view_id: view_id field from URL
+		:param timeout: [optional] the time in seconds to wait for messages; the poll_timeout passed to the constructor by default
+		:return: JSON string to send to the client browser; an empty list if no messages arrived within the timeout
+		"""
+		worker = self.__get_worker(view_id)
+		if worker is None:
+			return json.dumps([messages.invalid_page_message()])
+
+		worker.start()
+		timeout = timeout   if timeout is not None   else self.__poll_timeout
+		return json.dumps(worker.channel.get(timeout))
+
+
+	def shutdown(self):
+		"""
+		Close all channels and stop the worker threads
+		"""
+		with self.__workers_lock:
+			workers = self.__workers.values()
+			self.__workers.clear()
+		for worker in workers:
+			worker.close()
+		self.__pool.shutdown()
+
+
+	def _close_page(self, page):
+		self.__close_worker(page._view_id)
+		super(AsyncDynamicPageService, self)._close_page(page)
+
+
+	def __close_worker(self, view_id):
+		with self.__workers_lock:
+			worker = self.__workers.pop(view_id, None)
+		if worker is not None:
+			worker.close()
+
+
+	def __get_worker(self, view_id):
+		# Look the view up in the registry, so that it is marked as accessed
+		if self._get_view(view_id) is None:
+			return None
+		with self.__workers_lock:
+			return self.__workers.get(view_id)
+
+
+
+
+
+class Test_AsyncDynamicPageService (unittest.TestCase):
+	def setUp(self):
+		self.service = AsyncDynamicPageService(num_workers=2, poll_timeout=5.0)
+
+	def tearDown(self):
+		self.service.shutdown()
+
+
+	def _new_view(self):
+		from larch.live import LiveValue
+		from larch.core.incremental_view import IncrementalView
+		from larch.core.subject import Subject
+		live = LiveValue(0)
+		view = self.service.new_view(None)
+		page = view.dynamic_page
+		view.view_data = IncrementalView(Subject(live), page)
+		page.initial_content()
+		page.synchronize()
+		return page, page._view_id, live
+
+
+	@staticmethod
+	def _event_data(event_name, data):
+		return json.dumps({'id': 0, 'messages': [{'segment_id': None, 'event_name': event_name, 'ev_data': data}]})
+
+
+	def test_slow_view_does_not_block_others(self):
+		release = threading.Event()
+		handled = []
+
+		slow_page, slow_id, slow_live = self._new_view()
+		fast_page, fast_id, fast_live = self._new_view()
+
+		def on_slow(event):
+			release.wait(5.0)
+			handled.append('slow')
+			slow_live.value = 1
+			return True
+
+		def on_fast(event):
+			handled.append(event.data)
+			fast_live.value = event.data
+			return True
+
+		slow_page.add_page_event_handler('go', on_slow)
+		fast_page.add_page_event_handler('go', on_fast)
+
+		self.assertEqual('[]', self.service.event(slow_id, self._event_data('go', None)))
+		self.service.event(fast_id, self._event_data('go', 1))
+		self.service.event(fast_id, self._event_data('go', 2))
+
+		# The fast view's messages arrive while the slow view's handler is still blocked
+		msgs = json.loads(self.service.poll(fast_id))
+		while len(handled) < 2:
+			msgs.extend(json.loads(self.service.poll(fast_id)))
+		self.assertEqual([1, 2], handled)
+		self.assertNotEqual([], msgs)
+
+		release.set()
+		while len(handled) < 3:
+			json.loads(self.service.poll(slow_id))
+		self.assertEqual([1, 2, 'slow'], handled)
+
+
+	def test_bad_event(self):
+		page, view_id, live = self._new_view()
+		handled = []
+
+		def on_go(event):
+			handled.append(event.data)
+			live.value = event.data
+			return True
+
+		page.add_page_event_handler('go', on_go)
+
+		# A malformed event message; ev_data is missing
+		self.service.event(view_id, json.dumps({'id': 0, 'messages': [{'segment_id': None, 'event_name': 'go'}]}))
+		msgs = json.loads(self.service.poll(view_id))
+		self.assertEqual(['error_during_update'], [m['msgtype']   for m in msgs])
+
+		# The view continues to handle events
+		self.service.event(view_id, self._event_data('go', 1))
+		msgs = json.loads(self.service.poll(view_id))
+		self.assertEqual([1], handled)
+		self.assertNotEqual([], msgs)
+
+
+	def test_bad_block_with_good_block(self):
+		page, view_id, live = self._new_view()
+		handled = []
+		release = threading.Event()
+		started = threading.Event()
+
+		def on_go(event):
+			handled.append(event.data)
+			live.value = event.data
+			return True
+
+		def on_wait(event):
+			started.set()
+			release.wait(5.0)
+			return True
+
+		page.add_page_event_handler('go', on_go)
+		page.add_page_event_handler('wait', on_wait)
+
+		# Hold up the worker, so that the next two blocks are handled together
+		self.service.event(view_id, self._event_data('wait', None))
+		self.assertTrue(started.wait(5.0))
+		# A malformed block; segment_id is missing
+		self.service.event(view_id, json.dumps({'id': 1, 'messages': [{'event_name': 'go', 'ev_data': 1}]}))
+		self.service.event(view_id, self._event_data('go', 2))
+		release.set()
+
+		msg_types = []
+		for i in xrange(10):
+			msg_types.extend([m['msgtype']   for m in json.loads(self.service.poll(view_id, timeout=1.0))])
+			if 'modify_page' in msg_types  and  'error_during_update' in msg_types:
+				break
+		# The good block was handled and synchronised, and the bad block was reported
+		self.assertEqual([2], handled)
+		self.assertTrue('modify_page' in msg_types)
+		self.assertTrue('error_during_update' in msg_types)
+
+
+	def test_background_task_is_pushed(self):
+		page, view_id, live = self._new_view()
+		self.assertEqual('[]', self.service.poll(view_id, timeout=0.01))
+
+		def modify():
+			live.value = 1
+
+		thread = threading.Thread(target=modify)
+		thread.start()
+		msgs = json.loads(self.service.poll(view_id))
+		thread.join()
+		self.assertEqual(1, len(msgs))
+
+
+	def test_invalid_view(self):
+		msgs = json.loads(self.service.event('nonexistent', self._event_data('go', None)))
+		self.assertEqual([messages.invalid_page_message()], msgs)
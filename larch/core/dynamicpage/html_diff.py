@@ -0,0 +1,252 @@
+##-*************************
+##-* This program is free software; you can use it, redistribute it and/or
+##-* modify it under the terms of the GNU Affero General Public License
+##-* version 3 as published by the Free Software Foundation. The full text of
+##-* the GNU Affero General Public License version 3 can be found in the file
+##-* named 'LICENSE.txt' that accompanies this program. This source code is
+##-* (C)copyright Geoffrey French 2011-2014.
+##-*************************
+"""
+Item level diffing of segment HTML
+
+The HTML source of a segment is built as a list of string items (see HtmlContent._build_html). When the content of a
+segment that the client has seen before is modified, the new list of items can be sent as a patch against the previous
+list. A patch is a list of operations, each of which is either:
+	a string - an item to insert
+	a [start, count] pair - copy count items from the previous list, starting at index start
+
+The client applies the patch (see Larch.__decodeSegmentContent in larch.js) to recover the new items, which it joins
+to make the HTML source of the segment.
+
+difflib.SequenceMatcher takes time quadratic in the number of items, so it is only used on short runs of items. Longer
+runs are first aligned on the items that occur exactly once in both the previous and new lists (as in patience
+diff), with the matches extended to the neighbouring equal items; the short gaps between them are then matched by the
+sequence matcher and the long gaps are sent in full.
+"""
+import bisect
+import difflib
+import unittest
+
+
+# The estimated size of a copy operation in the JSON encoded patch
+_COPY_OP_SIZE = 12
+
+# The maximum total number of items in a pair of runs that are compared with the sequence matcher
+_MAX_MATCHER_ITEMS = 1000
+
+
+
+def _size(items):
+	return sum([len(x)   for x in items])
+
+
+def diff_items(prev_items, items):
+	"""
+	Compute a patch that transforms one list of HTML source items into another
+
+	:param prev_items: the list of items that the client has
+	:param items: the new list of items
+	:return: a list of patch operations
+	"""
+	n_prev = len(prev_items)
+	n = len(items)
+
+	# Trim the common prefix and suffix; typically only a small part of a large segment changes, so this leaves little work for
+	# the sequence matcher
+	prefix = 0
+	while prefix < n_prev  and  prefix < n  and  prev_items[prefix] == items[prefix]:
+		prefix += 1
+	suffix = 0
+	while suffix < n_prev - prefix  and  suffix < n - prefix  and  prev_items[n_prev - 1 - suffix] == items[n - 1 - suffix]:
+		suffix += 1
+
+	patch = []
+	def copy(start, count):
+		if count > 0:
+			if len(patch) > 0  and  not isinstance(patch[-1], basestring)  and  patch[-1][0] + patch[-1][1] == start:
+				patch[-1][1] += count
+			else:
+				patch.append([start, count])
+
+	copy(0, prefix)
+	a = prev_items[prefix:n_prev-suffix]
+	b = items[prefix:n-suffix]
+	j = 0
+	for block_i, block_j, size in _matching_blocks(a, b):
+		patch.extend(b[j:block_j])
+		copy(prefix + block_i, size)
+		j = block_j + size
+	patch.extend(b[j:])
+	copy(n_prev - suffix, suffix)
+
+	return patch
+
+
+def _matching_blocks(a, b):
+	# Returns a list of (i, j, size) triples, in increasing order of both i and j, where a[i:i+size] == b[j:j+size]
+	if len(a) + len(b) <= _MAX_MATCHER_ITEMS:
+		matcher = difflib.SequenceMatcher(None, a, b, autojunk=False)
+		return [tuple(block)   for block in matcher.get_matching_blocks()   if block[2] > 0]
+
+	blocks = []
+	prev_i = prev_j = 0
+	for i, j in _unique_anchors(a, b):
+		if i < prev_i  or  j < prev_j:
+			# Covered by the previous block
+			continue
+		# Extend the match backwards and forwards over equal items
+		start = 0
+		while i - start > prev_i  and  j - start > prev_j  and  a[i-start-1] == b[j-start-1]:
+			start += 1
+		end = 1
+		while i + end < len(a)  and  j + end < len(b)  and  a[i+end] == b[j+end]:
+			end += 1
+		blocks.extend(_gap_matching_blocks(a, b, prev_i, i - start, prev_j, j - start))
+		blocks.append((i - start, j - start, start + end))
+		prev_i, prev_j = i + end, j + end
+	blocks.extend(_gap_matching_blocks(a, b, prev_i, len(a), prev_j, len(b)))
+	return blocks
+
+
+def _gap_matching_blocks(a, b, i1, i2, j1, j2):
+	# Match the items in a gap between aligned blocks, if it is short enough to use the sequence matcher
+	if i2 > i1  and  j2 > j1  and  (i2 - i1) + (j2 - j1) <= _MAX_MATCHER_ITEMS:
+		return [(i1 + i, j1 + j, size)   for i, j, size in _matching_blocks(a[i1:i2], b[j1:j2])]
+	else:
+		return []
+
+
+def _unique_anchors(a, b):
+	# Find the items that occur exactly once in each of a and b, and return the longest sequence of their (i, j)
+	# positions that increases in both i and j
+	counts = {}
+	for i, x in enumerate(a):
+		entry = counts.get(x)
+		counts[x] = [i, None, 1, 0]   if entry is None   else [entry[0], None, entry[2] + 1, 0]
+	for j, x in enumerate(b):
+		entry = counts.get(x)
+		if entry is not None:
+			entry[1] = j
+			entry[3] += 1
+	pairs = sorted([(entry[0], entry[1])   for entry in counts.values()   if entry[2] == 1  and  entry[3] == 1])
+
+	# Longest increasing subsequence of j, by patience sorting
+	tails = []
+	tail_indices = []
+	predecessors = [None] * len(pairs)
+	for k, (i, j) in enumerate(pairs):
+		pos = bisect.bisect_left(tails, j)
+		if pos > 0:
+			predecessors[k] = tail_indices[pos - 1]
+		if pos == len(tails):
+			tails.append(j)
+			tail_indices.append(k)
+		else:
+			tails[pos] = j
+			tail_indices[pos] = k
+	anchors = []
+	k = tail_indices[-1]   if len(tail_indices) > 0   else None
+	while k is not None:
+		anchors.append(pairs[k])
+		k = predecessors[k]
+	anchors.reverse()
+	return anchors
+
+
+def patch_size(patch):
+	"""
+	Estimate the size of a patch once encoded
+	"""
+	size = 0
+	for op in patch:
+		if isinstance(op, basestring):
+			size += len(op)
+		else:
+			size += _COPY_OP_SIZE
+	return size
+
+
+def encode_segment_items(prev_items, items):
+	"""
+	Encode the new HTML source items of a segment for sending to the client
+
+	:param prev_items: the items that were last sent to the client, or None if the client does not have them
+	:param items: the new items
+	:return: {'patch': patch}   if a patch is smaller than the items themselves, otherwise {'items': items}
+	"""
+	if prev_items is not None:
+		patch = diff_items(prev_items, items)
+		if patch_size(patch) < _size(items):
+			return {'patch': patch}
+	return {'items': items}
+
+
+def apply_patch(prev_items, patch):
+	"""
+	Apply a patch; the Python counterpart of the client side implementation
+
+	:param prev_items: the previous list of items
+	:param patch: the patch computed by diff_items
+	:return: the new list of items
+	"""
+	items = []
+	for op in patch:
+		if isinstance(op, basestring):
+			items.append(op)
+		else:
+			start, count = op
+			items.extend(prev_items[start:start+count])
+	return items
+
+
+
+
+
+class Test_html_diff (unittest.TestCase):
+	def _check(self, prev_items, items):
+		patch = diff_items(prev_items, items)
+		self.assertEqual(items, apply_patch(prev_items, patch))
+		return patch
+
+
+	def test_unchanged(self):
+		self.assertEqual([[0, 3]], self._check(['a', 'b', 'c'], ['a', 'b', 'c']))
+
+	def test_empty(self):
+		self.assertEqual([], self._check(['a', 'b'], []))
+		self.assertEqual(['a', 'b'], self._check([], ['a', 'b']))
+
+	def test_modify(self):
+		prev = ['<table>'] + ['<tr><td>', 'x', '</td></tr>'] * 100 + ['</table>']
+		items = list(prev)
+		items[151] = 'y'
+		self.assertEqual([[0, 151], 'y', [152, 150]], self._check(prev, items))
+
+	def test_insert_remove(self):
+		self._check(['a', 'b', 'c', 'd', 'e'], ['a', 'x', 'c', 'e', 'f'])
+		self._check(['a', 'b', 'a', 'b'], ['b', 'a', 'b', 'a'])
+		self._check(['a', 'a', 'a'], ['a', 'a'])
+
+	def test_large(self):
+		# A large table with a cell changed near each end; too large for the sequence matcher
+		prev = ['<table>']
+		for i in xrange(10000):
+			prev.extend(['<tr><td>', str(i), '</td><td>', 'x', '</td></tr>'])
+		prev.append('</table>')
+		items = list(prev)
+		items[4] = 'y'
+		items[-3] = 'z'
+		patch = self._check(prev, items)
+		self.assertEqual([[0, 4], 'y', [5, len(prev) - 8], 'z', [len(prev) - 2, 2]], patch)
+
+		# Rows inserted and removed in the middle
+		items = prev[:20001] + ['<tr><td>', 'new', '</td></tr>'] + prev[20011:]
+		patch = self._check(prev, items)
+		self.assertTrue(patch_size(patch) < 100)
+
+
+	def test_encode(self):
+		self.assertEqual({'items': ['a']}, encode_segment_items(None, ['a']))
+		self.assertEqual({'items': ['a', 'b']}, encode_segment_items(['x', 'y'], ['a', 'b']))
+		prev = ['<p>' * 50, 'x', '</p>' * 50]
+		self.assertEqual({'patch': [[0, 1], 'y', [2, 1]]}, encode_segment_items(prev, [prev[0], 'y', prev[2]]))
@@ -6,18 +6,22 @@
 ##-* named 'LICENSE.txt' that accompanies this program. This source code is
 ##-* (C)copyright Geoffrey French 2011-2014.
 ##-*************************
-import threading
 import sys
+import urllib
+import threading
+import unittest
 
 import json
 
 from copy import copy
 from larch import js
 
-from larch.util import priority_list
+from larch.util import priority_list, rw_lock
 from larch.core.dynamicpage.segment import DynamicSegment, SegmentRef
 from larch.core.dynamicpage.event import Event
-from larch.core.dynamicpage import messages, dependencies, global_dependencies
+from larch.core.dynamicpage.resource_stream import ResourceStream
+from larch.pres.resource import data_version
+from larch.core.dynamicpage import messages, dependencies, global_dependencies, html_diff, serialization_cache
 from larch.inspector import present_exception
 
 
@@ -106,6 +110,31 @@ class EventHandleError (object):
 
 
 
+def etag_for_version(version, content_encoding=None):
+	# Each content encoding of the data is a different representation, so it has a different ETag
+	if content_encoding is not None:
+		return '"{0}-{1}"'.format(version, content_encoding)
+	else:
+		return '"{0}"'.format(version)
+
+
+def _version_matches(version, if_none_match):
+	if if_none_match is None:
+		return False
+	if if_none_match.strip() == '*':
+		return True
+	etags = {etag_for_version(version), etag_for_version(version, 'gzip')}
+	for tag in if_none_match.split(','):
+		tag = tag.strip()
+		# Weak comparison, as required for If-None-Match
+		if tag.startswith('W/'):
+			tag = tag[2:]
+		if tag in etags:
+			return True
+	return False
+
+
+
 def _rsc_retrieve_error_message(rsc_seg_id, rsc_model_type_name, exception, exc_value, traceback):
 	err_html = present_exception.exception_to_html_src(exception, exc_value, traceback)
 	return messages.error_retrieving_resource(err_html, rsc_seg_id, rsc_model_type_name)
@@ -255,6 +284,8 @@ class DynamicPage (object):
 		self.__rsc_id_counter = 1
 		self.__rsc_id_to_rsc_instance = {}
 		self.__url_rsc_id_to_rsc_instance = {}
+		# Immutable URL resources are kept separately, so that they can be retrieved without acquiring the page lock
+		self.__immutable_url_rsc_id_to_rsc_instance = {}
 		self.__resource_to_resource_instance = {}
 		self.__resource_id_and_message_pairs = []
 		self.__disposed_rsc_instance_ids = set()
@@ -264,7 +295,7 @@ class DynamicPage (object):
 		self.__segment_dispose_listeners = {}
 
 		# Threading lock, required for servers such as CherryPy
-		self.__lock = None
+		self.__lock = rw_lock.ReadWriteLock()
 
 		# Incremental view
 		self.__inc_view = None
@@ -300,6 +331,22 @@ class DynamicPage (object):
 
 
 
+	@property
+	def html_diffing(self):
+		"""
+		HTML diffing mode
+
+		When enabled, the HTML source of a modified segment is sent as a patch against the source that was previously
+		sent for it, where that is smaller. Only the items that differ are transferred, rather than the complete source.
+		"""
+		return self._table._html_diffing
+
+	@html_diffing.setter
+	def html_diffing(self, value):
+		self._table._html_diffing = value
+
+
+
 	#
 	#
 	# Threads/locking
@@ -307,13 +354,23 @@ class DynamicPage (object):
 	#
 
 	def lock(self):
-		if self.__lock is None:
-			self.__lock = threading.Lock()
-		self.__lock.acquire()
+		"""
+		Acquire the page lock exclusively, for handling events and synchronising
+		"""
+		self.__lock.acquire_write()
 
 	def unlock(self):
-		if self.__lock is not None:
-			self.__lock.release()
+		self.__lock.release_write()
+
+
+	def lock_read(self):
+		"""
+		Acquire the page lock for reading; readers may run concurrently with each other, but not with event handling
+		"""
+		self.__lock.acquire_read()
+
+	def unlock_read(self):
+		self.__lock.release_read()
 
 
 
@@ -555,31 +612,119 @@ class DynamicPage (object):
 
 
 	def _allocate_resource_url(self, rsc_instance):
-		self.__url_rsc_id_to_rsc_instance[rsc_instance.id] = rsc_instance
+		if rsc_instance.is_immutable:
+			self.__immutable_url_rsc_id_to_rsc_instance[rsc_instance.id] = rsc_instance
+		else:
+			self.__url_rsc_id_to_rsc_instance[rsc_instance.id] = rsc_instance
 
 	def _deallocate_resource_url(self, rsc_instance):
-		del self.__url_rsc_id_to_rsc_instance[rsc_instance.id]
+		if rsc_instance.is_immutable:
+			del self.__immutable_url_rsc_id_to_rsc_instance[rsc_instance.id]
+		else:
+			del self.__url_rsc_id_to_rsc_instance[rsc_instance.id]
 
 
 
 	# Resource retrieval
-	def get_url_resource_data(self, rsc_id):
+	def get_url_resource_data(self, rsc_id, stream=False):
+		"""
+		Retrieve the data of a URL resource
+
+		:param rsc_id: the resource ID
+		:param stream: [optional] if True, the data is returned as a ResourceStream rather than a string
+		:return: a tuple (data, mime_type), or None if there is no resource with the given ID. data is a string or, for resources that serve a buffer without copying it (e.g. NumpyArrayResource), a memoryview
+		"""
+		result = self.get_url_resource(rsc_id, stream=stream)
+		return result[:2]   if result is not None   else None
+
+
+	def get_url_resource(self, rsc_id, stream=False, if_none_match=None, accept_gzip=False):
+		"""
+		Retrieve the data of a URL resource along with its ETag, answering conditional requests
+
+		Immutable resources (see URLResource.is_immutable) are retrieved without acquiring the page lock, so that serving
+		them neither waits for nor holds up event handling. Other resources are retrieved while holding the page lock for
+		reading.
+
+		When streaming, only the stream is obtained while holding the lock; its chunks are produced as the caller
+		iterates over it, after the lock has been released.
+
+		The ETag is derived from the version of the resource (see URLResource.get_version). If the resource does not
+		provide a version, it is computed from a hash of the data, except when streaming, in which case there is no ETag.
+
+		The data of versioned resources is retrieved via the shared serialization cache, so that it is computed - and
+		compressed - once per version, no matter how many clients request it.
+
+		:param rsc_id: the resource ID
+		:param stream: [optional] if True, the data is returned as a ResourceStream rather than a string
+		:param if_none_match: [optional] the value of the If-None-Match header of a conditional request
+		:param accept_gzip: [optional] if True, the data may be returned gzip compressed; not applicable when streaming
+		:return: a tuple (data, mime_type, etag, content_encoding), or None if there is no resource with the given ID. data is a string, a memoryview (see get_url_resource_data) or a ResourceStream; it is None if the ETag matches if_none_match, in which case the client's copy is up to date. etag is None if it is not known. content_encoding is 'gzip' if the data is compressed, None otherwise.
+		"""
+		rsc = self.__immutable_url_rsc_id_to_rsc_instance.get(rsc_id)
+		if rsc is not None:
+			return self.__retrieve_resource_data(rsc, stream, if_none_match, accept_gzip)
+
+		self.lock_read()
 		try:
-			rsc = self.__url_rsc_id_to_rsc_instance[rsc_id]
-		except KeyError:
-			return None
-		else:
-			try:
+			rsc = self.__url_rsc_id_to_rsc_instance.get(rsc_id)
+			if rsc is None:
+				return None
+			return self.__retrieve_resource_data(rsc, stream, if_none_match, accept_gzip)
+		finally:
+			self.unlock_read()
+
+
+	def __retrieve_resource_data(self, rsc, stream, if_none_match, accept_gzip):
+		content_encoding = None
+		try:
+			version = rsc.get_version()
+			if version is not None  and  _version_matches(version, if_none_match):
+				# Not modified; the data need not be retrieved
+				if accept_gzip  and  not stream  and  serialization_cache.is_compressible(rsc.get_mime_type()):
+					content_encoding = 'gzip'
+				return None, rsc.get_mime_type(), etag_for_version(version, content_encoding), content_encoding
+
+			if stream:
+				data = rsc.get_stream()
+				data = ResourceStream(self.__resource_chunks(rsc, data), data.content_length, data.close)
+			elif version is not None:
+				cache = serialization_cache.shared_cache
+				if accept_gzip  and  serialization_cache.is_compressible(rsc.get_mime_type()):
+					data = cache.get_gzip(rsc.resource, version, rsc.get_data)
+					content_encoding = 'gzip'
+				else:
+					data = cache.get(rsc.resource, version, rsc.get_data)
+			else:
 				data = rsc.get_data()
-				mime_type = rsc.get_mime_type()
-			except Exception, e:
-				fragment = rsc.pres_ctx.fragment_view
-				msg = _rsc_retrieve_error_message(fragment.segment_id, type(fragment.model).__name__, e, sys.exc_info()[1], sys.exc_info()[2])
-				self.__resource_error_messages.append(msg)
-				data = ''
-				mime_type = ''
+				version = data_version(data)
+				if _version_matches(version, if_none_match):
+					return None, rsc.get_mime_type(), etag_for_version(version), None
+			mime_type = rsc.get_mime_type()
+			etag = etag_for_version(version, content_encoding)   if version is not None   else None
+		except Exception, e:
+			self.__resource_error(rsc, e)
+			data = ResourceStream.from_data('')   if stream   else ''
+			mime_type = ''
+			etag = None
+			content_encoding = None
+
+		return data, mime_type, etag, content_encoding
+
+
+	def __resource_chunks(self, rsc, data):
+		try:
+			for chunk in data:
+				yield chunk
+		except Exception, e:
+			# The data has been partially sent; report the error and end the stream
+			self.__resource_error(rsc, e)
 
-			return data, mime_type
+
+	def __resource_error(self, rsc, e):
+		fragment = rsc.pres_ctx.fragment_view
+		msg = _rsc_retrieve_error_message(fragment.segment_id, type(fragment.model).__name__, e, sys.exc_info()[1], sys.exc_info()[2])
+		self.__resource_error_messages.append(msg)
 
 
 
@@ -686,11 +831,12 @@ class DynamicPage (object):
 				msg_list.append(structure_validity_message)
 
 
-			# Resource errors
-			if len(self.__resource_error_messages) > 0:
+			# Resource errors; resources are retrieved on other threads, so swap the list in a single step so that an
+			# error reported in the meantime is not lost
+			rsc_error_messages, self.__resource_error_messages = self.__resource_error_messages, []
+			if len(rsc_error_messages) > 0:
 				print 'Page.sync: Adding rsc error messages'
-				msg_list.extend(self.__resource_error_messages)
-				self.__resource_error_messages = []
+				msg_list.extend(rsc_error_messages)
 
 
 		return msg_list, deps_list
@@ -885,6 +1031,8 @@ class DynamicPage (object):
 		initialisers = self._table._get_all_initialisers()
 
 		self._table._clear_changes()
+		# The client is starting afresh
+		self._table._clear_sent_items()
 
 
 		return self._view_id, root_content, self.__js_queue, initialisers, deps_list
@@ -899,13 +1047,19 @@ class _ChangeSet (object):
 
 	Represents a set of DOM changes that must be applied by the client.
 	"""
-	def __init__(self, added_segs, removed_segs, modified_segs, popup_segs_to_js_src, segment_id_to_queued_scripts):
+	def __init__(self, added_segs, removed_segs, modified_segs, popup_segs_to_js_src, segment_id_to_queued_scripts, segment_id_to_sent_items=None,
+		     splices=None):
 		"""Constructor
 
 		added_segs - the set of new segments added
 		removed_segs - the set of segments that were removed
 		modified_segs - the set of modified segments
 		popup_segs - the set of popup segments
+		segment_id_to_sent_items - when diffing HTML, a dictionary mapping segment ID to the HTML source items last sent to the
+		client for that segment; it is updated as the changes are processed. None to send complete HTML source.
+		splices - a list of (segment, removed_segs, before_seg, inserted_segs) tuples, in the order in which the child segments of
+		the segments were spliced (see DynamicSegment.splice_children). Splices of removed or modified segments are dropped, as
+		the client will not have the segment or will receive its complete content.
 
 		Processes the changes, eliminating the added segments in the process; new segments should be children of modified segments, into which
 		they are 'inlined'. By the time the inline process has finished, only removal and modification operations remain.
@@ -918,6 +1072,7 @@ class _ChangeSet (object):
 
 		self.removed = [seg.id   for seg in removed_segs]
 		self.modified = []
+		self.spliced = []
 		self.popups = [[seg.id, seg.reference()._complete_html()]   for seg in popup_segs]
 		self.popup_scripts = [[seg.id, init_js_src]   for seg, init_js_src in popup_segs_to_js_src.items()]
 		self.initialise_scripts = []
@@ -944,9 +1099,29 @@ class _ChangeSet (object):
 			seg._build_inline_html(items, self.__resolve_reference)
 			self.__added_seg_to_html_bits[seg] = items
 
+		if segment_id_to_sent_items is not None:
+			for seg in removed_segs:
+				segment_id_to_sent_items.pop(seg.id, None)
+
+		if splices is not None:
+			for seg, removed, before, inserted in splices:
+				if seg not in removed_segs  and  seg not in modified_segs:
+					items = []
+					for child in inserted:
+						self.__resolve_reference(items, child)
+					self.spliced.append([seg.id, [child.id   for child in removed], before.id   if before is not None   else None, u''.join(items)])
+					if segment_id_to_sent_items is not None:
+						segment_id_to_sent_items.pop(seg.id, None)
+
 		for seg in modified_segs:
-			html = seg._inline_html(self.__resolve_reference)
-			self.modified.append((seg.id, html))
+			if segment_id_to_sent_items is not None:
+				items = []
+				seg._build_inline_html(items, self.__resolve_reference)
+				self.modified.append((seg.id, html_diff.encode_segment_items(segment_id_to_sent_items.get(seg.id), items)))
+				segment_id_to_sent_items[seg.id] = items
+			else:
+				html = seg._inline_html(self.__resolve_reference)
+				self.modified.append((seg.id, html))
 			initialise_scripts = seg.get_initialise_scripts()
 			if initialise_scripts is not None:
 				self.initialise_scripts.append((seg.id, initialise_scripts))
@@ -967,8 +1142,8 @@ class _ChangeSet (object):
 
 
 	def print_contents(self):
-		print 'CHANGES TO SEND: {0} removed, {1} modified, {2} popups, {3} popup scripts, {4} initialise scripts, {5} shutdown scripts'.format(len(self.removed), len(self.modified), len(self.popups),
-																		       len(self.popup_scripts), len(self.initialise_scripts), len(self.shutdown_scripts))
+		print 'CHANGES TO SEND: {0} removed, {1} modified, {6} spliced, {2} popups, {3} popup scripts, {4} initialise scripts, {5} shutdown scripts'.format(len(self.removed), len(self.modified), len(self.popups),
+																		       len(self.popup_scripts), len(self.initialise_scripts), len(self.shutdown_scripts), len(self.spliced))
 
 
 
@@ -976,7 +1151,7 @@ class _ChangeSet (object):
 	def json(self):
 		"""Generates a JSON object describing the changes
 		"""
-		return {'removed': self.removed, 'modified': self.modified, 'popups': self.popups, 'popup_scripts': self.popup_scripts, 'initialise_scripts': self.initialise_scripts, 'shutdown_scripts': self.shutdown_scripts}
+		return {'removed': self.removed, 'modified': self.modified, 'spliced': self.spliced, 'popups': self.popups, 'popup_scripts': self.popup_scripts, 'initialise_scripts': self.initialise_scripts, 'shutdown_scripts': self.shutdown_scripts}
 
 
 	def __resolve_reference(self, items, seg):
@@ -1007,6 +1182,12 @@ class _SegmentTable (object):
 		self.__changes_removed = set()
 		self.__changes_modified = set()
 		self.__changes_popups = {}		# Dictionary used as a sort of set: maps popup segment to the initialisation JS source
+		self.__changes_spliced = []
+		# Maps new segments that were inserted by splicing to the segment into which they were inserted
+		self.__spliced_new_segment_to_parent = {}
+
+		# HTML diffing; maps segment ID to the HTML source items last sent to the client
+		self.__segment_id_to_sent_items = None
 
 
 
@@ -1029,10 +1210,27 @@ class _SegmentTable (object):
 		self.__changes_removed = set()
 		self.__changes_modified = set()
 		self.__changes_popups = {}
+		self.__changes_spliced = []
+		self.__spliced_new_segment_to_parent = {}
 
 
 	def _get_recent_changes(self, segment_id_to_queued_scripts):
-		return _ChangeSet(copy(self.__changes_added), copy(self.__changes_removed), copy(self.__changes_modified), copy(self.__changes_popups), segment_id_to_queued_scripts)
+		return _ChangeSet(copy(self.__changes_added), copy(self.__changes_removed), copy(self.__changes_modified), copy(self.__changes_popups), segment_id_to_queued_scripts,
+				  self.__segment_id_to_sent_items, list(self.__changes_spliced))
+
+
+	@property
+	def _html_diffing(self):
+		return self.__segment_id_to_sent_items is not None
+
+	@_html_diffing.setter
+	def _html_diffing(self, value):
+		if value != self._html_diffing:
+			self.__segment_id_to_sent_items = {}   if value   else None
+
+	def _clear_sent_items(self):
+		if self.__segment_id_to_sent_items is not None:
+			self.__segment_id_to_sent_items = {}
 
 
 	def _get_all_initialisers(self):
@@ -1064,6 +1262,11 @@ class _SegmentTable (object):
 
 		if segment in self.__changes_added:
 			self.__changes_added.remove(segment)
+			# A segment that was inserted by a splice has been removed before the client received it; splices that refer to
+			# it cannot be sent, so send the complete content of the segment that it was inserted into instead
+			parent = self.__spliced_new_segment_to_parent.pop(segment, None)
+			if parent is not None  and  parent.id in self.__id_to_segment:
+				self.__changes_modified.add(parent)
 		else:
 			self.__changes_removed.add(segment)
 
@@ -1077,6 +1280,16 @@ class _SegmentTable (object):
 		self.__page._notify_page_modified()
 
 
+	def _segment_spliced(self, segment, removed, before, inserted):
+		if segment not in self.__changes_added:
+			self.__changes_spliced.append((segment, removed, before, inserted))
+			for seg in inserted:
+				if seg in self.__changes_added:
+					self.__spliced_new_segment_to_parent[seg] = segment
+
+		self.__page._notify_page_modified()
+
+
 	def _add_popup_segment(self, segment, initialisation_js_src):
 		self.__changes_popups[segment] = initialisation_js_src
 
@@ -1135,12 +1348,82 @@ class DynamicPageResourceInstance (object):
 	def get_data(self):
 		return self.__resource.get_data()
 
+	def get_stream(self):
+		return self.__resource.get_stream()
+
 	def get_mime_type(self):
 		return self.__resource.get_mime_type()
 
+	def get_version(self):
+		return self.__resource.get_version()
+
+	@property
+	def resource(self):
+		return self.__resource
+
+	@property
+	def is_immutable(self):
+		return self.__resource.is_immutable
+
 
 	@property
 	def resource_url(self):
 		if not self.__resource.requires_url:
 			raise RuntimeError, 'Attempting to acquire a URL for a resource that does not support URL based access'
 		return '/rsc/{0}/{1}/{2}'.format(self.__page._doc_url, self.__page._view_id, self.__rsc_id)
+
+	@property
+	def versioned_resource_url(self):
+		"""
+		The resource URL with the version of the resource embedded as the v query parameter, so that a URL refers to a
+		particular version of the data and can be cached by the client
+		"""
+		url = self.resource_url
+		version = self.__resource.get_version()
+		if version is not None:
+			url = '{0}?v={1}'.format(url, urllib.quote(version, safe=''))
+		return url
+
+
+
+
+
+class Test_DynamicPage (unittest.TestCase):
+	def test_immutable_resource_during_slow_event(self):
+		from larch.live import LiveValue
+		from larch.core.incremental_view import IncrementalView
+		from larch.core.subject import Subject
+		from larch.pres.resource import ConstResource
+		from larch.core.dynamicpage.service import DynamicPageService
+		service = DynamicPageService()
+		view = service.new_view(None)
+		page = view.dynamic_page
+		view.view_data = IncrementalView(Subject(LiveValue(0)), page)
+		page.initial_content()
+		page.synchronize()
+		view_id = page._view_id
+		rsc = DynamicPageResourceInstance(page, 'r1', ConstResource('abc', 'text/plain'))
+		page._allocate_resource_url(rsc)
+
+		release = threading.Event()
+		started = threading.Event()
+		released = []
+
+		def on_slow(event):
+			started.set()
+			released.append(release.wait(5.0))
+			return True
+
+		page.add_page_event_handler('go', on_slow)
+		event_data = json.dumps({'id': 0, 'messages': [{'segment_id': None, 'event_name': 'go', 'ev_data': None}]})
+		thread = threading.Thread(target=lambda: service.event(view_id, event_data))
+		thread.start()
+		try:
+			self.assertTrue(started.wait(5.0))
+			# The page lock is held by the event handler
+			self.assertEqual(('abc', 'text/plain'), service.resource(view_id, 'r1'))
+		finally:
+			release.set()
+			thread.join(5.0)
+		# The resource was retrieved before the handler gave up waiting
+		self.assertEqual([True], released)
@@ -0,0 +1,148 @@
+##-*************************
+##-* This program is free software; you can use it, redistribute it and/or
+##-* modify it under the terms of the GNU Affero General Public License
+##-* version 3 as published by the Free Software Foundation. The full text of
+##-* the GNU Affero General Public License version 3 can be found in the file
+##-* named 'LICENSE.txt' that accompanies this program. This source code is
+##-* (C)copyright Geoffrey French 2011-2014.
+##-*************************
+"""
+Streamed URL resource data
+
+A ResourceStream delivers the data of a URL resource as a sequence of chunks, so that large resources need not be
+held in memory in their entirety. A web app should send the content length as the Content-Length header when it is
+known and use chunked transfer encoding otherwise, writing each chunk as it is produced.
+"""
+import unittest
+
+
+
+class ResourceStream (object):
+	def __init__(self, chunks, content_length=None, close_fn=None):
+		"""
+		Constructor
+
+		:param chunks: an iterable of strings or memoryviews; the data
+		:param content_length: [optional] the total length of the data in bytes, or None if it is not known in advance
+		:param close_fn: [optional] a function of the form function() that releases the resources used to produce the chunks (e.g. closes a file)
+		"""
+		self.__chunks = chunks
+		self.__content_length = content_length
+		self.__close_fn = close_fn
+		self.__closed = False
+
+
+	@staticmethod
+	def from_data(data):
+		"""
+		Create a stream that consists of a single chunk
+
+		:param data: the data as a string
+		"""
+		return ResourceStream([data], len(data))
+
+
+	@property
+	def content_length(self):
+		return self.__content_length
+
+
+	def __iter__(self):
+		# The stream is closed when iteration finishes or is abandoned
+		try:
+			for chunk in self.__chunks:
+				yield chunk
+		finally:
+			self.close()
+
+
+	def read(self):
+		"""
+		Read the remainder of the stream and close it
+
+		:return: the data as a string
+		"""
+		return ''.join([chunk.tobytes()   if isinstance(chunk, memoryview)   else chunk   for chunk in self])
+
+
+	def close(self):
+		if not self.__closed:
+			self.__closed = True
+			close = getattr(self.__chunks, 'close', None)
+			if close is not None:
+				close()
+			if self.__close_fn is not None:
+				self.__close_fn()
+
+
+
+
+
+class Test_ResourceStream (unittest.TestCase):
+	def test_from_data(self):
+		s = ResourceStream.from_data('abc')
+		self.assertEqual(3, s.content_length)
+		self.assertEqual(['abc'], list(s))
+
+
+	def test_close(self):
+		closed = []
+		def chunks():
+			for i in xrange(10):
+				yield str(i)
+
+		s = ResourceStream(chunks(), close_fn=lambda: closed.append(True))
+		self.assertEqual(None, s.content_length)
+		self.assertEqual('0123456789', s.read())
+		self.assertEqual([True], closed)
+
+		# Abandoning iteration part way through closes the stream
+		s = ResourceStream(chunks(), close_fn=lambda: closed.append(True))
+		it = iter(s)
+		self.assertEqual('0', next(it))
+		it.close()
+		self.assertEqual([True, True], closed)
+		s.close()
+		self.assertEqual([True, True], closed)
+
+
+	def test_page_stream(self):
+		import os, tempfile
+		from larch.pres.resource import StreamingFnResource, FileResource
+		from larch.core.dynamicpage.page import DynamicPage, DynamicPageResourceInstance
+		page = DynamicPage(None, 'x')
+		lock = page._DynamicPage__lock
+		readers = []
+
+		def chunks():
+			readers.append(lock._ReadWriteLock__readers)
+			for i in xrange(3):
+				yield 'row{0}\n'.format(i)
+
+		rsc = DynamicPageResourceInstance(page, 'r1', StreamingFnResource(chunks, 'text/csv'))
+		page._allocate_resource_url(rsc)
+		s, mime_type = page.get_url_resource_data('r1', stream=True)
+		self.assertEqual('text/csv', mime_type)
+		self.assertEqual(None, s.content_length)
+		self.assertEqual('row0\nrow1\nrow2\n', s.read())
+		# The chunks were produced after the page lock had been released
+		self.assertEqual([0], readers)
+		self.assertEqual(('row0\nrow1\nrow2\n', 'text/csv'), page.get_url_resource_data('r1'))
+
+		fd, path = tempfile.mkstemp(suffix='.txt')
+		try:
+			data = ''.join([chr(i % 256)   for i in xrange(10000)])
+			os.write(fd, data)
+			os.close(fd)
+			for use_mmap in [False, True]:
+				rsc = DynamicPageResourceInstance(page, 'f', FileResource(path, chunk_size=4096, use_mmap=use_mmap))
+				page._allocate_resource_url(rsc)
+				s, mime_type = page.get_url_resource_data('f', stream=True)
+				self.assertEqual('text/plain', mime_type)
+				self.assertEqual(10000, s.content_length)
+				chunks = list(s)
+				self.assertEqual([4096, 4096, 1808], [len(c)   for c in chunks])
+				self.assertEqual(data, ''.join(chunks))
+				page._deallocate_resource_url(rsc)
+		finally:
+			os.remove(path)
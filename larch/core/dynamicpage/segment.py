@@ -19,6 +19,12 @@ class DynamicSegment (object):
 	Represents a segment of HTML content. Its contents is stored in an HtmlContent object.
 
 	Segments can be nested via references; create a reference using the reference() method and put it into the content of a parent segment to nest this within a parent segment.
+
+	The rendered HTML is cached. Each segment caches its own HTML as a list of chunks; strings, with the child segments that
+	are referenced between them, so that the complete HTML of a segment subtree can be built by concatenating the cached
+	chunks of the segments within it. The complete HTML is cached by the segments for which it is requested; e.g. the root
+	segment and popups. Setting the content of a segment invalidates its own chunks and the complete HTML cached by it and
+	its ancestors.
 	"""
 	def __init__(self, page, seg_id, content=None, fragment=None):
 		"""
@@ -48,6 +54,8 @@ class DynamicSegment (object):
 				self.__page._notify_segment_html_structure_validity_change(self, False)
 
 		self.__content = content
+		self.__html_chunks = None
+		self.__complete_html = None
 		self.__connect_children()
 
 
@@ -108,6 +116,7 @@ class DynamicSegment (object):
 				self.__page._notify_segment_html_structure_fixes(self, fixes)
 
 		self.__disconnect_children()
+		self.__invalidate_html_cache()
 		self.__content = x
 		if valid != self.__structure_valid:
 			self.__structure_valid = valid
@@ -122,6 +131,32 @@ class DynamicSegment (object):
 		return SegmentRef(self)
 
 
+	def splice_children(self, index, n_removed, segments):
+		"""
+		Replace a range of the child segments referenced by this segment. The client is sent the segments that were removed
+		and the inserted segments, rather than the complete content of this segment.
+
+		The content of this segment must consist solely of references to child segments.
+
+		:param index: the index of the first reference to replace
+		:param n_removed: the number of references to remove
+		:param segments: the segments to insert in their place
+		:return: None
+		"""
+		content = self.__content
+		removed = [ref.segment   for ref in content[index:index+n_removed]]
+		for seg in removed:
+			seg.__parent = None
+		content[index:index+n_removed] = [seg.reference()   for seg in segments]
+		for seg in segments:
+			seg.__parent = self
+		self.__invalidate_html_cache()
+
+		end = index + len(segments)
+		before = content[end].segment   if end < len(content)   else None
+		self.__page._table._segment_spliced(self, removed, before, segments)
+
+
 
 	# Event handling
 	def add_event_handler(self, handler):
@@ -205,6 +240,58 @@ class DynamicSegment (object):
 		items.append('<span class="__lch_seg_end" data-larchsegid="{0}"></span>'.format(self.__id))
 
 
+	def _complete_html(self):
+		"""Get the HTML source of the complete segment subtree rooted at this segment, with all references inlined.
+
+		The result is cached until the content of this segment or one of its descendants is modified.
+		"""
+		if self.__complete_html is None:
+			items = []
+			self.__build_complete_html(items)
+			self.__complete_html = ''.join(items)
+		return self.__complete_html
+
+
+	def __build_complete_html(self, items):
+		for chunk in self.__get_html_chunks():
+			if isinstance(chunk, basestring):
+				items.append(chunk)
+			elif chunk.__complete_html is not None:
+				items.append(chunk.__complete_html)
+			else:
+				chunk.__build_complete_html(items)
+
+
+	def __get_html_chunks(self):
+		if self.__html_chunks is None:
+			items = []
+			self._build_inline_html(items, lambda items, seg: items.append(seg))
+
+			# Join runs of strings
+			chunks = []
+			run = []
+			for x in items:
+				if isinstance(x, basestring):
+					run.append(x)
+				else:
+					if len(run) > 0:
+						chunks.append(''.join(run))
+						run = []
+					chunks.append(x)
+			if len(run) > 0:
+				chunks.append(''.join(run))
+			self.__html_chunks = chunks
+		return self.__html_chunks
+
+
+	def __invalidate_html_cache(self):
+		self.__html_chunks = None
+		seg = self
+		while seg is not None:
+			seg.__complete_html = None
+			seg = seg.__parent
+
+
 
 	def __connect_children(self):
 		if self.__content is not None:
@@ -279,13 +366,7 @@ class SegmentRef (object):
 
 		All references are inlined.
 		"""
-		items = []
-		self._build_html(items, self.__resolve_complete)
-		return ''.join(items)
-
-
-	def __resolve_complete(self, items, seg):
-		return seg._build_inline_html(items, self.__resolve_complete)
+		return self.__segment._complete_html()
 
 
 
@@ -523,4 +604,65 @@ class Test_FixHtmlContent (unittest.TestCase):
 		c = HtmlContent(['<div>', 'Test',])
 		f, fixes = c._fix_structure()
 		self.assertEqual(fixes, [_CloseUnclosedTagFix('div')])
-		self.assertEqual(f, HtmlContent(['<div>', 'Test', '</div>']))
\ No newline at end of file
+		self.assertEqual(f, HtmlContent(['<div>', 'Test', '</div>']))
+
+
+class Test_DynamicSegment (unittest.TestCase):
+	class _Table (object):
+		def __init__(self):
+			self.splices = []
+
+		def _segment_modified(self, segment, content):
+			pass
+
+		def _segment_spliced(self, segment, removed, before, inserted):
+			self.splices.append((segment.id, [seg.id   for seg in removed], before.id   if before is not None   else None, [seg.id   for seg in inserted]))
+
+	class _Page (object):
+		def __init__(self):
+			self._enable_structure_fixing = False
+			self._table = Test_DynamicSegment._Table()
+
+
+	@staticmethod
+	def _html(seg_id, *contents):
+		return '<span class="__lch_seg_begin" data-larchsegid="{0}"></span>'.format(seg_id) + ''.join(contents) + \
+		       '<span class="__lch_seg_end" data-larchsegid="{0}"></span>'.format(seg_id)
+
+
+	def test_complete_html_cache(self):
+		page = self._Page()
+		c = DynamicSegment(page, 'c', HtmlContent(['<b>', 'x', '</b>']))
+		b = DynamicSegment(page, 'b', HtmlContent(['<i>', c.reference(), '</i>']))
+		a = DynamicSegment(page, 'a', HtmlContent(['<p>', b.reference(), '</p>', 'tail']))
+
+		self.assertEqual(self._html('a', '<p>', self._html('b', '<i>', self._html('c', '<b>x</b>'), '</i>'), '</p>tail'), a.reference()._complete_html())
+		self.assertIs(a._complete_html(), a._complete_html())
+
+		# Modifying a descendant invalidates the cached HTML of its ancestors
+		c.content = HtmlContent(['y'])
+		self.assertEqual(self._html('a', '<p>', self._html('b', '<i>', self._html('c', 'y'), '</i>'), '</p>tail'), a._complete_html())
+
+		# The complete HTML cached by a child is re-used
+		self.assertEqual(self._html('b', '<i>', self._html('c', 'y'), '</i>'), b._complete_html())
+		a.content = HtmlContent([b.reference()])
+		self.assertEqual(self._html('a', self._html('b', '<i>', self._html('c', 'y'), '</i>')), a._complete_html())
+		c.content = None
+		self.assertEqual(self._html('a', self._html('b', '<i>', self._html('c'), '</i>')), a._complete_html())
+		self.assertEqual(self._html('b', '<i>', self._html('c'), '</i>'), b._complete_html())
+
+
+	def test_splice_children(self):
+		page = self._Page()
+		x = DynamicSegment(page, 'x', HtmlContent(['x']))
+		y = DynamicSegment(page, 'y', HtmlContent(['y']))
+		z = DynamicSegment(page, 'z', HtmlContent(['z']))
+		ls = DynamicSegment(page, 'ls', HtmlContent([x.reference()]))
+		self.assertEqual(self._html('ls', self._html('x', 'x')), ls._complete_html())
+
+		ls.splice_children(1, 0, [y, z])
+		ls.splice_children(0, 1, [])
+		self.assertEqual([('ls', [], None, ['y', 'z']), ('ls', ['x'], 'y', [])], page._table.splices)
+		self.assertIsNone(x.parent)
+		self.assertIs(ls, z.parent)
+		self.assertEqual(self._html('ls', self._html('y', 'y'), self._html('z', 'z')), ls._complete_html())
@@ -0,0 +1,382 @@
+##-*************************
+##-* This program is free software; you can use it, redistribute it and/or
+##-* modify it under the terms of the GNU Affero General Public License
+##-* version 3 as published by the Free Software Foundation. The full text of
+##-* the GNU Affero General Public License version 3 can be found in the file
+##-* named 'LICENSE.txt' that accompanies this program. This source code is
+##-* (C)copyright Geoffrey French 2011-2014.
+##-*************************
+"""
+Cache of serialized URL resource data
+
+The data of a versioned URL resource (see URLResource.get_version) is cached by resource and version, so that when
+several clients - e.g. a number of viewers of a live chart - request a resource after it has changed, the data is
+computed once rather than once per request. Concurrent requests for the same version wait for the first to compute
+it. The gzip compressed form of the data is computed at most once per version too.
+
+The cache is shared by all resources and is bounded in size; when it grows beyond its budget, the data of the least
+recently used resources is discarded. Only the most recent version of each resource is kept.
+
+Data that is served without copying it - a memoryview, e.g. the buffer of a NumpyArrayResource - is not cached, as the
+buffer is already held by its resource; it does not count towards the size of the cache. Its gzip compressed form is
+cached, however.
+"""
+import threading
+import weakref
+import collections
+import zlib
+import unittest
+
+
+
+class _Entry (object):
+	def __init__(self, version, resource_ref):
+		self.version = version
+		self.resource_ref = resource_ref
+		# Held while computing the data, so that it is computed only once
+		self.lock = threading.Lock()
+		self.data = None
+		self.gzip_data = None
+		self.size = 0
+
+
+
+class SerializationCache (object):
+	def __init__(self, max_bytes=64*1024*1024):
+		"""
+		Constructor
+
+		:param max_bytes: [optional] the maximum total size of the cached data in bytes
+		"""
+		self.__max_bytes = max_bytes
+		self.__lock = threading.Lock()
+		# Maps the ID of a resource to its entry, least recently used first
+		self.__entries = collections.OrderedDict()
+		self.__size = 0
+
+		self.__hits = 0
+		self.__misses = 0
+		self.__evictions = 0
+
+
+	@property
+	def max_bytes(self):
+		return self.__max_bytes
+
+	@max_bytes.setter
+	def max_bytes(self, max_bytes):
+		with self.__lock:
+			self.__max_bytes = max_bytes
+			self.__evict()
+
+
+	def get(self, resource, version, data_fn):
+		"""
+		Get the data of a resource
+
+		:param resource: the resource
+		:param version: the version of the data
+		:param data_fn: a function of the form function() that computes the data as a string or a memoryview; invoked if the data of this version is not cached
+		:return: the data
+		"""
+		entry = self.__entry(resource, version)
+		with entry.lock:
+			return self.__data(resource, entry, data_fn)
+
+
+	def get_gzip(self, resource, version, data_fn):
+		"""
+		Get the data of a resource, gzip compressed
+
+		:param resource: the resource
+		:param version: the version of the data
+		:param data_fn: a function of the form function() that computes the (uncompressed) data as a string or a memoryview; invoked if the data of this version is not cached
+		:return: the compressed data
+		"""
+		entry = self.__entry(resource, version)
+		with entry.lock:
+			if entry.gzip_data is None:
+				data = self.__data(resource, entry, data_fn)
+				entry.gzip_data = gzip_compress(data)
+				self.__account(resource, entry, len(entry.gzip_data))
+			return entry.gzip_data
+
+
+	def discard(self, resource):
+		"""
+		Discard the cached data of a resource
+		"""
+		with self.__lock:
+			self.__remove(id(resource))
+
+
+	def clear(self):
+		with self.__lock:
+			self.__entries.clear()
+			self.__size = 0
+
+
+	def metrics(self):
+		"""
+		Get statistics
+
+		:return: a dictionary with the keys:
+			'entries' - the number of resources whose data is cached
+			'bytes' - the total size of the cached data
+			'hits' - the number of requests for data that was cached
+			'misses' - the number of requests for data that had to be computed
+			'evictions' - the number of entries discarded to stay within the maximum size
+		"""
+		with self.__lock:
+			return {'entries': len(self.__entries),
+				'bytes': self.__size,
+				'hits': self.__hits,
+				'misses': self.__misses,
+				'evictions': self.__evictions}
+
+
+
+	def __entry(self, resource, version):
+		key = id(resource)
+		with self.__lock:
+			entry = self.__entries.pop(key, None)
+			if entry is not None  and  (entry.resource_ref() is not resource  or  entry.version != version):
+				# Out of date, or the resource was garbage collected and its ID reused
+				self.__size -= entry.size
+				entry = None
+			if entry is None:
+				# Discard the entry when the resource is garbage collected
+				resource_ref = weakref.ref(resource, lambda r: self.__on_resource_collected(key, r))
+				entry = _Entry(version, resource_ref)
+			# Move to the end; the most recently used
+			self.__entries[key] = entry
+			return entry
+
+
+	def __data(self, resource, entry, data_fn):
+		# Called with the entry lock held
+		if entry.data is None:
+			data = data_fn()
+			with self.__lock:
+				self.__misses += 1
+			if isinstance(data, memoryview):
+				# Served without copying; do not retain it
+				return data
+			entry.data = data
+			self.__account(resource, entry, len(data))
+		else:
+			with self.__lock:
+				self.__hits += 1
+		return entry.data
+
+
+	def __account(self, resource, entry, size):
+		with self.__lock:
+			entry.size += size
+			# The entry may have been evicted or replaced while its data was computed
+			if self.__entries.get(id(resource)) is entry:
+				self.__size += size
+				self.__evict()
+
+
+	def __evict(self):
+		# Called with the lock held
+		while self.__size > self.__max_bytes  and  len(self.__entries) > 0:
+			key = next(iter(self.__entries))
+			self.__remove(key)
+			self.__evictions += 1
+
+
+	def __remove(self, key):
+		# Called with the lock held
+		entry = self.__entries.pop(key, None)
+		if entry is not None:
+			self.__size -= entry.size
+
+
+	def __on_resource_collected(self, key, resource_ref):
+		with self.__lock:
+			entry = self.__entries.get(key)
+			if entry is not None  and  entry.resource_ref is resource_ref:
+				self.__remove(key)
+
+
+
+
+_COMPRESSIBLE_MIME_TYPES = {'application/json', 'application/javascript', 'application/xml', 'image/svg+xml'}
+
+def is_compressible(mime_type):
+	"""
+	Determine if data of the given MIME type benefits from compression
+	"""
+	if mime_type is None:
+		return False
+	mime_type = mime_type.split(';')[0].strip()
+	return mime_type.startswith('text/')  or  mime_type in _COMPRESSIBLE_MIME_TYPES
+
+
+def gzip_compress(data):
+	"""
+	Compress data in the gzip format, for use with the gzip content encoding
+
+	:param data: the data as a string or a memoryview; unicode strings are encoded as UTF-8
+	:return: the compressed data
+	"""
+	if isinstance(data, unicode):
+		data = data.encode('utf-8')
+	elif isinstance(data, memoryview):
+		data = data.tobytes()
+	# A window size of 16 + MAX_WBITS selects a gzip header and trailer
+	compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+	return compressor.compress(data) + compressor.flush()
+
+
+shared_cache = SerializationCache()
+
+
+
+
+
+class Test_SerializationCache (unittest.TestCase):
+	class _Resource (object):
+		pass
+
+
+	def test_get(self):
+		cache = SerializationCache()
+		rsc = self._Resource()
+		calls = []
+		def data_fn():
+			calls.append(True)
+			return 'abc' * 100
+
+		self.assertEqual('abc' * 100, cache.get(rsc, '1', data_fn))
+		self.assertEqual('abc' * 100, cache.get(rsc, '1', data_fn))
+		self.assertEqual(1, len(calls))
+		gz = cache.get_gzip(rsc, '1', data_fn)
+		self.assertEqual('abc' * 100, zlib.decompress(gz, 16 + zlib.MAX_WBITS))
+		self.assertEqual(1, len(calls))
+		self.assertEqual(300 + len(gz), cache.metrics()['bytes'])
+
+		# A new version replaces the old one
+		cache.get(rsc, '2', data_fn)
+		self.assertEqual(2, len(calls))
+		self.assertEqual({'entries': 1, 'bytes': 300, 'hits': 2, 'misses': 2, 'evictions': 0}, cache.metrics())
+
+		# The entry is discarded when the resource is garbage collected
+		del rsc
+		self.assertEqual(0, cache.metrics()['entries'])
+		self.assertEqual(0, cache.metrics()['bytes'])
+
+
+	def test_lru(self):
+		cache = SerializationCache(max_bytes=250)
+		resources = [self._Resource()   for i in xrange(4)]
+		for r in resources[:2]:
+			cache.get(r, '1', lambda: 'x' * 100)
+		# Use the first, so that the second is the least recently used
+		cache.get(resources[0], '1', lambda: self.fail())
+		cache.get(resources[2], '1', lambda: 'x' * 100)
+		m = cache.metrics()
+		self.assertEqual((2, 200, 1), (m['entries'], m['bytes'], m['evictions']))
+		cache.get(resources[0], '1', lambda: self.fail())
+		calls = []
+		cache.get(resources[1], '1', lambda: calls.append(True) or 'x' * 100)
+		self.assertEqual(1, len(calls))
+
+		# Data that exceeds the budget is not retained
+		cache.get(resources[3], '1', lambda: 'x' * 1000)
+		self.assertEqual(0, cache.metrics()['bytes'])
+
+
+	def test_memoryview(self):
+		cache = SerializationCache(max_bytes=250)
+		rsc = self._Resource()
+		buf = memoryview('x' * 1000)
+		calls = []
+		def data_fn():
+			calls.append(True)
+			return buf
+
+		# The buffer is returned as is, and is neither retained nor counted
+		self.assertTrue(cache.get(rsc, '1', data_fn) is buf)
+		self.assertTrue(cache.get(rsc, '1', data_fn) is buf)
+		self.assertEqual(2, len(calls))
+		self.assertEqual(0, cache.metrics()['bytes'])
+		self.assertEqual(0, cache.metrics()['evictions'])
+
+		# Its compressed form is a copy, so it is cached
+		gz = cache.get_gzip(rsc, '1', data_fn)
+		self.assertEqual('x' * 1000, zlib.decompress(gz, 16 + zlib.MAX_WBITS))
+		cache.get_gzip(rsc, '1', data_fn)
+		self.assertEqual(3, len(calls))
+		self.assertEqual(len(gz), cache.metrics()['bytes'])
+
+
+	def test_concurrent(self):
+		cache = SerializationCache()
+		rsc = self._Resource()
+		calls = []
+		started = threading.Event()
+		release = threading.Event()
+		def data_fn():
+			calls.append(True)
+			started.set()
+			release.wait(5.0)
+			return 'abc'
+
+		results = []
+		threads = [threading.Thread(target=lambda: results.append(cache.get(rsc, '1', data_fn)))   for i in xrange(4)]
+		threads[0].start()
+		started.wait(5.0)
+		for t in threads[1:]:
+			t.start()
+		release.set()
+		for t in threads:
+			t.join(5.0)
+		self.assertEqual(['abc'] * 4, results)
+		self.assertEqual(1, len(calls))
+
+
+	def test_shared_serialization(self):
+		import json
+		from larch.live import LiveValue
+		from larch.core.incremental_view import IncrementalView
+		from larch.core.subject import Subject
+		from larch.pres.resource import JsonLiveFnResource
+		from larch.core.dynamicpage.page import DynamicPageResourceInstance
+		from larch.core.dynamicpage.service import DynamicPageService
+		service = DynamicPageService()
+		live = LiveValue(0)
+		calls = []
+		def data_fn():
+			calls.append(True)
+			return {'values': range(live.value, 100)}
+		rsc = JsonLiveFnResource(data_fn)
+		view_ids = []
+		for i in xrange(2):
+			view = service.new_view(None)
+			page = view.dynamic_page
+			view.view_data = IncrementalView(Subject(live), page)
+			page.initial_content()
+			page.synchronize()
+			DynamicPageResourceInstance(page, 'j', rsc).ref(None)
+			view_ids.append(page._view_id)
+		id_a, id_b = view_ids
+
+		# Both views are served from a single serialization, which is compressed once
+		responses = [service.resource_response(view_id, 'j', accept_encoding='gzip, deflate')   for view_id in view_ids]
+		self.assertEqual(1, len(calls))
+		self.assertTrue(responses[0].data is responses[1].data)
+		headers = dict(responses[0].headers)
+		self.assertEqual('gzip', headers['Content-Encoding'])
+		self.assertEqual({'values': range(100)}, json.loads(zlib.decompress(responses[0].data, 16 + zlib.MAX_WBITS)))
+		r = service.resource_response(id_a, 'j', if_none_match=headers['ETag'], accept_encoding='gzip')
+		self.assertEqual(304, r.status)
+
+		live.value = 50
+		r = service.resource_response(id_b, 'j')
+		self.assertEqual({'values': range(50, 100)}, json.loads(r.data))
+		self.assertEqual(None, dict(r.headers).get('Content-Encoding'))
+		service.resource_response(id_a, 'j')
+		self.assertEqual(2, len(calls))
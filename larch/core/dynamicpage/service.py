@@ -9,9 +9,12 @@
 import json
 import traceback
 import sys
+import threading
+import unittest
 
-from larch.core.dynamicpage.page import DynamicPage, EventHandleError
+from larch.core.dynamicpage.page import DynamicPage, EventHandleError, etag_for_version
 from larch.core.dynamicpage import messages
+from larch.core.dynamicpage.view_registry import ViewRegistry
 from larch.inspector import present_exception
 
 
@@ -29,6 +32,24 @@ class UploadedFile (object):
 
 
 
+class ResourceResponse (object):
+	"""
+	A response to a resource request
+
+	Attributes:
+		:var status: the HTTP status code; 200, or 304 (not modified) when the client's copy of the data is up to date
+		:var data: the data; a string, a memoryview (e.g. the buffer of a NumPy array) or a ResourceStream, or None if the status is 304
+		:var mime_type: the MIME type
+		:var headers: a list of (name, value) pairs; the ETag, Cache-Control and content encoding headers
+	"""
+	def __init__(self, status, data, mime_type, headers):
+		self.status = status
+		self.data = data
+		self.mime_type = mime_type
+		self.headers = headers
+
+
+
 class DynamicPageService (object):
 	"""
 	Abstract dynamic page web service API
@@ -55,13 +76,18 @@ class DynamicPageService (object):
 
 
 
-	def __init__(self):
+	def __init__(self, max_views=None, view_ttl=None, num_view_shards=16):
 		"""
 		Constructor
 
+		:param max_views: [optional] the maximum number of views; the least recently used views are discarded when it is exceeded. Unlimited if None.
+		:param view_ttl: [optional] the time in seconds after its last event or resource request at which a view is discarded. Views are not discarded due to age if None.
+		:param num_view_shards: [optional] the number of shards - each with its own lock - over which the views are distributed
 		:return: DynamicPageService instance
 		"""
-		self.__views = {}
+		self.__views = ViewRegistry(num_shards=num_view_shards, max_views=max_views, ttl=view_ttl,
+					    on_evict=self.__on_view_evicted)
+		self.__view_counter_lock = threading.Lock()
 		self.__view_counter = 1
 		self.__users = {}
 
@@ -92,12 +118,13 @@ class DynamicPageService (object):
 		"""
 		view_id = self.__new_view_id()
 		view = self.View()
-		self.__views[view_id] = view
 
 		dynamic_page = DynamicPage(self, view_id)
 		view.dynamic_page = dynamic_page
 		view.subject = subject
 
+		self.__views.add(view_id, view)
+
 		return view
 
 
@@ -113,9 +140,8 @@ class DynamicPageService (object):
 		"""
 
 		# Get the page for the given view
-		try:
-			view = self.__views[view_id]
-		except KeyError:
+		view = self.__views.get(view_id)
+		if view is None:
 			msg = messages.invalid_page_message()
 			client_messages = [msg]
 			result = json.dumps(client_messages)
@@ -128,7 +154,7 @@ class DynamicPageService (object):
 		block_json = json.loads(event_data)
 		events_json = block_json['messages']
 
-		return self.__handle_events(dynamic_page, events_json)
+		return json.dumps(self._handle_events(dynamic_page, events_json))
 
 
 
@@ -142,9 +168,8 @@ class DynamicPageService (object):
 		"""
 
 		# Get the page for the given view
-		try:
-			view = self.__views[view_id]
-		except KeyError:
+		view = self.__views.get(view_id)
+		if view is None:
 			msg = messages.invalid_page_message()
 			client_messages = [msg]
 			result = json.dumps(client_messages)
@@ -159,89 +184,196 @@ class DynamicPageService (object):
 		segment_id = ev_data.pop('__larch_segment_id')
 		events_json = [{'segment_id': segment_id, 'event_name': 'form_submit', 'ev_data': ev_data}]
 
-		return self.__handle_events(dynamic_page, events_json)
+		return json.dumps(self._handle_events(dynamic_page, events_json))
 
 
 
-	def __handle_events(self, dynamic_page, events_json):
-		error_messages = []
+	def _handle_events(self, dynamic_page, events_json):
+		"""
+		Handle events and synchronise the page, holding the page lock
 
-		dynamic_page.lock()
+		:param dynamic_page: the page
+		:param events_json: a list of event messages
+		:return: the list of messages to send to the client
+		"""
+		return self._handle_event_blocks(dynamic_page, [events_json])
 
-		# Handle the events
-		for ev_json in events_json:
-			event_handle_result = dynamic_page.handle_event(ev_json['segment_id'], ev_json['event_name'], ev_json['ev_data'])
-			if isinstance(event_handle_result, EventHandleError):
-				msg = event_handle_result.to_message()
-				error_messages.append(msg)
 
+	def _handle_event_blocks(self, dynamic_page, event_blocks_json):
+		"""
+		Handle several blocks of events and synchronise the page once, holding the page lock
 
-		# Synchronise the view
-		try:
-			client_messages = dynamic_page.synchronize()
-		except Exception, e:
-			# Catch internal server error
-			err_html = present_exception.exception_to_html_src(e, sys.exc_info()[1], sys.exc_info()[2])
-			msg = messages.error_during_update_message(err_html)
-			error_messages.append(msg)
-			client_messages = []
+		A malformed block (e.g. an event message with a missing field) is reported to the client as an error; the
+		remaining blocks are still handled.
 
-		# Send messages to the client
-		result = json.dumps(client_messages + error_messages)
+		:param dynamic_page: the page
+		:param event_blocks_json: a list of lists of event messages
+		:return: the list of messages to send to the client
+		"""
+		error_messages = []
 
-		#print 'EVENT {0}: in {1} events, out {2} messages'.format(block_json['id'], len(events_json), len(client_messages))
+		dynamic_page.lock()
+		try:
+			# Handle the events
+			for events_json in event_blocks_json:
+				try:
+					for ev_json in events_json:
+						event_handle_result = dynamic_page.handle_event(ev_json['segment_id'], ev_json['event_name'], ev_json['ev_data'])
+						if isinstance(event_handle_result, EventHandleError):
+							msg = event_handle_result.to_message()
+							error_messages.append(msg)
+				except Exception, e:
+					err_html = present_exception.exception_to_html_src(e, sys.exc_info()[1], sys.exc_info()[2])
+					error_messages.append(messages.error_during_update_message(err_html))
+
+
+			# Synchronise the view
+			try:
+				client_messages, deps = dynamic_page.synchronize()
+			except Exception, e:
+				# Catch internal server error
+				err_html = present_exception.exception_to_html_src(e, sys.exc_info()[1], sys.exc_info()[2])
+				msg = messages.error_during_update_message(err_html)
+				error_messages.append(msg)
+				client_messages = []
+		finally:
+			dynamic_page.unlock()
 
-		dynamic_page.unlock()
+		#print 'EVENT {0}: in {1} events, out {2} messages'.format(block_json['id'], len(events_json), len(client_messages))
 
-		return result
+		return client_messages + error_messages
 
 
 
 
-	def resource(self, view_id, rsc_id):
+	def resource(self, view_id, rsc_id, stream=False):
 		"""
 		Resource acquisition. Map the URL <root_url>/rsc to this. You will need to extract the view_id and rsc_id fields from the GET parameters and pass them through
 
+		Web apps that can send a response incrementally should pass stream=True and write the chunks of the resulting
+		ResourceStream as they are produced, sending its content_length as the Content-Length header if it is not None and
+		using chunked transfer encoding otherwise. The stream must be closed if it is not iterated to the end.
+
 		:param view_id: view_id field from GET parameters
 		:param rsc_id: rsc_id field from GET parameters
-		:return: the data to send to the client and its MIME type in the form of a tuple: (data, mime_type)
+		:param stream: [optional] if True, the data is returned as a ResourceStream rather than a string
+		:return: the data to send to the client and its MIME type in the form of a tuple: (data, mime_type); data is a string, a memoryview (e.g. the buffer of a NumPy array) or a ResourceStream
 		"""
 
 		# Get the page for the given view
-		try:
-			view = self.__views[view_id]
-		except KeyError:
+		view = self.__views.get(view_id)
+		if view is None:
 			return None
 
 		dynamic_page = view.dynamic_page
 
-		dynamic_page.lock()
-
-		# Get the resource
+		# Get the resource; the page acquires its lock for reading
 		try:
-			result = dynamic_page.get_url_resource_data(rsc_id)
+			result = dynamic_page.get_url_resource_data(rsc_id, stream)
 		except Exception:
 			print 'Error while retrieving resource:'
 			traceback.print_exc()
 			return None
-		finally:
-			dynamic_page.unlock()
 
 		return result
 
 
 
+	def resource_response(self, view_id, rsc_id, version=None, if_none_match=None, accept_encoding=None, stream=False):
+		"""
+		Resource acquisition with HTTP caching. Use in place of the resource method in web apps that can set response headers.
+
+		Resources are identified by version (see URLResource.get_version), which is used as their ETag. Conditional
+		requests whose If-None-Match header matches the ETag are answered with a 304 (not modified) status without
+		retrieving the data. Resource URLs embed the version as the v GET parameter; a request for the current version
+		may be cached by the client indefinitely, as the data at that URL never changes.
+
+		Textual data is gzip compressed if the client accepts it; the compressed data of versioned resources is cached.
+
+		:param view_id: view_id field from GET parameters
+		:param rsc_id: rsc_id field from GET parameters
+		:param version: [optional] v field from GET parameters
+		:param if_none_match: [optional] the value of the If-None-Match header
+		:param accept_encoding: [optional] the value of the Accept-Encoding header
+		:param stream: [optional] if True, the data is returned as a ResourceStream rather than a string (see the resource method)
+		:return: a ResourceResponse, or None if there is no such resource
+		"""
+		view = self.__views.get(view_id)
+		if view is None:
+			return None
+
+		accept_gzip = accept_encoding is not None  and  'gzip' in accept_encoding
+		try:
+			result = view.dynamic_page.get_url_resource(rsc_id, stream=stream, if_none_match=if_none_match,
+								    accept_gzip=accept_gzip)
+		except Exception:
+			print 'Error while retrieving resource:'
+			traceback.print_exc()
+			return None
+
+		if result is None:
+			return None
+
+		data, mime_type, etag, content_encoding = result
+		headers = []
+		if content_encoding is not None:
+			headers.append(('Content-Encoding', content_encoding))
+		if accept_gzip  or  content_encoding is not None:
+			headers.append(('Vary', 'Accept-Encoding'))
+		if etag is not None:
+			headers.append(('ETag', etag))
+			if version is not None  and  etag == etag_for_version(version, content_encoding):
+				headers.append(('Cache-Control', 'private, max-age=31536000'))
+			else:
+				# The data at this URL may change; the client must revalidate its copy
+				headers.append(('Cache-Control', 'private, no-cache'))
+		else:
+			headers.append(('Cache-Control', 'no-store'))
+		status = 304   if data is None   else 200
+		return ResourceResponse(status, data, mime_type, headers)
+
+
+
 	def new_uploaded_file(self, upload_name):
 		return UploadedFile(upload_name)
 
 
 
+	def _get_view(self, view_id):
+		"""
+		Get a view
+
+		:param view_id: the view ID
+		:return: the view, or None if there is no view with the given ID
+		"""
+		return self.__views.get(view_id)
+
+
+	def view_metrics(self):
+		"""
+		Get statistics on the views served; see ViewRegistry.metrics
+		"""
+		return self.__views.metrics()
+
+
 	def _close_page(self, page):
-		view_id = page._view_id
-		try:
-			del self.__views[view_id]
-		except KeyError:
-			pass
+		"""
+		Invoked when a page is closed by the client, reloaded, or its view is evicted (see _on_view_evicted).
+		Override to release resources associated with the page, invoking the base class method.
+		"""
+		self.__views.remove(page._view_id)
+
+
+	def _on_view_evicted(self, view_id, view):
+		"""
+		Invoked when a view is discarded as it was idle for too long, or the maximum number of views was exceeded.
+		The page is torn down in the same way as a page closed by the client.
+		"""
+		self._close_page(view.dynamic_page)
+
+
+	def __on_view_evicted(self, view_id, view):
+		self._on_view_evicted(view_id, view)
 
 
 
@@ -261,9 +393,95 @@ class DynamicPageService (object):
 
 
 	def __new_view_id(self):
-		index = self.__view_counter
-		self.__view_counter += 1
+		with self.__view_counter_lock:
+			index = self.__view_counter
+			self.__view_counter += 1
 		salt = self.__rng.randint(0, 1<<31)
 		view_id = 'v{0}{1}'.format(index, salt)
 		return view_id
 
+
+
+
+
+class Test_DynamicPageService (unittest.TestCase):
+	@staticmethod
+	def _new_view(service):
+		from larch.live import LiveValue
+		from larch.core.incremental_view import IncrementalView
+		from larch.core.subject import Subject
+		live = LiveValue(0)
+		view = service.new_view(None)
+		page = view.dynamic_page
+		view.view_data = IncrementalView(Subject(live), page)
+		page.initial_content()
+		page.synchronize()
+		return page, page._view_id, live
+
+
+	@staticmethod
+	def _event_data(event_name, data):
+		return json.dumps({'id': 0, 'messages': [{'segment_id': None, 'event_name': event_name, 'ev_data': data}]})
+
+
+	def test_evicted_view(self):
+		service = DynamicPageService(max_views=1)
+		page_a, id_a, live_a = self._new_view(service)
+		page_b, id_b, live_b = self._new_view(service)
+		self.assertEqual([messages.invalid_page_message()], json.loads(service.event(id_a, self._event_data('go', None))))
+		self.assertEqual('[]', service.event(id_b, self._event_data('go', None)))
+		self.assertEqual(None, service.resource(id_a, 'r1'))
+		self.assertEqual(1, service.view_metrics()['views_evicted_lru'])
+
+
+	def test_evicted_view_is_closed(self):
+		closed = []
+		class _Service (DynamicPageService):
+			def _close_page(self, page):
+				closed.append(page._view_id)
+				super(_Service, self)._close_page(page)
+
+		service = _Service(max_views=1)
+		page_a, id_a, live_a = self._new_view(service)
+		page_b, id_b, live_b = self._new_view(service)
+		self.assertEqual([id_a], closed)
+		# The evicted view was removed by eviction, not by closing it
+		self.assertEqual(0, service.view_metrics()['views_removed'])
+
+
+	def test_conditional_resource(self):
+		from larch.pres.resource import ConstResource, FnResource, LiveFnResource
+		from larch.core.dynamicpage.page import DynamicPageResourceInstance
+		service = DynamicPageService()
+		page, view_id, live = self._new_view(service)
+		const = DynamicPageResourceInstance(page, 'c', ConstResource('abc', 'text/plain'))
+		const.ref(None)
+		fn = DynamicPageResourceInstance(page, 'f', FnResource(lambda: 'xyz', 'text/plain'))
+		fn.ref(None)
+		calls = []
+		def live_fn():
+			calls.append(True)
+			return str(live.value)
+		live_rsc = DynamicPageResourceInstance(page, 'l', LiveFnResource(live_fn, 'text/plain'))
+		live_rsc.ref(None)
+
+		for rsc in [const, fn, live_rsc]:
+			r = service.resource_response(view_id, rsc.id)
+			self.assertEqual(200, r.status)
+			etag = dict(r.headers)['ETag']
+			r = service.resource_response(view_id, rsc.id, if_none_match=etag)
+			self.assertEqual(304, r.status)
+			self.assertEqual(None, r.data)
+		self.assertEqual(1, len(calls))
+
+		# The URL of a versioned resource embeds the version; requests for it may be cached
+		r = service.resource_response(view_id, 'c', version=const.get_version())
+		self.assertEqual(('abc', 'private, max-age=31536000'), (r.data, dict(r.headers)['Cache-Control']))
+
+		# Modifying the live value changes the version of the live resource
+		etag = dict(service.resource_response(view_id, 'l').headers)['ETag']
+		live.value = 1
+		r = service.resource_response(view_id, 'l', if_none_match=etag)
+		self.assertEqual((200, '1'), (r.status, r.data))
+		self.assertNotEqual(etag, dict(r.headers)['ETag'])
+		self.assertEqual(2, len(calls))
@@ -0,0 +1,325 @@
+##-*************************
+##-* This program is free software; you can use it, redistribute it and/or
+##-* modify it under the terms of the GNU Affero General Public License
+##-* version 3 as published by the Free Software Foundation. The full text of
+##-* the GNU Affero General Public License version 3 can be found in the file
+##-* named 'LICENSE.txt' that accompanies this program. This source code is
+##-* (C)copyright Geoffrey French 2011-2014.
+##-*************************
+"""
+Scheduling of synchronisation requests
+
+When tasks are queued on a page from outside of an event handler (e.g. by a background thread modifying a LiveValue),
+the server asks the client to request a synchronisation. Sending a request for every queued task floods the client,
+so the SyncScheduler coalesces them: all of the tasks queued within a frame are handled by a single synchronisation.
+
+Frames are at least min_interval seconds apart. The interval adapts to the time that the client takes to answer a
+request - which includes the time taken to apply the preceding updates - up to max_interval, so that a client that
+cannot keep up receives fewer, larger updates. At most max_inflight requests may be unanswered at a time; a further
+request is only sent when the most recent one has been unanswered for longer than max_interval. Requests that have
+been unanswered for several times max_interval are assumed to have been lost (e.g. the client view was not yet
+rendered, or was closed or reloaded) and no longer count against the limit, so that synchronisation resumes.
+"""
+import threading
+import unittest
+from timeit import default_timer
+
+
+
+class SyncScheduler (object):
+	# The number of multiples of max_interval after which an unanswered request is assumed to have been lost
+	_LOST_REQUEST_INTERVALS = 4
+
+	def __init__(self, send_request_fn, min_interval=1.0/30.0, max_interval=1.0, max_inflight=3,
+		     timer_factory=threading.Timer, clock=default_timer):
+		"""
+		Constructor
+
+		:param send_request_fn: a function of the form function() that asks the client to request a synchronisation
+		:param min_interval: [optional] the minimum time between synchronisations, in seconds
+		:param max_interval: [optional] the maximum time between synchronisations that the adaptive interval will grow to
+		:param max_inflight: [optional] the maximum number of unanswered requests
+		:param timer_factory: [optional] a function of the form function(delay, fn) that returns a timer with a start method; threading.Timer by default
+		:param clock: [optional] a function that returns the current time in seconds
+		"""
+		self.__send_request_fn = send_request_fn
+		self.__min_interval = min_interval
+		self.__max_interval = max_interval
+		self.__max_inflight = max_inflight
+		self.__timer_factory = timer_factory
+		self.__clock = clock
+
+		self.__lock = threading.Lock()
+		self.__interval = min_interval
+		# Send times of the unanswered requests
+		self.__inflight = []
+		self.__timer = None
+		self.__dirty = False
+		self.__syncing = False
+		self.__last_sync_time = None
+
+		self.requests_sent = 0
+		self.syncs = 0
+
+
+	interval = property(lambda self: self.__interval)
+	num_inflight = property(lambda self: len(self.__inflight))
+
+
+	def on_tasks_queued(self):
+		"""
+		Notify the scheduler that tasks have been queued on the page
+		"""
+		with self.__lock:
+			self.__dirty = True
+			send = self.__schedule()
+		if send:
+			self.__send_request_fn()
+
+
+	def begin_sync(self, answers_request=True):
+		"""
+		Notify the scheduler that the page is about to be synchronised
+
+		:param answers_request: True if the synchronisation was requested by the client in response to a request, False if it was caused by something else (e.g. an event)
+		"""
+		with self.__lock:
+			now = self.__clock()
+			if answers_request  and  len(self.__inflight) > 0:
+				latency = now - self.__inflight.pop(0)
+				# Move the interval half way towards the latency of the client
+				interval = (self.__interval + latency) * 0.5
+				self.__interval = max(self.__min_interval, min(interval, self.__max_interval))
+			# The synchronisation will execute all queued tasks
+			self.__dirty = False
+			self.__syncing = True
+			self.syncs += 1
+
+
+	def end_sync(self):
+		"""
+		Notify the scheduler that the page has been synchronised
+		"""
+		with self.__lock:
+			self.__syncing = False
+			self.__last_sync_time = self.__clock()
+			# Tasks may have been queued by other threads during the synchronisation
+			send = self.__schedule()
+		if send:
+			self.__send_request_fn()
+
+
+	def reset(self):
+		"""
+		Forget the unanswered requests; invoke when a new client view or transport is set up, as requests sent to the
+		previous one will not be answered
+		"""
+		with self.__lock:
+			del self.__inflight[:]
+			if self.__timer is not None:
+				self.__timer.cancel()
+				self.__timer = None
+			send = self.__schedule()
+		if send:
+			self.__send_request_fn()
+
+
+	def cancel(self):
+		"""
+		Cancel any pending timer
+		"""
+		with self.__lock:
+			if self.__timer is not None:
+				self.__timer.cancel()
+				self.__timer = None
+			self.__dirty = False
+
+
+
+	def __on_timer(self):
+		with self.__lock:
+			self.__timer = None
+			send = self.__schedule()
+		if send:
+			self.__send_request_fn()
+
+
+	def __schedule(self):
+		# Called with the lock held; returns True if a request should be sent now
+		if not self.__dirty  or  self.__syncing  or  self.__timer is not None:
+			return False
+		now = self.__clock()
+		# Drop requests that have been unanswered for so long that they were probably lost
+		lost_timeout = self.__max_interval * self._LOST_REQUEST_INTERVALS
+		while len(self.__inflight) > 0  and  now - self.__inflight[0] >= lost_timeout:
+			del self.__inflight[0]
+		if len(self.__inflight) > 0:
+			# An unanswered request will result in a synchronisation that handles the queued tasks
+			since_request = now - self.__inflight[-1]
+			if len(self.__inflight) >= self.__max_inflight:
+				# Try again once the oldest request is deemed lost
+				self.__start_timer(self.__inflight[0] + lost_timeout - now)
+				return False
+			elif since_request < self.__max_interval:
+				self.__start_timer(self.__max_interval - since_request)
+				return False
+		delay = 0.0
+		if self.__last_sync_time is not None:
+			delay = self.__last_sync_time + self.__interval - now
+		if delay > 0.0:
+			self.__start_timer(delay)
+			return False
+		self.__inflight.append(now)
+		self.requests_sent += 1
+		return True
+
+
+	def __start_timer(self, delay):
+		self.__timer = self.__timer_factory(delay, self.__on_timer)
+		self.__timer.start()
+
+
+
+
+
+class Test_SyncScheduler (unittest.TestCase):
+	class _Timer (object):
+		def __init__(self, test, delay, fn):
+			self.test = test
+			self.delay = delay
+			self.fn = fn
+
+		def start(self):
+			self.test.timers.append(self)
+
+		def cancel(self):
+			self.test.timers.remove(self)
+
+
+	def setUp(self):
+		self.now = 0.0
+		self.timers = []
+		self.requests = 0
+
+		def send():
+			self.requests += 1
+
+		self.scheduler = SyncScheduler(send, min_interval=0.1, max_interval=1.0, max_inflight=2,
+					       timer_factory=lambda delay, fn: Test_SyncScheduler._Timer(self, delay, fn),
+					       clock=lambda: self.now)
+
+
+	def _fire_timer(self):
+		timer = self.timers.pop(0)
+		self.now += timer.delay
+		timer.fn()
+
+
+	def _sync(self, latency):
+		self.now += latency
+		self.scheduler.begin_sync()
+		self.scheduler.end_sync()
+
+
+	def test_coalesce(self):
+		s = self.scheduler
+		for i in xrange(1000):
+			s.on_tasks_queued()
+		self.assertEqual(1, self.requests)
+		self.assertEqual(1, s.num_inflight)
+
+		# Tasks queued while a request is unanswered do not result in further requests
+		self._sync(0.05)
+		self.assertEqual(0, s.num_inflight)
+		for i in xrange(1000):
+			s.on_tasks_queued()
+		# Within the frame interval of the previous synchronisation; wait for the timer
+		self.assertEqual(1, self.requests)
+		self.assertEqual(1, len(self.timers))
+		self._fire_timer()
+		self.assertEqual(2, self.requests)
+
+
+	def test_no_request_when_idle(self):
+		s = self.scheduler
+		s.on_tasks_queued()
+		self._sync(0.05)
+		self.now += 10.0
+		self.assertEqual(1, self.requests)
+		self.assertEqual([], self.timers)
+
+
+	def test_adaptive_interval(self):
+		s = self.scheduler
+		s.on_tasks_queued()
+		self._sync(0.8)
+		self.assertAlmostEqual(0.45, s.interval)
+		s.on_tasks_queued()
+		self._fire_timer()
+		self._sync(0.01)
+		self.assertAlmostEqual(0.23, s.interval)
+		for i in xrange(20):
+			s.on_tasks_queued()
+			self._fire_timer()
+			self._sync(0.01)
+		self.assertAlmostEqual(0.1, s.interval)
+
+
+	def test_unanswered_requests(self):
+		s = self.scheduler
+		s.on_tasks_queued()
+		self.assertEqual(1, self.requests)
+		# The request is not answered; a second is sent after the maximum interval
+		s.on_tasks_queued()
+		self.assertEqual(1, self.requests)
+		self._fire_timer()
+		self.assertEqual(2, self.requests)
+		# The in-flight limit has been reached; the oldest request is deemed lost after four times the maximum interval
+		s.on_tasks_queued()
+		self.assertEqual(2, self.requests)
+		self.assertEqual([3.0], [t.delay   for t in self.timers])
+		self._fire_timer()
+		self.assertEqual(3, self.requests)
+		self.assertEqual(2, s.num_inflight)
+
+		# Unanswered requests do not stop synchronisation for good
+		self.now += 5.0
+		s.on_tasks_queued()
+		self.assertEqual(4, self.requests)
+		self.assertEqual(1, s.num_inflight)
+
+		# Synchronising due to an event does not answer a request
+		s.begin_sync(answers_request=False)
+		s.end_sync()
+		self.assertEqual(1, s.num_inflight)
+		self._sync(0.01)
+		self.assertEqual(0, s.num_inflight)
+
+
+	def test_reset(self):
+		s = self.scheduler
+		s.on_tasks_queued()
+		s.on_tasks_queued()
+		self._fire_timer()
+		self.assertEqual(2, s.num_inflight)
+		s.on_tasks_queued()
+		self.assertEqual(1, len(self.timers))
+
+		# The requests were sent to a view that has gone; a request is sent to the new one straight away
+		s.reset()
+		self.assertEqual([], self.timers)
+		self.assertEqual(3, self.requests)
+		self.assertEqual(1, s.num_inflight)
+
+
+	def test_queued_during_sync(self):
+		s = self.scheduler
+		s.on_tasks_queued()
+		self.now += 0.5
+		s.begin_sync()
+		s.on_tasks_queued()
+		self.assertEqual(1, self.requests)
+		s.end_sync()
+		self.assertEqual(1, len(self.timers))
+		self._fire_timer()
+		self.assertEqual(2, self.requests)
@@ -0,0 +1,181 @@
+##-*************************
+##-* This program is free software; you can use it, redistribute it and/or
+##-* modify it under the terms of the GNU Affero General Public License
+##-* version 3 as published by the Free Software Foundation. The full text of
+##-* the GNU Affero General Public License version 3 can be found in the file
+##-* named 'LICENSE.txt' that accompanies this program. This source code is
+##-* (C)copyright Geoffrey French 2011-2014.
+##-*************************
+"""
+Message packet transport encodings
+
+A packet of client messages is encoded as a JSON compatible object along with a list of binary buffers, suitable for
+sending over a channel such as an IPython widget comm. The encodings are:
+	json - the messages are sent as they are, with no buffers
+	binary - large strings (e.g. HTML content) are moved out of the messages into binary buffers, as UTF-8
+	deflate - the messages are JSON encoded and compressed into a single buffer
+
+The client declares the encodings that it supports, and the server chooses one using the negotiate function.
+The client side decoder is Larch.decodeMessagePacket in larch.js.
+"""
+import json
+import zlib
+import unittest
+
+
+
+class PacketEncoder (object):
+	name = NotImplemented
+
+	def encode(self, messages):
+		"""
+		Encode a packet of messages
+
+		:param messages: a list of messages
+		:return: a tuple (packet, buffers) where packet is a JSON compatible dictionary and buffers is a list of byte strings
+		"""
+		raise NotImplementedError, 'abstract'
+
+
+
+class JsonPacketEncoder (PacketEncoder):
+	name = 'json'
+
+	def encode(self, messages):
+		return {'messages': messages}, []
+
+
+
+class BinaryPacketEncoder (PacketEncoder):
+	"""
+	Moves strings whose length is at least min_length into binary buffers. Each string is replaced by a buffer reference
+	of the form {'__lch_buffer__': index}.
+	"""
+	name = 'binary'
+
+	def __init__(self, min_length=1024):
+		self.__min_length = min_length
+
+
+	def encode(self, messages):
+		buffers = []
+		min_length = self.__min_length
+
+		def extract(x):
+			if isinstance(x, basestring):
+				if len(x) >= min_length:
+					buffers.append(x.encode('utf-8')   if isinstance(x, unicode)   else x)
+					return {'__lch_buffer__': len(buffers) - 1}
+				else:
+					return x
+			elif isinstance(x, dict):
+				return {k: extract(v)   for k, v in x.items()}
+			elif isinstance(x, list)  or  isinstance(x, tuple):
+				return [extract(v)   for v in x]
+			else:
+				return x
+
+		return {'encoding': self.name, 'messages': extract(messages)}, buffers
+
+
+
+class DeflatePacketEncoder (PacketEncoder):
+	name = 'deflate'
+
+	def __init__(self, level=6):
+		self.__level = level
+
+
+	def encode(self, messages):
+		return {'encoding': self.name}, [zlib.compress(json.dumps(messages), self.__level)]
+
+
+
+_encoder_types = {
+	JsonPacketEncoder.name: JsonPacketEncoder,
+	BinaryPacketEncoder.name: BinaryPacketEncoder,
+	DeflatePacketEncoder.name: DeflatePacketEncoder,
+}
+
+DEFAULT_PREFERENCES = [DeflatePacketEncoder.name, BinaryPacketEncoder.name, JsonPacketEncoder.name]
+
+
+def negotiate(client_encodings, preferences=None):
+	"""
+	Choose a packet encoder
+
+	:param client_encodings: the names of the encodings supported by the client
+	:param preferences: [optional] the names of the encodings that the server is willing to use, most preferred first
+	:return: a PacketEncoder; the JSON encoder if there are no other encodings in common
+	"""
+	if preferences is None:
+		preferences = DEFAULT_PREFERENCES
+	for name in preferences:
+		if name in client_encodings  and  name in _encoder_types:
+			return _encoder_types[name]()
+	return JsonPacketEncoder()
+
+
+def decode(packet, buffers):
+	"""
+	Decode a packet; the Python counterpart of the client side decoder
+
+	:param packet: the packet produced by an encoder
+	:param buffers: the buffers produced by an encoder
+	:return: the list of messages
+	"""
+	encoding = packet.get('encoding', JsonPacketEncoder.name)
+	if encoding == JsonPacketEncoder.name:
+		return packet['messages']
+	elif encoding == BinaryPacketEncoder.name:
+		def resolve(x):
+			if isinstance(x, dict):
+				if '__lch_buffer__' in x:
+					return buffers[x['__lch_buffer__']].decode('utf-8')
+				return {k: resolve(v)   for k, v in x.items()}
+			elif isinstance(x, list):
+				return [resolve(v)   for v in x]
+			else:
+				return x
+		return resolve(packet['messages'])
+	elif encoding == DeflatePacketEncoder.name:
+		return json.loads(zlib.decompress(buffers[0]))
+	else:
+		raise ValueError, 'Unknown packet encoding {0}'.format(encoding)
+
+
+
+
+
+class Test_transport (unittest.TestCase):
+	def _messages(self):
+		html = u'<div>' + u'\xe9' * 2000 + u'</div>'
+		return [{'msg_type': 'modify_page', 'changes': {'removed': ['seg1'], 'modified': [['seg2', html], ['seg3', '<b>x</b>']]}}]
+
+
+	def test_json(self):
+		packet, buffers = JsonPacketEncoder().encode(self._messages())
+		self.assertEqual([], buffers)
+		self.assertEqual(self._messages(), decode(packet, buffers))
+
+
+	def test_binary(self):
+		packet, buffers = BinaryPacketEncoder().encode(self._messages())
+		self.assertEqual(1, len(buffers))
+		self.assertEqual({'__lch_buffer__': 0}, packet['messages'][0]['changes']['modified'][0][1])
+		self.assertEqual('<b>x</b>', packet['messages'][0]['changes']['modified'][1][1])
+		self.assertEqual(self._messages(), decode(json.loads(json.dumps(packet)), buffers))
+
+
+	def test_deflate(self):
+		packet, buffers = DeflatePacketEncoder().encode(self._messages())
+		self.assertEqual(1, len(buffers))
+		self.assertLess(len(buffers[0]), 200)
+		self.assertEqual(self._messages(), decode(packet, buffers))
+
+
+	def test_negotiate(self):
+		self.assertIsInstance(negotiate(['json', 'binary', 'deflate']), DeflatePacketEncoder)
+		self.assertIsInstance(negotiate(['binary', 'json']), BinaryPacketEncoder)
+		self.assertIsInstance(negotiate(['binary', 'deflate'], ['binary']), BinaryPacketEncoder)
+		self.assertIsInstance(negotiate(['zstd']), JsonPacketEncoder)
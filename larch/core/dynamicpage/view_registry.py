@@ -0,0 +1,287 @@
+##-*************************
+##-* This program is free software; you can use it, redistribute it and/or
+##-* modify it under the terms of the GNU Affero General Public License
+##-* version 3 as published by the Free Software Foundation. The full text of
+##-* the GNU Affero General Public License version 3 can be found in the file
+##-* named 'LICENSE.txt' that accompanies this program. This source code is
+##-* (C)copyright Geoffrey French 2011-2014.
+##-*************************
+"""
+Registry of the views served by a dynamic page service
+
+Views are distributed over a number of shards by view ID, each with its own lock, so that looking up different
+views from concurrent requests does not contend on a single lock. Each shard keeps its views in order of last access.
+
+Views that have not been accessed for longer than a time-to-live are evicted, as are the least recently used views
+when the number of views exceeds a maximum. This reclaims the views of pages that were abandoned without the client
+sending a close_page event (e.g. a browser tab that was closed or crashed).
+"""
+import threading
+import collections
+import unittest
+from timeit import default_timer
+
+
+
+class _Shard (object):
+	def __init__(self):
+		self.lock = threading.Lock()
+		# Maps view ID to (view, last access time), least recently accessed first
+		self.entries = collections.OrderedDict()
+
+
+
+class ViewRegistry (object):
+	def __init__(self, num_shards=16, max_views=None, ttl=None, on_evict=None, clock=default_timer):
+		"""
+		Constructor
+
+		:param num_shards: [optional] the number of shards
+		:param max_views: [optional] the maximum number of views; the least recently used views are evicted when it is exceeded. Unlimited if None.
+		:param ttl: [optional] the time in seconds after its last access at which a view is evicted. Views are not evicted due to age if None.
+		:param on_evict: [optional] a function of the form function(view_id, view) that is invoked when a view is evicted
+		:param clock: [optional] a function that returns the current time in seconds
+		"""
+		self.__shards = [_Shard()   for i in xrange(num_shards)]
+		self.__max_views = max_views
+		self.__ttl = ttl
+		self.__on_evict = on_evict
+		self.__clock = clock
+
+		self.__metrics_lock = threading.Lock()
+		self.__last_sweep_time = clock()
+		self.__views_added = 0
+		self.__views_removed = 0
+		self.__views_evicted_idle = 0
+		self.__views_evicted_lru = 0
+
+
+	def add(self, view_id, view):
+		"""
+		Add a view, evicting views if the registry is over its limits
+		"""
+		shard = self.__shard(view_id)
+		with shard.lock:
+			shard.entries[view_id] = (view, self.__clock())
+		with self.__metrics_lock:
+			self.__views_added += 1
+
+		self.__sweep_if_due()
+		if self.__max_views is not None:
+			self.__evict_lru()
+
+
+	def get(self, view_id):
+		"""
+		Get a view and mark it as accessed
+
+		:return: the view, or None if there is no view with the given ID, or it has exceeded the time-to-live
+		"""
+		self.__sweep_if_due()
+		shard = self.__shard(view_id)
+		with shard.lock:
+			entry = shard.entries.pop(view_id, None)
+			if entry is None:
+				return None
+			view, last_access = entry
+			now = self.__clock()
+			if self.__ttl is None  or  now - last_access <= self.__ttl:
+				# Move to the end; the most recently accessed
+				shard.entries[view_id] = (view, now)
+				return view
+		# Idle for too long, but not yet swept; evict it
+		with self.__metrics_lock:
+			self.__views_evicted_idle += 1
+		self.__notify_evicted([(view_id, view)])
+		return None
+
+
+	def remove(self, view_id):
+		"""
+		Remove a view
+
+		:return: the view, or None if there is no view with the given ID
+		"""
+		shard = self.__shard(view_id)
+		with shard.lock:
+			entry = shard.entries.pop(view_id, None)
+		if entry is None:
+			return None
+		with self.__metrics_lock:
+			self.__views_removed += 1
+		return entry[0]
+
+
+	def __len__(self):
+		return sum([len(shard.entries)   for shard in self.__shards])
+
+
+	def evict_idle(self):
+		"""
+		Evict the views that have not been accessed for longer than the time-to-live. Invoked periodically by add and get.
+
+		:return: the number of views evicted
+		"""
+		self.__last_sweep_time = self.__clock()
+		if self.__ttl is None:
+			return 0
+		threshold = self.__clock() - self.__ttl
+		evicted = []
+		for shard in self.__shards:
+			with shard.lock:
+				entries = shard.entries
+				while len(entries) > 0:
+					view_id, (view, last_access) = next(entries.iteritems())
+					if last_access >= threshold:
+						break
+					del entries[view_id]
+					evicted.append((view_id, view))
+		with self.__metrics_lock:
+			self.__views_evicted_idle += len(evicted)
+		self.__notify_evicted(evicted)
+		return len(evicted)
+
+
+	def metrics(self):
+		"""
+		Get statistics
+
+		:return: a dictionary with the keys:
+			'live_views' - the number of views in the registry
+			'views_added' - the number of views added
+			'views_removed' - the number of views removed explicitly (e.g. when a page was closed)
+			'views_evicted_idle' - the number of views evicted as they exceeded the time-to-live
+			'views_evicted_lru' - the number of views evicted to stay within the maximum number of views
+		"""
+		with self.__metrics_lock:
+			return {'live_views': len(self),
+				'views_added': self.__views_added,
+				'views_removed': self.__views_removed,
+				'views_evicted_idle': self.__views_evicted_idle,
+				'views_evicted_lru': self.__views_evicted_lru}
+
+
+
+	def __shard(self, view_id):
+		return self.__shards[hash(view_id) % len(self.__shards)]
+
+
+	def __sweep_if_due(self):
+		# Sweep for idle views at intervals of a quarter of the time-to-live
+		if self.__ttl is not None  and  self.__clock() - self.__last_sweep_time >= self.__ttl * 0.25:
+			self.evict_idle()
+
+
+	def __evict_lru(self):
+		evicted = []
+		while len(self) > self.__max_views:
+			# Find the least recently accessed view; the oldest of the first entries of each shard
+			oldest_shard = None
+			oldest_id = None
+			oldest_time = None
+			for shard in self.__shards:
+				with shard.lock:
+					if len(shard.entries) > 0:
+						view_id, (view, last_access) = next(shard.entries.iteritems())
+						if oldest_time is None  or  last_access < oldest_time:
+							oldest_shard, oldest_id, oldest_time = shard, view_id, last_access
+			if oldest_shard is None:
+				break
+			with oldest_shard.lock:
+				# The view may have been accessed or removed by another thread in the meantime; if so, look again
+				entry = oldest_shard.entries.get(oldest_id)
+				if entry is None  or  entry[1] != oldest_time:
+					continue
+				del oldest_shard.entries[oldest_id]
+			evicted.append((oldest_id, entry[0]))
+		with self.__metrics_lock:
+			self.__views_evicted_lru += len(evicted)
+		self.__notify_evicted(evicted)
+
+
+	def __notify_evicted(self, evicted):
+		# Invoked without holding any shard locks
+		if self.__on_evict is not None:
+			for view_id, view in evicted:
+				self.__on_evict(view_id, view)
+
+
+
+
+
+class Test_ViewRegistry (unittest.TestCase):
+	def setUp(self):
+		self.now = 0.0
+		self.evicted = []
+
+
+	def _registry(self, **kwargs):
+		return ViewRegistry(num_shards=4, clock=lambda: self.now,
+				    on_evict=lambda view_id, view: self.evicted.append(view_id), **kwargs)
+
+
+	def test_add_get_remove(self):
+		r = self._registry()
+		r.add('a', 1)
+		r.add('b', 2)
+		self.assertEqual(1, r.get('a'))
+		self.assertEqual(None, r.get('c'))
+		self.assertEqual(2, r.remove('b'))
+		self.assertEqual(None, r.get('b'))
+		self.assertEqual(1, len(r))
+		self.assertEqual({'live_views': 1, 'views_added': 2, 'views_removed': 1, 'views_evicted_idle': 0,
+				  'views_evicted_lru': 0}, r.metrics())
+
+
+	def test_lru(self):
+		r = self._registry(max_views=3)
+		for i in xrange(3):
+			r.add(i, i)
+			self.now += 1.0
+		r.get(0)
+		self.now += 1.0
+		r.add(3, 3)
+		self.assertEqual([1], self.evicted)
+		r.add(4, 4)
+		self.assertEqual([1, 2], self.evicted)
+		self.assertEqual(3, len(r))
+		self.assertEqual(0, r.get(0))
+		self.assertEqual(2, r.metrics()['views_evicted_lru'])
+
+
+	def test_ttl(self):
+		r = self._registry(ttl=10.0)
+		r.add('a', 1)
+		r.add('b', 2)
+		self.now = 8.0
+		r.get('a')
+		self.now = 12.0
+		r.add('c', 3)
+		self.assertEqual(['b'], self.evicted)
+		self.assertEqual(1, r.get('a'))
+		self.now = 30.0
+		self.assertEqual(2, r.evict_idle())
+		self.assertEqual(0, len(r))
+		self.assertEqual(3, r.metrics()['views_evicted_idle'])
+
+
+	def test_ttl_get(self):
+		r = self._registry(ttl=10.0)
+		r.add('a', 1)
+		r.add('b', 2)
+		r.add('c', 3)
+		self.now = 5.0
+		r.get('a')
+		# Getting a view sweeps for idle views, without waiting for a view to be added
+		self.now = 12.0
+		self.assertEqual(1, r.get('a'))
+		self.assertEqual(['b', 'c'], sorted(self.evicted))
+		self.assertEqual(1, len(r))
+		# A view that has exceeded the time-to-live is not returned, even if a sweep is not yet due
+		self.now = 21.0
+		self.assertEqual(None, r.get('x'))
+		self.assertEqual(['b', 'c'], sorted(self.evicted))
+		self.now = 22.5
+		self.assertEqual(None, r.get('a'))
+		self.assertEqual(['a', 'b', 'c'], sorted(self.evicted))
+		self.assertEqual(3, r.metrics()['views_evicted_idle'])
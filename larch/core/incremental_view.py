@@ -7,6 +7,7 @@
 ##-* (C)copyright Geoffrey French 2011-2014.
 ##-*************************
 import sys
+import unittest
 from collections import deque
 
 from larch.util.simple_attribute_table import SimpleAttributeTable
@@ -14,9 +15,11 @@ from larch.pres.presctx import PresentationContext
 from larch.pres.pres import Pres
 from larch.pres.html import Html
 from larch.incremental import IncrementalMonitor, IncrementalFunctionMonitor
+from larch.live import TrackedLiveList
 from larch.inspector.present_exception import present_exception_with_traceback
 from larch.core.dynamicpage.page import  DynamicPage
-from larch.core.dynamicpage.segment import  HtmlContent
+from larch.core.dynamicpage.segment import  HtmlContent, SegmentRef
+from larch.core.refresh_profile import RefreshProfile
 
 
 
@@ -45,6 +48,38 @@ def _inspector_event_handler(event):
 
 
 
+class _AccessRecorder (object):
+	"""
+	Stands in for the current computation while a presentation is prefetched on a worker thread, recording the
+	incremental monitors that are accessed so that the accesses can be replayed against the fragment's monitor
+	"""
+	def __init__(self):
+		self.accessed = []
+
+	def _on_incoming_dependency_access(self, inc):
+		self.accessed.append(inc)
+
+
+
+class _PrefetchedPresentation (object):
+	def __init__(self, fragment_pres, accessed, revision, present_time):
+		self.fragment_pres = fragment_pres
+		self.accessed = accessed
+		self.revision = revision
+		self.present_time = present_time
+
+
+	def is_valid_for(self, incr):
+		# The presentation is stale if the fragment or anything that it accessed was changed after the prefetch began
+		if incr._changed_revision > self.revision:
+			return False
+		for inc in self.accessed:
+			if inc._changed_revision > self.revision  or  inc.refresh_required:
+				return False
+		return True
+
+
+
 
 
 
@@ -73,11 +108,14 @@ class _FragmentView (object):
 		self.__model = model
 
 		self.__parent = None
+		self.__prev_sibling = None
 		self.__next_sibling = None
 		self.__children_head = None
 		self.__children_tail = None
 
 		self.__fragment_factory = None
+		self.__prefetched = None
+		self.__compute_start_time = None
 		self.__incr = IncrementalFunctionMonitor(self)
 		self.__incr.add_listener(self.__on_incremental_monitor_changed)
 
@@ -85,19 +123,29 @@ class _FragmentView (object):
 		self.__segment = self.__inc_view.dynamic_page.new_segment(desc='{0}'.format(type(self.__model).__name__), fragment=self)
 		self.__segment.add_event_handler(_inspector_event_handler)
 		self.__segment.add_initialise_script('larch.controls.initObjectInspector(node);')
-		self.__sub_segments = []
+		self.__sub_segments = set()
+		profile = self.__inc_view.profile
+		if profile is not None:
+			profile._on_segments_created(self, 1)
 
 		# Resources
 		self.__resource_instances = set()
 
+		# Listeners whose lifetime is that of the current content; list of (source, listener) pairs
+		self.__scoped_listeners = None
+
 
 	def _dispose(self):
 		self.__incr.remove_listener(self.__on_incremental_monitor_changed)
+		self.__remove_scoped_listeners()
 		for rsc_instance in self.__resource_instances:
 			self.__inc_view.dynamic_page.unref_resource_instance(rsc_instance)
 		for sub_seg in self.__sub_segments:
 			self.__inc_view.dynamic_page.remove_segment(sub_seg)
 		self.__inc_view.dynamic_page.remove_segment(self.__segment)
+		profile = self.__inc_view.profile
+		if profile is not None:
+			profile._on_segments_destroyed(self, len(self.__sub_segments) + 1)
 
 
 
@@ -111,6 +159,34 @@ class _FragmentView (object):
 		self.__inc_view.queue_task(task, priority)
 
 
+	def add_scoped_listener(self, source, listener):
+		"""
+		Add a listener to a source - such as a live value - for as long as the current content of the fragment exists
+
+		The listener is removed when the content of the fragment is re-computed, or the fragment is disposed of. The source
+		only holds a weak reference to the listener; the fragment holds it.
+
+		:param source: an object with add_listener and remove_listener methods, e.g. a live value or an incremental monitor, or a TrackedLiveList, in which case the listener is added as a delta listener
+		:param listener: the listener
+		"""
+		if isinstance(source, TrackedLiveList):
+			source.add_delta_listener(listener, weak=True)
+			remove = source.remove_delta_listener
+		else:
+			source.add_listener(listener, weak=True)
+			remove = source.remove_listener
+		if self.__scoped_listeners is None:
+			self.__scoped_listeners = []
+		self.__scoped_listeners.append((remove, listener))
+
+
+	def __remove_scoped_listeners(self):
+		if self.__scoped_listeners is not None:
+			for remove, listener in self.__scoped_listeners:
+				remove(listener)
+			self.__scoped_listeners = None
+
+
 	#
 	#
 	# Segment acquisition
@@ -248,10 +324,42 @@ class _FragmentView (object):
 
 	def create_sub_segment(self, content):
 		sub_seg = self.__inc_view.dynamic_page.new_segment(content, desc='subseg_{0}'.format(type(self.__model).__name__), fragment=self)
-		self.__sub_segments.append(sub_seg)
+		self.__sub_segments.add(sub_seg)
+		profile = self.__inc_view.profile
+		if profile is not None:
+			profile._on_segments_created(self, 1)
 		return sub_seg
 
 
+	def discard_content(self, content):
+		"""
+		Discard part of the content of this fragment, outside of a refresh. The sub-segments referenced by the content are
+		removed and the inner fragments are detached from this fragment; they are disposed of when the incremental view is
+		next cleaned, unless they are presented again in the meantime.
+
+		Used by presentations that update their content in place, e.g. live_list.
+
+		:param content: HtmlContent previously built by presenting within this fragment
+		"""
+		for x in content:
+			if isinstance(x, HtmlContent):
+				self.discard_content(x)
+			elif isinstance(x, SegmentRef):
+				seg = x.segment
+				if seg in self.__sub_segments:
+					if seg.content is not None:
+						self.discard_content(seg.content)
+					self.__sub_segments.remove(seg)
+					self.__inc_view.dynamic_page.remove_segment(seg)
+					profile = self.__inc_view.profile
+					if profile is not None:
+						profile._on_segments_destroyed(self, 1)
+				else:
+					child = seg.fragment
+					if child is not None  and  child.__parent is self:
+						self.__detach_child(child)
+
+
 
 	def get_resource_instance(self, resource, pres_ctx):
 		rsc_instance = self.__inc_view.dynamic_page.get_resource_instance(resource, pres_ctx)
@@ -323,12 +431,19 @@ class _FragmentView (object):
 
 		if self.__test_flag(self._FLAG_NODE_REFRESH_REQUIRED):
 			# Compute result for this fragment, and refresh all children
+			was_invalidated = self.__incr.refresh_required
 			refresh_state = self.__incr.on_refresh_begin()
 			if refresh_state is not None:
 				content = self.__compute_fragment_content()
+			elif was_invalidated:
+				# Early cutoff; the values that this fragment depends upon did not change, so keep the existing content
+				self.__clear_flag(self._FLAG_NODE_REFRESH_REQUIRED)
 			self.__incr.on_refresh_end(refresh_state)
 
 		# Refresh each child
+		refresh_pool = self.__inc_view.refresh_pool
+		if refresh_pool is not None:
+			self.__prefetch_child_presentations(refresh_pool)
 		child = self.__children_head
 		while child is not None:
 			child.refresh()
@@ -340,10 +455,48 @@ class _FragmentView (object):
 			self.__segment.content = content
 
 		self.__inc_view.on_fragment_content_change_to(self, content)
+		self.__prefetched = None
 		self.__clear_flag(self._FLAG_NODE_REFRESH_REQUIRED)
 		self.__clear_flag(self._FLAG_NODE_REFRESH_IN_PROGRESS)
 
 
+	def __prefetch_child_presentations(self, refresh_pool):
+		# Gather the children whose presentations will be re-computed when they are refreshed
+		children = []
+		child = self.__children_head
+		while child is not None:
+			if child.__test_flag(self._FLAG_SUBTREE_REFRESH_REQUIRED)  and  child.__test_flag(self._FLAG_NODE_REFRESH_REQUIRED)  and \
+					child.__incr.refresh_required  and  child.__fragment_factory is not None:
+				children.append(child)
+			child = child.__next_sibling
+
+		if len(children) > 1:
+			# Present the children on the worker pool. The content is built from the presentations, and committed to the
+			# dynamic page, when each child is refreshed on this thread.
+			profile = self.__inc_view.profile
+			t0 = profile.clock()   if profile is not None   else None
+			prefetched = list(refresh_pool.map(_FragmentView.__prefetch_presentation, children))
+			if profile is not None:
+				profile._on_presentations_prefetched(profile.clock() - t0)
+			for child, p in zip(children, prefetched):
+				child.__prefetched = p
+
+
+	def __prefetch_presentation(self):
+		recorder = _AccessRecorder()
+		revision = IncrementalMonitor._revision
+		# Invoked on a worker thread while the refreshing thread waits, so the profile does not change
+		profile = self.__inc_view.profile
+		t0 = profile.clock()   if profile is not None   else None
+		prev_computation = IncrementalMonitor._push_current_computation(recorder)
+		try:
+			fragment_pres = self.__fragment_factory.present_fragment(self, self.__model)
+		finally:
+			IncrementalMonitor._pop_current_computation(prev_computation)
+		present_time = profile.clock() - t0   if profile is not None   else 0.0
+		return _PrefetchedPresentation(fragment_pres, recorder.accessed, revision, present_time)
+
+
 	@staticmethod
 	def _unref_subtree(inc_view, fragment):
 		q = deque()
@@ -391,6 +544,7 @@ class _FragmentView (object):
 			next = child.__next_sibling
 
 			child.__parent = None
+			child.__prev_sibling = None
 			child.__next_sibling = None
 
 			child = next
@@ -410,12 +564,23 @@ class _FragmentView (object):
 		self.__on_compute_node_result_begin()
 		self.__clear_flag(self._FLAG_DISABLE_INSPECTOR)
 
+		fragment_pres = None
+		present_time = 0.0
+		prefetched = self.__prefetched
+		self.__prefetched = None
+		if prefetched is not None  and  prefetched.is_valid_for(self.__incr):
+			# Replay the accesses made while prefetching, so that this fragment depends upon them
+			for inc in prefetched.accessed:
+				inc._on_value_access()
+			fragment_pres = prefetched.fragment_pres
+			present_time = prefetched.present_time
+
 		content = None
 		try:
 			if self.__fragment_factory is not None:
-				content = self.__fragment_factory.build_html_content_for_fragment(self.__inc_view, self, self.__model)   if self.__fragment_factory is not None   else None
+				content = self.__fragment_factory.build_html_content_for_fragment(self.__inc_view, self, self.__model, fragment_pres)   if self.__fragment_factory is not None   else None
 		finally:
-			self.__on_compute_node_result_end()
+			self.__on_compute_node_result_end(content, present_time)
 		return content
 
 
@@ -427,6 +592,7 @@ class _FragmentView (object):
 
 			_FragmentView._unref_subtree(self.__inc_view, child)
 			child.__parent = None
+			child.__prev_sibling = None
 			child.__next_sibling = None
 
 			child = next
@@ -435,7 +601,12 @@ class _FragmentView (object):
 		# Remove sub segments
 		for sub_seg in self.__sub_segments:
 			self.__inc_view.dynamic_page.remove_segment(sub_seg)
-		del self.__sub_segments[:]
+		profile = self.__inc_view.profile
+		if profile is not None  and  len(self.__sub_segments) > 0:
+			profile._on_segments_destroyed(self, len(self.__sub_segments))
+		self.__sub_segments.clear()
+
+		self.__remove_scoped_listeners()
 
 
 
@@ -452,6 +623,7 @@ class _FragmentView (object):
 		# Append child to the list of children
 		if self.__children_tail is not None:
 			self.__children_tail.__next_sibling = child
+		child.__prev_sibling = self.__children_tail
 
 		if self.__children_head is None:
 			self.__children_head = child
@@ -464,6 +636,24 @@ class _FragmentView (object):
 		_FragmentView._ref_subtree(self.__inc_view, child)
 
 
+	def __detach_child(self, child):
+		# Remove the child from the list of children
+		if child.__prev_sibling is not None:
+			child.__prev_sibling.__next_sibling = child.__next_sibling
+		else:
+			self.__children_head = child.__next_sibling
+		if child.__next_sibling is not None:
+			child.__next_sibling.__prev_sibling = child.__prev_sibling
+		else:
+			self.__children_tail = child.__prev_sibling
+
+		child.__parent = None
+		child.__prev_sibling = None
+		child.__next_sibling = None
+
+		_FragmentView._unref_subtree(self.__inc_view, child)
+
+
 
 	#
 	#
@@ -488,10 +678,17 @@ class _FragmentView (object):
 	#
 
 	def __on_compute_node_result_begin(self):
-		pass
+		profile = self.__inc_view.profile
+		if profile is not None:
+			self.__compute_start_time = profile.clock()
 
-	def __on_compute_node_result_end(self):
-		pass
+	def __on_compute_node_result_end(self, content, present_time):
+		profile = self.__inc_view.profile
+		if profile is not None  and  self.__compute_start_time is not None:
+			# Include the time spent presenting the model on a worker thread, if the presentation was prefetched
+			compute_time = profile.clock() - self.__compute_start_time + present_time
+			profile._on_fragment_computed(self, compute_time, content, present_time)
+		self.__compute_start_time = None
 
 
 
@@ -617,7 +814,7 @@ class FragmentFactory (object):
 			return NotImplemented
 
 
-	def build_html_content_for_fragment(self, inc_view, fragment_view, model):
+	def present_fragment(self, fragment_view, model):
 		# Create the view fragment
 		try:
 			fragment_pres = self._perspective.present_object(model, fragment_view)
@@ -630,6 +827,13 @@ class FragmentFactory (object):
 		except Exception, e:
 			fragment_pres = _exception_during_presentation(present_exception_with_traceback(e, sys.exc_info()[1], sys.exc_info()[2]))
 
+		return fragment_pres
+
+
+	def build_html_content_for_fragment(self, inc_view, fragment_view, model, fragment_pres=None):
+		if fragment_pres is None:
+			fragment_pres = self.present_fragment(fragment_view, model)
+
 		try:
 			html_content = self.__pres_to_html_content(fragment_pres, fragment_view)
 		except Exception, e:
@@ -906,8 +1110,20 @@ class IncrementalView (object):
 
 
 
-	def __init__(self, subject, dynamic_page):
+	def __init__(self, subject, dynamic_page, refresh_pool=None):
+		"""
+		Constructor
+
+		:param subject: the subject to present
+		:param dynamic_page: the dynamic page that will display the presentation
+		:param refresh_pool: [optional] a worker pool with a map(fn, items) method, e.g. multiprocessing.pool.ThreadPool; when
+		given, the presentations of sibling fragments that require a refresh are computed in parallel. Presentation functions
+		will then be invoked on worker threads, so they should not modify shared state. The content of the page is still
+		built and updated on the refreshing thread.
+		"""
 		self._subject = subject
+		self.__refresh_pool = refresh_pool
+		self.__profile = None
 
 
 		self.__root_subtree = self.Subtree(self, subject.focus, subject.perspective)
@@ -958,6 +1174,56 @@ class IncrementalView (object):
 	def service(self):
 		return self.__dynamic_page.service
 
+	@property
+	def refresh_pool(self):
+		return self.__refresh_pool
+
+	@refresh_pool.setter
+	def refresh_pool(self, pool):
+		self.__refresh_pool = pool
+
+
+
+
+	#
+	#
+	# Profiling
+	#
+	#
+
+	@property
+	def profile(self):
+		"""
+		:return: the RefreshProfile that is gathering statistics, or None if profiling is not enabled
+		"""
+		return self.__profile
+
+
+	def enable_profiling(self, clock=None):
+		"""
+		Start gathering timings and counts as fragments are refreshed
+
+		Present the report obtained from the profile's report method to find the models whose presentations are the
+		most expensive to compute.
+
+		:param clock: [optional] a function that returns the current time in seconds; used if profiling is not already enabled. See RefreshProfile.
+		:return: the RefreshProfile that gathers the statistics
+		"""
+		if self.__profile is None:
+			self.__profile = RefreshProfile(clock)   if clock is not None   else RefreshProfile()
+		return self.__profile
+
+
+	def disable_profiling(self):
+		"""
+		Stop gathering statistics
+
+		:return: the RefreshProfile that gathered the statistics, or None if profiling was not enabled
+		"""
+		profile = self.__profile
+		self.__profile = None
+		return profile
+
 
 
 	def queue_task(self, task, priority=0):
@@ -970,6 +1236,14 @@ class IncrementalView (object):
 		self.__dynamic_page.queue_task(task, priority)
 
 
+	def clean(self):
+		"""
+		Dispose of fragments that are no longer in use. This is done at the end of each refresh; call it after discarding
+		content outside of a refresh (see _FragmentView.discard_content) to release the discarded fragments promptly.
+		"""
+		self._node_table.clean()
+
+
 
 
 	#
@@ -1049,11 +1323,13 @@ class IncrementalView (object):
 
 
 	def on_fragment_content_change_from(self, fragment_view, content):
-		pass
+		if self.__profile is not None:
+			self.__profile._on_subtree_refresh_begin(fragment_view)
 
 
 	def on_fragment_content_change_to(self, fragment_view, content):
-		pass
+		if self.__profile is not None:
+			self.__profile._on_subtree_refresh_end(fragment_view)
 
 
 
@@ -1068,3 +1344,140 @@ class IncrementalView (object):
 		invoke_inspector = self.subject.optional_attr('invoke_inspector')
 		if invoke_inspector is not None:
 			invoke_inspector(event, fragment)
+
+
+
+
+
+class Test_IncrementalView (unittest.TestCase):
+	class _Item (object):
+		def __init__(self, live, presented):
+			self.live = live
+			self.__presented = presented
+
+		def __present__(self, fragment):
+			self.__presented.append(self)
+			return Html('<span>{0}</span>'.format(self.live.value))
+
+
+	class _List (object):
+		def __init__(self, items):
+			self.items = items
+
+		def __present__(self, fragment):
+			return Html(*(['<div>'] + self.items + ['</div>']))
+
+
+	class _Pool (object):
+		# Presents the fragments on this thread, invoking on_map before returning the results
+		def __init__(self, on_map=None):
+			self.map_sizes = []
+			self.__on_map = on_map
+
+		def map(self, fn, items):
+			self.map_sizes.append(len(items))
+			results = [fn(x)   for x in items]
+			if self.__on_map is not None:
+				self.__on_map()
+			return results
+
+
+	def _view(self, values, refresh_pool=None, presented=None):
+		from larch.live import LiveValue
+		from larch.core.subject import Subject
+		self.presented = presented   if presented is not None   else []
+		self.lives = [LiveValue(v)   for v in values]
+		self.items = [self._Item(live, self.presented)   for live in self.lives]
+		page = DynamicPage(None, 'x')
+		IncrementalView(Subject(self._List(self.items)), page, refresh_pool=refresh_pool)
+		page.initial_content()
+		page.synchronize()
+		return page
+
+
+	@staticmethod
+	def _html(page):
+		return page.initial_content()[1]
+
+
+	def test_parallel_refresh(self):
+		from multiprocessing.pool import ThreadPool
+		pool = ThreadPool(2)
+		try:
+			results = []
+			for refresh_pool in [None, pool]:
+				page = self._view(range(4), refresh_pool)
+				self.lives[1].value = 10
+				self.lives[2].value = 20
+				client_messages, deps = page.synchronize()
+				# The segments in a change set are in no particular order
+				changes = [sorted(client_messages[0]['changes'][key])   for key in ['modified', 'initialise_scripts']]
+				results.append((len(client_messages), changes, self._html(page)))
+		finally:
+			pool.close()
+			pool.join()
+
+		# The output of a refresh on the pool is that of a serial refresh
+		self.assertEqual(results[0], results[1])
+		self.assertTrue('<span>20</span>' in results[1][2])
+
+
+	def test_profile_clock(self):
+		test = self
+		class _TimedList (list):
+			# Presenting an item takes 0.25s
+			def append(self, x):
+				test.now += 0.25
+				super(_TimedList, self).append(x)
+
+		self.now = 0.0
+		# Waiting for the pool takes 1s
+		pool = self._Pool(on_map=lambda: setattr(self, 'now', self.now + 1.0))
+		page = self._view(range(4), presented=_TimedList())
+		page.inc_view.refresh_pool = pool
+		profile = page.inc_view.enable_profiling(clock=lambda: self.now)
+		self.lives[1].value = 10
+		self.lives[2].value = 20
+		page.synchronize()
+		self.assertEqual([2], pool.map_sizes)
+
+		# All timings are taken from the profile's clock; the time spent waiting for the pool is replaced by the
+		# time taken to present the items on it
+		item_stats = profile.stats_by_model_type[self._Item]
+		self.assertEqual((2, 0.5), (item_stats.refresh_count, item_stats.compute_time))
+		self.assertEqual(0.5, profile.stats_by_model_type[self._List].subtree_time)
+
+
+	def test_stale_prefetch_discarded(self):
+		pool = self._Pool(on_map=lambda: setattr(self.lives[1], 'value', 99))
+		page = self._view(range(4))
+		page.inc_view.refresh_pool = pool
+		self.lives[1].value = 10
+		self.lives[2].value = 20
+		del self.presented[:]
+		page.synchronize()
+		self.assertEqual([2], pool.map_sizes)
+
+		# The value presented by the prefetch was changed before the fragment was refreshed, so it was presented again
+		self.assertEqual([self.items[1], self.items[2], self.items[1]], self.presented)
+		html = self._html(page)
+		self.assertTrue('<span>99</span>' in html)
+		self.assertFalse('<span>10</span>' in html)
+		self.assertTrue('<span>20</span>' in html)
+
+
+	def test_prefetch_accesses_replayed(self):
+		pool = self._Pool()
+		page = self._view(range(4))
+		page.inc_view.refresh_pool = pool
+		self.lives[1].value = 10
+		self.lives[2].value = 20
+		page.synchronize()
+		self.assertEqual([2], pool.map_sizes)
+
+		# The fragments depend upon the values accessed on the pool, so they are refreshed when they change
+		self.lives[2].value = 30
+		del self.presented[:]
+		page.synchronize()
+		self.assertEqual([self.items[2]], self.presented)
+		self.assertTrue('<span>30</span>' in self._html(page))
@@ -32,14 +32,15 @@ class ProjectionService (DynamicPageService):
 	"""
 
 
-	def __init__(self, front_page_model):
+	def __init__(self, front_page_model, **kwargs):
 		"""
 		Constructor
 
 		:param front_page_model - the front page
+		:param kwargs - view registry options passed to DynamicPageService (max_views, view_ttl, num_view_shards)
 		:return: ProjectionService instance
 		"""
-		super(ProjectionService, self).__init__()
+		super(ProjectionService, self).__init__(**kwargs)
 		self.__front_page_model = front_page_model
 
 
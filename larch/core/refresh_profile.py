@@ -0,0 +1,356 @@
+##-*************************
+##-* This program is free software; you can use it, redistribute it and/or
+##-* modify it under the terms of the GNU Affero General Public License
+##-* version 3 as published by the Free Software Foundation. The full text of
+##-* the GNU Affero General Public License version 3 can be found in the file
+##-* named 'LICENSE.txt' that accompanies this program. This source code is
+##-* (C)copyright Geoffrey French 2011-2014.
+##-*************************
+import weakref
+import unittest
+from timeit import default_timer
+
+from larch.pres.html import Html
+from larch.core.dynamicpage.segment import HtmlContent
+
+
+
+def html_content_size(content):
+	"""
+	Compute the size in bytes of the HTML source held directly by some HTML content. Referenced segments are not included.
+
+	:param content: an HtmlContent instance or None
+	:return: the size in bytes
+	"""
+	if content is None:
+		return 0
+	size = 0
+	stack = [content]
+	while len(stack) > 0:
+		for x in stack.pop():
+			if isinstance(x, str):
+				size += len(x)
+			elif isinstance(x, unicode):
+				size += len(x.encode('utf-8'))
+			elif isinstance(x, HtmlContent):
+				stack.append(x)
+	return size
+
+
+
+
+class RefreshStats (object):
+	"""
+	Refresh statistics, for a single fragment or accumulated over all fragments that present models of a given type
+
+	Attributes:
+		refresh_count - the number of times that the fragment content was computed
+		compute_time - the time spent computing fragment content, in seconds. Does not include the time taken to refresh child fragments.
+		max_compute_time - the longest time taken to compute fragment content
+		subtree_time - the time taken to refresh fragments, including their child fragments. Presentations computed on a refresh pool are counted by the time taken to compute them, as in compute_time, rather than the time spent waiting for them.
+		segments_created - the number of segments created
+		segments_destroyed - the number of segments destroyed
+		html_bytes - the size of the HTML source produced, not including that of child fragments
+	"""
+	def __init__(self, model_type):
+		self.model_type = model_type
+		self.refresh_count = 0
+		self.compute_time = 0.0
+		self.max_compute_time = 0.0
+		self.subtree_time = 0.0
+		self.segments_created = 0
+		self.segments_destroyed = 0
+		self.html_bytes = 0
+
+
+	@property
+	def model_type_name(self):
+		return self.model_type.__name__
+
+	@property
+	def mean_compute_time(self):
+		return self.compute_time / self.refresh_count   if self.refresh_count > 0   else 0.0
+
+
+	def _copy(self):
+		s = RefreshStats(self.model_type)
+		s.__dict__.update(self.__dict__)
+		return s
+
+
+	def __repr__(self):
+		return '<RefreshStats {0}: {1} refreshes, {2:.6f}s compute, {3:.6f}s subtree>'.format(self.model_type_name, self.refresh_count, self.compute_time, self.subtree_time)
+
+
+
+
+class RefreshProfileReport (object):
+	"""
+	A snapshot of a refresh profile. Present it to display a table of statistics for each model type, slowest first.
+	"""
+	_COLUMNS = [
+		('Model type', lambda s: Html.escape_str(s.model_type_name)),
+		('Refreshes', lambda s: str(s.refresh_count)),
+		('Compute (ms)', lambda s: '{0:.3f}'.format(s.compute_time * 1000.0)),
+		('Mean (ms)', lambda s: '{0:.3f}'.format(s.mean_compute_time * 1000.0)),
+		('Max (ms)', lambda s: '{0:.3f}'.format(s.max_compute_time * 1000.0)),
+		('Subtree (ms)', lambda s: '{0:.3f}'.format(s.subtree_time * 1000.0)),
+		('Segments created', lambda s: str(s.segments_created)),
+		('Segments destroyed', lambda s: str(s.segments_destroyed)),
+		('HTML bytes', lambda s: str(s.html_bytes)),
+	]
+
+
+	def __init__(self, stats):
+		self.stats = sorted(stats, key=lambda s: s.compute_time, reverse=True)
+
+
+	@property
+	def total_compute_time(self):
+		return sum([s.compute_time   for s in self.stats])
+
+	@property
+	def total_refresh_count(self):
+		return sum([s.refresh_count   for s in self.stats])
+
+
+	def __present__(self, fragment):
+		contents = ['<table class="larch_refresh_profile"><thead><tr>']
+		for title, _ in self._COLUMNS:
+			contents.append('<th>{0}</th>'.format(title))
+		contents.append('</tr></thead><tbody>')
+		for s in self.stats:
+			contents.append('<tr>')
+			for _, fmt in self._COLUMNS:
+				contents.append('<td>{0}</td>'.format(fmt(s)))
+			contents.append('</tr>')
+		contents.append('</tbody></table>')
+		return Html(*contents)
+
+
+
+
+class RefreshProfile (object):
+	"""
+	Refresh profile
+
+	Accumulates timings and counts for the fragments of an incremental view as they are refreshed.
+	Enable profiling with IncrementalView.enable_profiling.
+	"""
+	def __init__(self, clock=default_timer):
+		"""
+		Constructor
+
+		:param clock: [optional] a function that returns the current time in seconds
+		"""
+		self.__clock = clock
+		self.__stats_by_type = {}
+		self.__stats_by_fragment = weakref.WeakKeyDictionary()
+		self.__reset_timing()
+
+
+	@property
+	def clock(self):
+		"""
+		:return: the function that returns the current time in seconds, by which refreshes are timed
+		"""
+		return self.__clock
+
+
+	def reset(self):
+		"""
+		Discard the statistics gathered so far
+		"""
+		self.__stats_by_type = {}
+		self.__stats_by_fragment = weakref.WeakKeyDictionary()
+		self.__reset_timing()
+
+
+	@property
+	def stats_by_model_type(self):
+		"""
+		:return: a dictionary mapping model type to RefreshStats
+		"""
+		return dict(self.__stats_by_type)
+
+
+	def stats_for_fragment(self, fragment_view):
+		"""
+		Get the statistics gathered for a fragment
+
+		:param fragment_view: the fragment
+		:return: a RefreshStats instance or None if the fragment has not been refreshed while profiling
+		"""
+		return self.__stats_by_fragment.get(fragment_view)
+
+
+	def report(self):
+		"""
+		:return: a RefreshProfileReport that holds a snapshot of the statistics gathered so far
+		"""
+		return RefreshProfileReport([s._copy()   for s in self.__stats_by_type.values()])
+
+
+
+	def __stats(self, fragment_view):
+		model_type = type(fragment_view.model)
+		try:
+			type_stats = self.__stats_by_type[model_type]
+		except KeyError:
+			type_stats = self.__stats_by_type[model_type] = RefreshStats(model_type)
+		try:
+			frag_stats = self.__stats_by_fragment[fragment_view]
+		except KeyError:
+			frag_stats = self.__stats_by_fragment[fragment_view] = RefreshStats(model_type)
+		return type_stats, frag_stats
+
+
+	def __reset_timing(self):
+		# Entries of the form (start time, worker time at start, worker wait time at start) for each subtree being refreshed
+		self.__subtree_start_times = []
+		# Running totals of the time spent presenting fragments on a refresh pool, and the time spent waiting for them
+		self.__worker_time = 0.0
+		self.__worker_wait_time = 0.0
+
+
+
+	#
+	#
+	# Notifications from the incremental view
+	#
+	#
+
+	def _on_subtree_refresh_begin(self, fragment_view):
+		self.__subtree_start_times.append((self.__clock(), self.__worker_time, self.__worker_wait_time))
+
+	def _on_subtree_refresh_end(self, fragment_view):
+		# Profiling may have been enabled (or reset) part way through a refresh
+		if len(self.__subtree_start_times) > 0:
+			start, worker_time, worker_wait_time = self.__subtree_start_times.pop()
+			# Replace the time spent waiting for the refresh pool with the time taken to compute the presentations
+			t = self.__clock() - start - (self.__worker_wait_time - worker_wait_time) + (self.__worker_time - worker_time)
+			for s in self.__stats(fragment_view):
+				s.subtree_time += t
+
+
+	def _on_presentations_prefetched(self, wait_time):
+		self.__worker_wait_time += wait_time
+
+
+	def _on_fragment_computed(self, fragment_view, compute_time, content, worker_time=0.0):
+		# worker_time is the part of compute_time that was spent on a refresh pool
+		self.__worker_time += worker_time
+		html_bytes = html_content_size(content)
+		for s in self.__stats(fragment_view):
+			s.refresh_count += 1
+			s.compute_time += compute_time
+			s.max_compute_time = max(s.max_compute_time, compute_time)
+			s.html_bytes += html_bytes
+
+
+	def _on_segments_created(self, fragment_view, n):
+		for s in self.__stats(fragment_view):
+			s.segments_created += n
+
+	def _on_segments_destroyed(self, fragment_view, n):
+		for s in self.__stats(fragment_view):
+			s.segments_destroyed += n
+
+
+
+
+
+class Test_RefreshProfile (unittest.TestCase):
+	class _Fragment (object):
+		def __init__(self, model):
+			self.model = model
+
+	class _A (object):
+		pass
+
+	class _B (object):
+		pass
+
+
+	def test_html_content_size(self):
+		self.assertEqual(0, html_content_size(None))
+		self.assertEqual(10, html_content_size(HtmlContent(['<b>', HtmlContent(['x', u'\xe9']), '</b>'])))
+
+
+	def test_profile(self):
+		p = RefreshProfile()
+		a1 = self._Fragment(self._A())
+		a2 = self._Fragment(self._A())
+		b = self._Fragment(self._B())
+
+		p._on_segments_created(a1, 1)
+		p._on_fragment_computed(a1, 0.5, HtmlContent(['abc']))
+		p._on_fragment_computed(a2, 0.25, HtmlContent(['de']))
+		p._on_fragment_computed(a1, 0.125, None)
+		p._on_fragment_computed(b, 1.0, HtmlContent([]))
+		p._on_segments_destroyed(b, 2)
+
+		a_stats = p.stats_by_model_type[self._A]
+		self.assertEqual(3, a_stats.refresh_count)
+		self.assertEqual(0.875, a_stats.compute_time)
+		self.assertEqual(0.5, a_stats.max_compute_time)
+		self.assertEqual(5, a_stats.html_bytes)
+		self.assertEqual(1, a_stats.segments_created)
+
+		a1_stats = p.stats_for_fragment(a1)
+		self.assertEqual(2, a1_stats.refresh_count)
+		self.assertEqual(0.625, a1_stats.compute_time)
+		self.assertEqual(0.3125, a1_stats.mean_compute_time)
+
+		report = p.report()
+		self.assertEqual([self._B, self._A], [s.model_type   for s in report.stats])
+		self.assertEqual(2, report.stats[0].segments_destroyed)
+		self.assertEqual(4, report.total_refresh_count)
+
+		p.reset()
+		self.assertEqual({}, p.stats_by_model_type)
+		self.assertIsNone(p.stats_for_fragment(a1))
+		# The report is a snapshot
+		self.assertEqual(4, report.total_refresh_count)
+
+
+	def test_subtree_time(self):
+		self.now = 0.0
+		p = RefreshProfile(clock=lambda: self.now)
+		a = self._Fragment(self._A())
+		b = self._Fragment(self._B())
+
+		p._on_subtree_refresh_begin(a)
+		# The presentation of b is computed on a refresh pool in 0.75s, while a waits for 0.5s
+		self.now = 0.5
+		p._on_presentations_prefetched(0.5)
+		p._on_subtree_refresh_begin(b)
+		self.now = 0.625
+		p._on_fragment_computed(b, 0.875, None, worker_time=0.75)
+		p._on_subtree_refresh_end(b)
+		self.now = 1.0
+		p._on_subtree_refresh_end(a)
+
+		self.assertEqual(0.875, p.stats_for_fragment(b).compute_time)
+		self.assertEqual(0.875, p.stats_for_fragment(b).subtree_time)
+		self.assertEqual(1.25, p.stats_for_fragment(a).subtree_time)
+
+
+	def test_reset_during_refresh(self):
+		self.now = 0.0
+		p = RefreshProfile(clock=lambda: self.now)
+		a = self._Fragment(self._A())
+		b = self._Fragment(self._B())
+		p._on_subtree_refresh_begin(a)
+		p._on_subtree_refresh_begin(b)
+		p.reset()
+		self.now = 1.0
+		p._on_subtree_refresh_end(b)
+		p._on_subtree_refresh_end(a)
+		self.assertEqual({}, p.stats_by_model_type)
+
+		# Subtrees that begin after the reset are timed
+		p._on_subtree_refresh_begin(a)
+		self.now = 1.5
+		p._on_subtree_refresh_end(a)
+		self.assertEqual(0.5, p.stats_for_fragment(a).subtree_time)
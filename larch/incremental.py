@@ -7,6 +7,7 @@
 ##-* (C)copyright Geoffrey French 2011-2014.
 ##-*************************
 import weakref
+import threading
 import unittest
 import gc
 
@@ -17,13 +18,143 @@ class IncrementalEvaluationCycleError (Exception):
 
 
 
+class _IncrementalThreadState (threading.local):
+	def __init__(self):
+		self.current_computation = None
+		self.current_transaction = None
+
+
+# The computation whose dependencies are being tracked and the open change transaction are per-thread
+_thread_state = _IncrementalThreadState()
+
+# Guards mutation of the dependency graph; the edges, the monitor ID table and the revision counter
+_graph_lock = threading.RLock()
+
+# Notified when a function monitor finishes refreshing, waking threads that are waiting to refresh it
+_refresh_finished = threading.Condition(_graph_lock)
+
+
+
+class _ListenerTable (object):
+	"""
+	The listeners of a monitor, in the order in which they were added
+
+	A dictionary maps the key of each listener to its entry, so adding, removing and testing for a listener are O(1);
+	bound methods are keyed by their object and function, so that equal bound methods share an entry. Removed entries
+	are marked as dead and dropped from the ordered list of entries when most of it is dead.
+
+	A listener may be held weakly, in which case it is removed when it is garbage collected; for a bound method the
+	object is held weakly.
+	"""
+	__slots__ = ['_key_to_entry', '_entries', '__weakref__']
+
+	def __init__(self):
+		self._key_to_entry = {}
+		# Entries are lists of the form [alive, key, listener, weak_ref]; for a weakly held listener, listener is None,
+		# or the function of a bound method
+		self._entries = []
+
+
+	def add(self, listener, weak):
+		key = _ListenerTable._key(listener)
+		if key in self._key_to_entry:
+			return
+		if weak:
+			table_ref = weakref.ref(self)
+			def on_collected(r):
+				table = table_ref()
+				if table is not None:
+					table.remove_key(key)
+			if getattr(listener, 'im_self', None) is not None:
+				entry = [True, key, listener.im_func, weakref.ref(listener.im_self, on_collected)]
+			else:
+				entry = [True, key, None, weakref.ref(listener, on_collected)]
+		else:
+			entry = [True, key, listener, None]
+		self._key_to_entry[key] = entry
+		self._entries.append(entry)
+
+
+	def remove(self, listener):
+		self.remove_key(_ListenerTable._key(listener))
+
+
+	def remove_key(self, key):
+		entry = self._key_to_entry.pop(key, None)
+		if entry is not None:
+			entry[0] = False
+			if len(self._entries) > 8  and  len(self._entries) > 2 * len(self._key_to_entry):
+				self._entries = [e   for e in self._entries   if e[0]]
+
+
+	def __contains__(self, listener):
+		return _ListenerTable._key(listener) in self._key_to_entry
+
+
+	def __len__(self):
+		return len(self._key_to_entry)
+
+
+	def __iter__(self):
+		# Iterate over a snapshot, so that listeners may be added or removed by listeners
+		for entry in list(self._entries):
+			if entry[0]:
+				listener = _ListenerTable._resolve(entry)
+				if listener is not None:
+					yield listener
+
+
+	@staticmethod
+	def _key(listener):
+		im_self = getattr(listener, 'im_self', None)
+		if im_self is not None:
+			return id(im_self), id(listener.im_func)
+		else:
+			return id(listener)
+
+
+	@staticmethod
+	def _resolve(entry):
+		weak_ref = entry[3]
+		if weak_ref is None:
+			return entry[2]
+		x = weak_ref()
+		if x is None:
+			return None
+		elif entry[2] is not None:
+			# Bound method; re-bind the function to the object
+			return entry[2].__get__(x, type(x))
+		else:
+			return x
+
+
+
+
 class IncrementalMonitor (object):
+	"""Incremental Monitor
+
+	Outgoing dependency edges are stored compactly; a monitor is assigned an integer ID when it first takes part in a
+	dependency, and outgoing edges refer to monitors by ID. IDs are resolved through a single table of weak references, so
+	a monitor does not keep the monitors that depend on it alive, and edges to monitors that have been garbage collected are
+	discarded when they are next visited. Incoming edges (see IncrementalFunctionMonitor) refer to monitors directly, so
+	a function monitor keeps the monitors that it depends on alive, as they must be able to notify it of changes.
+
+	Thread safety:
+	The computation whose dependencies are being tracked and the open change transaction (see batch) are stored per-thread,
+	so separate threads can refresh separate computations concurrently. Changes to the dependency graph are made while
+	holding a lock. A given monitor should only be refreshed by one thread at a time.
+	"""
+	__slots__ = ['_owner', '_incremental_state', '_outgoing_dependencies', '_listeners', '_changed_revision', '_monitor_id', '__weakref__']
+
 	UNINITIALISED = 'UNINITIALISED'
 	REFRESH_REQUIRED = 'REFRESH_REQUIRED'
 	REFRESH_NOT_REQUIRED = 'REFRESH_NOT_REQUIRED'
 
 
-	_current_computation = None
+	_revision = 0
+
+	_monitor_id_counter = 0
+	_monitor_table = weakref.WeakValueDictionary()
 
 
 	def __init__(self, owner=None):
@@ -31,44 +162,50 @@ class IncrementalMonitor (object):
 		self._incremental_state = IncrementalMonitor.UNINITIALISED
 		self._outgoing_dependencies = None
 		self._listeners = None
+		self._changed_revision = 0
+		self._monitor_id = None
 
 
 
 	owner = property(lambda self: self._owner)
+	refresh_required = property(lambda self: self._incremental_state != IncrementalMonitor.REFRESH_NOT_REQUIRED)
 	has_listeners = property(lambda self: (self._listeners is not None  and  len(self._listeners) > 0))
-	outgoing_dependences = property(lambda self: (set(self._outgoing_dependencies.keys())   if self._outgoing_dependencies is not None   else set()))
-	has_outgoing_dependences = property(lambda self: (self._outgoing_dependencies is not None  and  len(self._outgoing_dependencies) > 0))
+	outgoing_dependences = property(lambda self: set(self._outgoing_dependency_monitors()))
+	has_outgoing_dependences = property(lambda self: len(self._outgoing_dependency_monitors()) > 0)
 
 
 
-	def add_listener(self, listener):
+	def add_listener(self, listener, weak=False):
+		"""
+		Add a listener, invoked when the monitor changes. Adding a listener that is already present has no effect.
+
+		:param listener: a function of the form function(monitor)
+		:param weak: [optional] if True, the listener is held by a weak reference (the object of a bound method is held weakly), and is removed once it has been garbage collected
+		"""
 		if self._listeners is None:
-			self._listeners = []
-		if listener in self._listeners:
-			return
-		self._listeners.append(listener)
+			self._listeners = _ListenerTable()
+		self._listeners.add(listener, weak)
 
 	def remove_listener(self, listener):
 		if self._listeners is not None:
-			try:
-				self._listeners.remove(listener)
-			except ValueError:
-				pass
+			self._listeners.remove(listener)
 
 
 
 	def _on_value_access(self):
-		if IncrementalMonitor._current_computation is not None:
-			IncrementalMonitor._current_computation._on_incoming_dependency_access(self)
+		current_computation = _thread_state.current_computation
+		if current_computation is not None:
+			current_computation._on_incoming_dependency_access(self)
 
 	def _notify_changed(self):
-		if self._incremental_state != IncrementalMonitor.REFRESH_REQUIRED:
-			self._incremental_state = IncrementalMonitor.REFRESH_REQUIRED
-			self._emit_changed()
-
-			if self._outgoing_dependencies is not None:
-				for dep in self._outgoing_dependencies.keys():
-					dep._notify_changed()
+		transaction = _thread_state.current_transaction
+		if transaction is not None:
+			# A transaction is open; its listeners will be notified when it finishes
+			transaction._invalidate(self)
+		else:
+			transaction = _ChangeTransaction()
+			transaction._invalidate(self)
+			transaction._finish()
 
 	def _notify_refreshed(self):
 		self._incremental_state = IncrementalMonitor.REFRESH_NOT_REQUIRED
@@ -80,15 +217,22 @@ class IncrementalMonitor (object):
 				listener(self)
 
 
+	@staticmethod
+	def _next_revision():
+		with _graph_lock:
+			IncrementalMonitor._revision += 1
+			return IncrementalMonitor._revision
+
+
 	@staticmethod
 	def _push_current_computation(computation):
-		f = IncrementalMonitor._current_computation
-		IncrementalMonitor._current_computation = computation
+		f = _thread_state.current_computation
+		_thread_state.current_computation = computation
 		return f
 
 	@staticmethod
 	def _pop_current_computation(prev_computation):
-		IncrementalMonitor._current_computation = prev_computation
+		_thread_state.current_computation = prev_computation
 
 
 
@@ -102,18 +246,169 @@ class IncrementalMonitor (object):
 
 
 
+	def _get_monitor_id(self):
+		if self._monitor_id is None:
+			with _graph_lock:
+				if self._monitor_id is None:
+					IncrementalMonitor._monitor_id_counter += 1
+					monitor_id = IncrementalMonitor._monitor_id_counter
+					IncrementalMonitor._monitor_table[monitor_id] = self
+					self._monitor_id = monitor_id
+		return self._monitor_id
+
+
 	def _add_outgoing_dependency(self, dep):
-		if self._outgoing_dependencies is None:
-			self._outgoing_dependencies = weakref.WeakKeyDictionary()
-		self._outgoing_dependencies[dep] = None
+		with _graph_lock:
+			if self._outgoing_dependencies is None:
+				self._outgoing_dependencies = set()
+			self._outgoing_dependencies.add(dep._get_monitor_id())
 
 	def _remove_outgoing_dependency(self, dep):
-		if self._outgoing_dependencies is not None:
-			del self._outgoing_dependencies[dep]
-			if len(self._outgoing_dependencies) == 0:
-				self._outgoing_dependencies = None
-		else:
-			raise KeyError
+		with _graph_lock:
+			if self._outgoing_dependencies is not None:
+				self._outgoing_dependencies.remove(dep._get_monitor_id())
+				if len(self._outgoing_dependencies) == 0:
+					self._outgoing_dependencies = None
+			else:
+				raise KeyError
+
+
+	def _outgoing_dependency_monitors(self):
+		with _graph_lock:
+			if self._outgoing_dependencies is None:
+				return []
+			monitors = []
+			dead_ids = None
+			table = IncrementalMonitor._monitor_table
+			for dep_id in self._outgoing_dependencies:
+				dep = table.get(dep_id)
+				if dep is not None:
+					monitors.append(dep)
+				else:
+					if dead_ids is None:
+						dead_ids = []
+					dead_ids.append(dep_id)
+			if dead_ids is not None:
+				self._outgoing_dependencies.difference_update(dead_ids)
+				if len(self._outgoing_dependencies) == 0:
+					self._outgoing_dependencies = None
+			return monitors
+
+
+
+
+
+
+class _ChangeTransaction (object):
+	"""Change transaction
+
+	Propagates invalidation through the dependency graph. Monitors are invalidated by walking the outgoing dependencies
+	iteratively, so deep chains of dependencies do not exhaust the stack and shared sub-graphs are only visited once.
+
+	The listeners of the monitors that were invalidated are notified when the transaction finishes; each monitor is
+	notified once, in order of topological height, so that a monitor is notified after all of the invalidated monitors
+	that it depends upon.
+	"""
+	def __init__(self):
+		self.__dirty = []
+		self.__dirty_set = set()
+
+
+	def _invalidate(self, monitor):
+		with _graph_lock:
+			stack = [monitor]
+			while len(stack) > 0:
+				m = stack.pop()
+				if m._incremental_state != IncrementalMonitor.REFRESH_REQUIRED:
+					m._incremental_state = IncrementalMonitor.REFRESH_REQUIRED
+					if m not in self.__dirty_set:
+						self.__dirty_set.add(m)
+						self.__dirty.append(m)
+
+					stack.extend(m._outgoing_dependency_monitors())
+
+
+	def _finish(self):
+		with _graph_lock:
+			ordered = self.__order_by_height()
+		# Notify listeners without holding the lock; they may refresh computations
+		for m in ordered:
+			m._emit_changed()
+		self.__dirty = []
+		self.__dirty_set = set()
+
+
+	def __order_by_height(self):
+		dirty = self.__dirty
+		dirty_set = self.__dirty_set
+
+		# Count the incoming edges that each invalidated monitor receives from other invalidated monitors
+		in_degree = dict.fromkeys(dirty, 0)
+		outgoing = {}
+		for m in dirty:
+			deps = [dep   for dep in m._outgoing_dependency_monitors()   if dep in dirty_set]
+			outgoing[m] = deps
+			for dep in deps:
+				in_degree[dep] += 1
+
+		# Visit the sub-graph level by level
+		ordered = []
+		level = [m   for m in dirty   if in_degree[m] == 0]
+		while len(level) > 0:
+			ordered.extend(level)
+			next_level = []
+			for m in level:
+				for dep in outgoing[m]:
+					in_degree[dep] -= 1
+					if in_degree[dep] == 0:
+						next_level.append(dep)
+			level = next_level
+
+		if len(ordered) < len(dirty):
+			# The dependency graph should be acyclic; don't drop any monitors if it is not
+			ordered.extend([m   for m in dirty   if in_degree[m] > 0])
+
+		return ordered
+
+
+
+
+
+
+class batch (object):
+	"""Change batch
+
+	A context manager that groups changes into a single transaction:
+
+		with batch():
+			for live, v in zip(lives, values):
+				live.value = v
+
+	Monitors are still invalidated as soon as they are changed, so values read within the block are up to date, but
+	the listeners of the invalidated monitors are notified once, when the outermost batch exits. Changing the same
+	monitor repeatedly within a batch costs a single notification.
+
+	Batches may be nested; inner batches join the transaction opened by the outermost batch. Transactions are per-thread;
+	changes made by other threads while a batch is open are not deferred.
+	"""
+	def __init__(self):
+		self.__is_outermost = False
+
+
+	def __enter__(self):
+		if _thread_state.current_transaction is None:
+			_thread_state.current_transaction = _ChangeTransaction()
+			self.__is_outermost = True
+		return self
+
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if self.__is_outermost:
+			self.__is_outermost = False
+			transaction = _thread_state.current_transaction
+			_thread_state.current_transaction = None
+			transaction._finish()
+		return False
 
 
 
@@ -121,11 +416,14 @@ class IncrementalMonitor (object):
 
 
 class IncrementalValueMonitor (IncrementalMonitor):
+	__slots__ = []
+
 	def on_access(self):
 		self._notify_refreshed()
 		self._on_value_access()
 
 	def on_changed(self):
+		self._changed_revision = IncrementalMonitor._next_revision()
 		self._notify_changed()
 
 
@@ -153,71 +451,156 @@ class IncrementalFunctionMonitor (IncrementalMonitor):
 					value_cache = evaluate_function()
 			finally:
 				inc_fn_mon.on_refresh_end(refresh_state)
+
+
+	Incoming dependencies are held in a dictionary that maps each monitor to the epoch of the refresh in which it was
+	accessed. Accessing a dependency
+	for the first time connects it straight away; dependencies that were not accessed during a refresh carry the stamp of
+	an older epoch and are disconnected when the refresh ends. There is no need to build a new set of dependencies and
+	compare it with the previous one on each refresh.
+
+
+	Early cutoff:
+		Provide a refresh function to the constructor and pass value_changed=False to on_refresh_end when the
+		re-computed value is equal to the previous one. A monitor that was invalidated only because monitors with
+		early cutoff were invalidated will first bring them up to date; if none of their values changed, it is restored
+		to a clean state and on_refresh_begin returns None, so that its value is not re-computed.
+
+
+	Threads:
+		If a thread calls on_refresh_begin while another thread is refreshing the same monitor, it waits for that
+		refresh to finish, after which it will usually find that no refresh is required. Re-entering the refresh of
+		a monitor on the same thread is a cycle and raises IncrementalEvaluationCycleError.
 	"""
-	_FLAG_CYCLE_LOCK = 0x1
 	_FLAG_BLOCK_INCOMING_DEPENDENCIES = 0x2
+	_FLAG_CHANGED = 0x4
 
-	def __init__(self, owner=None):
+	__slots__ = ['_incoming_dependencies', '_refresh_fn', '_refresh_revision', '_refresh_thread', '_epoch', '__flags']
+
+	def __init__(self, owner=None, refresh_fn=None):
+		"""
+		Constructor
+
+		:param owner: [optional] the object that owns this monitor
+		:param refresh_fn: [optional] a function of the form function() that brings the monitored value up to date; enables early cutoff
+		"""
 		super(IncrementalFunctionMonitor, self).__init__(owner)
 		self._incoming_dependencies = None
+		self._refresh_fn = refresh_fn
+		self._refresh_revision = None
+		self._refresh_thread = None
+		self._epoch = 0
 		self.__flags = 0
 
 
-	incoming_dependencies = property(lambda self: (self._incoming_dependencies   if self._incoming_dependencies is not None   else set()))
+	incoming_dependencies = property(lambda self: set(self._incoming_dependency_monitors()))
 
 
 	def on_access(self):
 		self._on_value_access()
 
 	def on_changed(self):
+		self.__set_flag(self._FLAG_CHANGED)
+		self._changed_revision = IncrementalMonitor._next_revision()
 		self._notify_changed()
 
 	def block_and_clear_incoming_dependencies(self):
 		self.__set_flag(self._FLAG_BLOCK_INCOMING_DEPENDENCIES)
-		self._incoming_dependencies = None
+		with _graph_lock:
+			if self._incoming_dependencies is not None:
+				for inc in self._incoming_dependencies:
+					inc._remove_outgoing_dependency(self)
+			self._incoming_dependencies = None
 
 
 	def on_refresh_begin(self):
-		if self.__test_flag(self._FLAG_CYCLE_LOCK):
-			raise IncrementalEvaluationCycleError
+		current_thread = threading.current_thread()
+		with _graph_lock:
+			while self._refresh_thread is not None:
+				if self._refresh_thread is current_thread:
+					raise IncrementalEvaluationCycleError
+				# Another thread is refreshing this monitor; wait for it to finish
+				_refresh_finished.wait()
+			self._refresh_thread = current_thread
 
 		self.__clear_flag(self._FLAG_BLOCK_INCOMING_DEPENDENCIES)
-		self.__set_flag(self._FLAG_CYCLE_LOCK)
+
+		if self._incremental_state == IncrementalMonitor.REFRESH_REQUIRED  and  self.__incoming_dependencies_unchanged():
+			# Early cutoff; none of the values that this monitor depends upon have changed
+			self._incremental_state = IncrementalMonitor.REFRESH_NOT_REQUIRED
 
 		if self._incremental_state != IncrementalMonitor.REFRESH_NOT_REQUIRED:
+			refresh_revision = IncrementalMonitor._revision
+			self._epoch += 1
+
 			# Push current computation
 			old_computation = IncrementalMonitor._push_current_computation(self)
 
-			refresh_state = old_computation, self._incoming_dependencies
-			self._incoming_dependencies = None
-			return refresh_state
+			return old_computation, refresh_revision
 		else:
 			return None
 
 
-	def on_refresh_end(self, refresh_state):
+	def on_refresh_end(self, refresh_state, value_changed=True):
+		"""
+		Notify the end of a refresh
+
+		:param refresh_state: the refresh state returned by on_refresh_begin
+		:param value_changed: [optional] pass False if the re-computed value is equal to the previous value
+		"""
 		if self._incremental_state != IncrementalMonitor.REFRESH_NOT_REQUIRED:
-			old_computation, prev_incoming_dependencies = refresh_state
+			old_computation, refresh_revision = refresh_state
 
 			# Restore current computation
 			IncrementalMonitor._pop_current_computation(old_computation)
 
-			# Disconnect the dependencies that are being removed
-			if prev_incoming_dependencies is not None:
-				for inc in prev_incoming_dependencies:
-					if self._incoming_dependencies is None  or  inc not in self._incoming_dependencies:
-						inc._remove_outgoing_dependency(self)
-
-			# Connect new dependencies
-			if self._incoming_dependencies is not None:
-				for inc in self._incoming_dependencies:
-					if prev_incoming_dependencies is None  or  inc not in prev_incoming_dependencies:
-						inc._add_outgoing_dependency(self)
-
+			# Disconnect the dependencies that were not accessed during this refresh
+			incoming = self._incoming_dependencies
+			if incoming is not None:
+				epoch = self._epoch
+				stale = [inc   for inc, inc_epoch in incoming.iteritems()   if inc_epoch != epoch]
+				if len(stale) > 0:
+					with _graph_lock:
+						for inc in stale:
+							del incoming[inc]
+							inc._remove_outgoing_dependency(self)
+						if len(incoming) == 0:
+							self._incoming_dependencies = None
+
+
+			self._refresh_revision = refresh_revision
+			if value_changed  or  self.__test_flag(self._FLAG_CHANGED):
+				self._changed_revision = refresh_revision
+			self.__clear_flag(self._FLAG_CHANGED)
 
 			self._incremental_state = IncrementalMonitor.REFRESH_NOT_REQUIRED
 
-		self.__clear_flag(self._FLAG_CYCLE_LOCK)
+		with _graph_lock:
+			self._refresh_thread = None
+			_refresh_finished.notify_all()
+
+
+	def __incoming_dependencies_unchanged(self):
+		if self._refresh_revision is None  or  self._incoming_dependencies is None  or  self.__test_flag(self._FLAG_CHANGED):
+			return False
+
+		for dep in list(self._incoming_dependencies):
+			if dep._incremental_state != IncrementalMonitor.REFRESH_NOT_REQUIRED  and  isinstance(dep, IncrementalFunctionMonitor):
+				# The dependency may or may not have changed; we can only find out if it supports early cutoff
+				if dep._refresh_fn is None:
+					return False
+				try:
+					dep._refresh_fn()
+				except Exception:
+					# Leave the dependency invalidated, so that the exception is raised again when this monitor is
+					# re-computed
+					dep._incremental_state = IncrementalMonitor.REFRESH_REQUIRED
+					return False
+				if dep._incremental_state != IncrementalMonitor.REFRESH_NOT_REQUIRED:
+					return False
+			if dep._changed_revision > self._refresh_revision:
+				return False
+		return True
 
 
 	def _on_incoming_dependency_access(self, inc):
@@ -226,9 +609,19 @@ class IncrementalFunctionMonitor (IncrementalMonitor):
 
 	def _add_incoming_dependency(self, dep):
 		if not self.__test_flag(self._FLAG_BLOCK_INCOMING_DEPENDENCIES):
-			if self._incoming_dependencies is None:
-				self._incoming_dependencies = set()
-			self._incoming_dependencies.add(dep)
+			incoming = self._incoming_dependencies
+			if incoming is None:
+				incoming = self._incoming_dependencies = {}
+			if dep not in incoming:
+				# New dependency; connect it
+				dep._add_outgoing_dependency(self)
+			incoming[dep] = self._epoch
+
+
+	def _incoming_dependency_monitors(self):
+		if self._incoming_dependencies is None:
+			return []
+		return list(self._incoming_dependencies)
 
 
 
@@ -279,7 +672,7 @@ class Test_IncrementalMonitor (unittest.TestCase):
 	@staticmethod
 	def _get_listeners(inc):
 		if inc._listeners is not None:
-			return inc._listeners
+			return list(inc._listeners)
 		else:
 			return []
 
@@ -321,6 +714,35 @@ class Test_IncrementalMonitor (unittest.TestCase):
 		self.assertFalse(inc.has_listeners)
 
 
+	def test_weak_listeners(self):
+		class Receiver (object):
+			def __init__(self):
+				self.count = 0
+
+			def on_change(self, inc):
+				self.count += 1
+
+		inc = IncrementalValueMonitor()
+		r = Receiver()
+		l1 = self.signal_counter()
+		l2 = self.signal_counter()
+		inc.add_listener(r.on_change, weak=True)
+		inc.add_listener(r.on_change, weak=True)
+		inc.add_listener(l1, weak=True)
+		inc.add_listener(l2)
+		self.assertTrue(r.on_change in inc._listeners)
+		self.assertEqual(3, len(self._get_listeners(inc)))
+
+		inc.on_access()
+		inc.on_changed()
+		self.assertEqual((1, 1, 1), (r.count, l1.count, l2.count))
+
+		del r, l1
+		gc.collect()
+		self.assertEqual([l2], self._get_listeners(inc))
+		inc.remove_listener(l2)
+		self.assertFalse(inc.has_listeners)
+
 
 
 
@@ -347,6 +769,56 @@ class Test_IncrementalValueMonitor (Test_IncrementalMonitor):
 
 
 
+class Test_batch (Test_IncrementalMonitor):
+	def test_batch(self):
+		inc1 = IncrementalValueMonitor()
+		inc2 = IncrementalFunctionMonitor()
+
+		l1 = self.signal_counter()
+		l2 = self.signal_counter()
+		inc1.add_listener(l1)
+		inc2.add_listener(l2)
+
+		rs2 = inc2.on_refresh_begin()
+		inc1.on_access()
+		inc2.on_refresh_end( rs2 )
+
+		with batch():
+			for i in xrange(10):
+				inc1.on_access()
+				inc1.on_changed()
+			self.assertEqual(0, l1.count)
+			self.assertEqual(0, l2.count)
+
+			with batch():
+				inc1.on_changed()
+
+			self.assertEqual(0, l1.count)
+			self.assertEqual(0, l2.count)
+
+		self.assertEqual(1, l1.count)
+		self.assertEqual(1, l2.count)
+		self.assertIsNone(_thread_state.current_transaction)
+
+
+	def test_batch_exception(self):
+		inc1 = IncrementalValueMonitor()
+		l1 = self.signal_counter()
+		inc1.add_listener(l1)
+
+		def _changes():
+			with batch():
+				inc1.on_changed()
+				raise ValueError
+
+		self.assertRaises(ValueError, _changes)
+		self.assertEqual(1, l1.count)
+		self.assertIsNone(_thread_state.current_transaction)
+
+
+
+
+
 class Test_IncrementalFunctionMonitor (Test_IncrementalMonitor):
 	def test_listener(self):
 		counter = self.signal_counter()
@@ -505,6 +977,51 @@ class Test_IncrementalFunctionMonitor (Test_IncrementalMonitor):
 
 
 
+	def test_diamond(self):
+		inc1 = IncrementalValueMonitor()
+		inc2 = IncrementalFunctionMonitor()
+		inc3 = IncrementalFunctionMonitor()
+		inc4 = IncrementalFunctionMonitor()
+
+		order = []
+		inc1.add_listener(lambda inc: order.append(1))
+		inc2.add_listener(lambda inc: order.append(2))
+		inc3.add_listener(lambda inc: order.append(3))
+		inc4.add_listener(lambda inc: order.append(4))
+
+		rs2 = inc2.on_refresh_begin()
+		inc1.on_access()
+		inc2.on_refresh_end( rs2 )
+		rs3 = inc3.on_refresh_begin()
+		inc2.on_access()
+		inc3.on_refresh_end( rs3 )
+		rs4 = inc4.on_refresh_begin()
+		inc1.on_access()
+		inc3.on_access()
+		inc4.on_refresh_end( rs4 )
+
+		inc1.on_changed()
+		self.assertEqual([1, 2, 3, 4], order)
+
+
+
+	def test_deep_chain(self):
+		incs = [IncrementalValueMonitor()]
+		for i in xrange(5000):
+			inc = IncrementalFunctionMonitor()
+			rs = inc.on_refresh_begin()
+			incs[-1].on_access()
+			inc.on_refresh_end( rs )
+			incs.append(inc)
+
+		l = self.signal_counter()
+		incs[-1].add_listener(l)
+
+		incs[0].on_changed()
+		self.assertEqual(1, l.count)
+
+
+
 	def test_cycle(self):
 		inc1 = IncrementalFunctionMonitor()
 
@@ -587,3 +1104,116 @@ class Test_IncrementalFunctionMonitor (Test_IncrementalMonitor):
 		self.assertEqual({inc1}, inc2.incoming_dependencies )
 		self.assertEqual({inc2}, inc3.incoming_dependencies )
 
+
+
+	def test_dead_dependent_edges(self):
+		inc1 = IncrementalValueMonitor()
+		inc2 = IncrementalFunctionMonitor()
+
+		rs2 = inc2.on_refresh_begin()
+		inc1.on_access()
+		inc2.on_refresh_end( rs2 )
+		self.assertEqual({inc2}, inc1.outgoing_dependences )
+
+		del inc2
+		del rs2
+		gc.collect()
+
+		# Edges to collected monitors are discarded
+		self.assertEqual(set(), inc1.outgoing_dependences )
+		self.assertFalse(inc1.has_outgoing_dependences )
+		inc1.on_changed()
+
+
+	def test_dependencies_kept_alive(self):
+		# A monitor that is only referenced by the monitor that depends on it must not be collected, else changes
+		# would no longer reach the dependent
+		inc1 = IncrementalValueMonitor()
+		inc3 = IncrementalFunctionMonitor()
+
+		rs3 = inc3.on_refresh_begin()
+		inc2 = IncrementalFunctionMonitor()
+		rs2 = inc2.on_refresh_begin()
+		inc1.on_access()
+		inc2.on_refresh_end( rs2 )
+		inc2.on_access()
+		inc3.on_refresh_end( rs3 )
+		inc2_ref = weakref.ref(inc2)
+		del inc2
+		gc.collect()
+
+		self.assertTrue(inc2_ref() is not None)
+		self.assertFalse(inc3.refresh_required)
+		inc1.on_changed()
+		self.assertTrue(inc3.refresh_required)
+
+
+	def test_block_and_clear_incoming_dependencies(self):
+		inc1 = IncrementalValueMonitor()
+		inc2 = IncrementalFunctionMonitor()
+
+		rs2 = inc2.on_refresh_begin()
+		inc1.on_access()
+		inc2.on_refresh_end( rs2 )
+		self.assertEqual({inc2}, inc1.outgoing_dependences )
+
+		inc2.block_and_clear_incoming_dependencies()
+		self.assertEqual(set(), inc1.outgoing_dependences )
+		self.assertEqual(set(), inc2.incoming_dependencies )
+
+
+	def test_threads(self):
+		# Interleave the refreshes of two computations on separate threads; each must only pick up the dependencies
+		# that were accessed on its own thread
+		inc1 = IncrementalValueMonitor()
+		inc2 = IncrementalValueMonitor()
+		f1 = IncrementalFunctionMonitor()
+		f2 = IncrementalFunctionMonitor()
+
+		begun = threading.Event()
+		accessed = threading.Event()
+		def refresh_f2():
+			rs2 = f2.on_refresh_begin()
+			begun.set()
+			accessed.wait()
+			inc2.on_access()
+			f2.on_refresh_end( rs2 )
+
+		t = threading.Thread(target=refresh_f2)
+		rs1 = f1.on_refresh_begin()
+		t.start()
+		begun.wait()
+		inc1.on_access()
+		f1.on_refresh_end( rs1 )
+		accessed.set()
+		t.join()
+
+		self.assertEqual({inc1}, f1.incoming_dependencies )
+		self.assertEqual({inc2}, f2.incoming_dependencies )
+		self.assertEqual({f1}, inc1.outgoing_dependences )
+		self.assertEqual({f2}, inc2.outgoing_dependences )
+		self.assertIsNone(_thread_state.current_computation)
+
+
+	def test_concurrent_refresh(self):
+		# A thread that attempts to refresh a monitor that is being refreshed by another thread waits for it to finish
+		inc1 = IncrementalValueMonitor()
+		f = IncrementalFunctionMonitor()
+
+		results = []
+		def refresh_f():
+			rs = f.on_refresh_begin()
+			results.append(rs)
+			f.on_refresh_end( rs )
+
+		rs = f.on_refresh_begin()
+		t = threading.Thread(target=refresh_f)
+		t.start()
+		t.join(0.05)
+		self.assertTrue(t.is_alive())
+		inc1.on_access()
+		f.on_refresh_end( rs )
+		t.join()
+
+		self.assertEqual([None], results)
+		self.assertEqual({inc1}, f.incoming_dependencies )
@@ -10,6 +10,7 @@ from larch.core.abstract_perspective import AbstractPerspective
 from larch.inspector.llinspector import llinspect
 from larch.inspector.primitive import present_primitive_object
 from larch.inspector.python_constructs import present_python
+from larch.inspector.numpy_array import present_numpy
 
 
 class InspectorPerspective (AbstractPerspective):
@@ -23,6 +24,10 @@ class InspectorPerspective (AbstractPerspective):
 		if p is not None:
 			return p
 
+		p = present_numpy(model)
+		if p is not None:
+			return p
+
 		return llinspect.present_object(model, fragment_view)
 
 
@@ -0,0 +1,150 @@
+##-*************************
+##-* This program is free software; you can use it, redistribute it and/or
+##-* modify it under the terms of the GNU Affero General Public License
+##-* version 3 as published by the Free Software Foundation. The full text of
+##-* the GNU Affero General Public License version 3 can be found in the file
+##-* named 'LICENSE.txt' that accompanies this program. This source code is
+##-* (C)copyright Geoffrey French 2011-2014.
+##-*************************
+"""
+Presentation of NumPy arrays
+
+An array is presented as a summary - its shape, dtype and, for numeric arrays, the range and mean of its values -
+followed by its elements along the first axis. The elements are presented within a window (see
+larch.inspector.windowed) so that only the slices that the user scrolls to are formatted and sent to the client.
+
+NumPy is optional; if it is not installed, present_numpy returns None for every object.
+"""
+import unittest
+
+from larch.pres.html import Html
+from larch.inspector.windowed import windowed_sequence
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+
+
+WINDOW_SIZE = 50
+
+# Options passed to numpy.array2string when formatting the elements of multi-dimensional arrays
+_ELEMENT_PRINT_OPTIONS = dict(threshold=64, edgeitems=3, max_line_width=120)
+
+
+def _span(css_class, x):
+	return '<span class="{0}">{1}</span>'.format(css_class, x)
+
+
+def array_summary(x):
+	"""
+	Describe an array
+
+	:param x: the array
+	:return: a list of (name, value) pairs, where the values are strings
+	"""
+	summary = [('shape', ' x '.join([str(n)   for n in x.shape])   if x.ndim > 0   else 'scalar'),
+		   ('dtype', str(x.dtype))]
+	if x.size > 0  and  x.dtype.kind in 'biuf':
+		summary.append(('min', str(x.min())))
+		summary.append(('max', str(x.max())))
+		if x.dtype.kind != 'b':
+			summary.append(('mean', str(x.mean())))
+	return summary
+
+
+def format_element(element):
+	"""
+	Format an element of an array - a scalar or a sub-array - as text
+	"""
+	if isinstance(element, numpy.ndarray):
+		return numpy.array2string(element, **_ELEMENT_PRINT_OPTIONS)
+	else:
+		return repr(element.item())   if hasattr(element, 'item')   else repr(element)
+
+
+def present_ndarray(x):
+	header = ['<div class="numpy_array_summary">', _span('numpy_array_type', 'ndarray')]
+	for name, value in array_summary(x):
+		header.append(' ' + _span('numpy_array_summary_name', name) + ' ' + _span('numpy_array_summary_value', Html.escape_str(value)))
+	header.append('</div>')
+	header = ''.join(header)
+
+	if x.ndim == 0:
+		return Html(header, '<div class="numpy_array_element">{0}</div>'.format(Html.escape_str(format_element(x[()]))))
+
+	n = x.shape[0]
+	def present_item(i, element):
+		return ['<pre class="numpy_array_element">' + _span('numpy_array_index', '[{0}]'.format(i)) + ' ' +
+			Html.escape_str(format_element(element)) + '</pre>']
+	return Html(header, windowed_sequence(x, n, present_item, '', '', window_size=WINDOW_SIZE))
+
+
+def present_numpy(x):
+	if numpy is not None  and  isinstance(x, numpy.ndarray):
+		return present_ndarray(x)
+	else:
+		return None
+
+
+
+
+
+@unittest.skipIf(numpy is None, 'NumPy is not installed')
+class Test_numpy_array (unittest.TestCase):
+	def test_summary(self):
+		x = numpy.arange(12, dtype=numpy.float32).reshape((3, 4))
+		self.assertEqual([('shape', '3 x 4'), ('dtype', 'float32'), ('min', '0.0'), ('max', '11.0'), ('mean', '5.5')],
+				 array_summary(x))
+		self.assertEqual([('shape', '0'), ('dtype', 'int64')], array_summary(numpy.zeros((0,), dtype=numpy.int64)))
+		self.assertEqual([('shape', '2'), ('dtype', 'bool'), ('min', 'False'), ('max', 'True')],
+				 array_summary(numpy.array([True, False])))
+
+
+	def test_format_element(self):
+		x = numpy.arange(6).reshape((2, 3))
+		self.assertEqual('[0 1 2]', format_element(x[0]))
+		self.assertEqual('4', format_element(x[1, 1]))
+
+
+	def test_present(self):
+		self.assertEqual(None, present_numpy([1, 2, 3]))
+		self.assertTrue(isinstance(present_numpy(numpy.arange(1000)), Html))
+
+
+	def test_resource(self):
+		from larch.pres.resource import NumpyArrayResource
+		x = numpy.arange(12, dtype='>i4').reshape((3, 4))[:, ::2]
+		rsc = NumpyArrayResource(x, chunk_size=8)
+		self.assertEqual({'dtype': 'int32', 'shape': [3, 2]}, rsc.get_metadata())
+		expected = numpy.ascontiguousarray(x, dtype='<i4').tostring()
+		self.assertEqual(expected, rsc.get_data().tobytes())
+		s = rsc.get_stream()
+		self.assertEqual(24, s.content_length)
+		self.assertEqual(expected, s.read())
+
+		# The buffer of a contiguous little-endian array is not copied
+		y = numpy.arange(4, dtype='<f8')
+		rsc = NumpyArrayResource(y)
+		y[0] = 5.0
+		self.assertEqual(5.0, numpy.frombuffer(rsc.get_data().tobytes(), dtype='<f8')[0])
+		self.assertRaises(TypeError, lambda: NumpyArrayResource(numpy.array(['a', 'b'])))
+
+
+	def test_modified_message(self):
+		from larch.pres.resource import NumpyArrayResource
+		class _Instance (object):
+			def __init__(self):
+				self.messages = []
+
+			def send_resource_message(self, message):
+				self.messages.append(message)
+
+		rsc = NumpyArrayResource(numpy.arange(4, dtype=numpy.int16))
+		instance = _Instance()
+		rsc.page_ref(None, instance)
+		rsc.set_array(numpy.zeros((2, 3), dtype=numpy.float32))
+		self.assertEqual(1, len(instance.messages))
+		m = instance.messages[0]
+		self.assertEqual(('modified', '1', 'float32', [2, 3]), (m['msgtype'], m['version'], m['dtype'], m['shape']))
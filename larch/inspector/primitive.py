@@ -10,6 +10,7 @@ import cgi
 from larch.core.dynamicpage.global_dependencies import GlobalCSS
 
 from larch.pres.html import Html
+from larch.inspector.windowed import windowed_sequence
 
 
 
@@ -89,8 +90,29 @@ _plus = _punct_html('+')
 _complex_j = '<span class="pyprim_complex_j">j</span>'
 
 
+# Collections with more elements than this are presented a window at a time
+WINDOWED_THRESHOLD = 1000
+
+
+def _windowed_items(xs, open_html, close_html):
+	n = len(xs)
+	def present_item(i, x):
+		return [x, _comma]   if i < n - 1   else [x]
+	return windowed_sequence(xs, n, present_item, open_html, close_html)
+
+
+def _windowed_dict(xs):
+	n = len(xs)
+	def present_item(i, item):
+		key, value = item
+		return [key, _colon, value, _comma]   if i < n - 1   else [key, _colon, value]
+	return windowed_sequence(xs, n, present_item, _open_brace, _close_brace)
+
+
 
 def present_tuple(xs):
+	if len(xs) > WINDOWED_THRESHOLD:
+		return _windowed_items(xs, _open_paren, _close_paren)
 	if len(xs) == 0:
 		return Html(_open_paren + _close_paren)
 	if len(xs) == 1:
@@ -108,6 +130,8 @@ def present_tuple(xs):
 
 
 def present_list(xs):
+	if len(xs) > WINDOWED_THRESHOLD:
+		return _windowed_items(xs, _open_bracket, _close_bracket)
 	contents = [_open_bracket]
 	first = True
 	for x in xs:
@@ -120,6 +144,8 @@ def present_list(xs):
 
 
 def present_set(xs):
+	if len(xs) > WINDOWED_THRESHOLD:
+		return _windowed_items(xs, _open_brace, _close_brace)
 	contents = [_open_brace]
 	first = True
 	for x in xs:
@@ -132,6 +158,8 @@ def present_set(xs):
 
 
 def present_dict(xs):
+	if len(xs) > WINDOWED_THRESHOLD:
+		return _windowed_dict(xs)
 	contents = [_open_brace]
 	first = True
 	for key, value in xs.items():
@@ -0,0 +1,169 @@
+##-*************************
+##-* This program is free software; you can use it, redistribute it and/or
+##-* modify it under the terms of the GNU Affero General Public License
+##-* version 3 as published by the Free Software Foundation. The full text of
+##-* the GNU Affero General Public License version 3 can be found in the file
+##-* named 'LICENSE.txt' that accompanies this program. This source code is
+##-* (C)copyright Geoffrey French 2011-2014.
+##-*************************
+"""
+Windowed presentation of large collections
+
+Presenting a collection creates a fragment for each of its elements. For very large collections, windowed_sequence
+presents only a window of elements within a scrollable container. When the user scrolls near either end of the
+container, the client posts a 'windowed_move' event and the window is moved. The elements that leave the window are
+no longer referenced by the page; their fragments are disposed of by the incremental view when it is cleaned after
+the refresh.
+"""
+import itertools
+import unittest
+
+from larch.pres.html import Html
+from larch.pres.pres import CompositePres
+from larch.live import LiveValue, LiveFunction
+
+
+
+DEFAULT_WINDOW_SIZE = 100
+
+
+def window_start_for_move(requested_start, length, window_size):
+	"""
+	Clamp the requested start of a window so that the window lies within the collection
+
+	:param requested_start: the index of the first element that the client requested
+	:param length: the number of elements in the collection
+	:param window_size: the number of elements in the window
+	:return: the start index of the window
+	"""
+	return max(0, min(requested_start, length - window_size))
+
+
+def slice_items(xs, start, stop):
+	"""
+	Get the elements of a collection within a given range
+
+	:param xs: the collection; sequences that support slicing (e.g. lists, tuples and NumPy arrays) are sliced, other collections (e.g. sets) are iterated
+	:param start: the index of the first element
+	:param stop: the index after the last element
+	:return: a list of elements; (key, value) pairs for a dictionary
+	"""
+	if isinstance(xs, dict):
+		return list(itertools.islice(xs.iteritems(), start, stop))
+	elif hasattr(xs, '__getitem__'):
+		return list(xs[start:stop])
+	else:
+		return list(itertools.islice(xs, start, stop))
+
+
+
+class windowed_sequence (CompositePres):
+	def __init__(self, xs, length, present_item, open_html, close_html, window_size=DEFAULT_WINDOW_SIZE, step=None):
+		"""
+		Create a windowed presentation of a collection
+
+		:param xs: the collection; a list, tuple, NumPy array, dictionary or a collection that iterates over its elements in a consistent order (e.g. a set)
+		:param length: the number of elements in the collection
+		:param present_item: a function of the form function(index, item) that returns a list of contents to display for an element; item is a (key, value) pair for a dictionary
+		:param open_html: the HTML source of the opening punctuation
+		:param close_html: the HTML source of the closing punctuation
+		:param window_size: [optional] the number of elements to present at a time
+		:param step: [optional] the number of elements by which the window moves when the user scrolls to either end; half the window size by default
+		"""
+		self.__xs = xs
+		self.__length = length
+		self.__present_item = present_item
+		self.__open_html = open_html
+		self.__close_html = close_html
+		self.__window_size = window_size
+		self.__step = step   if step is not None   else max(1, window_size // 2)
+
+		self.__start = LiveValue(0)
+		# Index of the element - relative to the start of the window - that the client should scroll to after the window moves
+		self.__scroll_to = None
+
+		self.__window = LiveFunction(self.__present_window)
+
+
+	@property
+	def window_start(self):
+		return self.__start.static_value
+
+	@property
+	def window_stop(self):
+		return min(self.__start.static_value + self.__window_size, self.__length)
+
+
+	def move_window(self, start, first_visible=None):
+		"""
+		Move the window
+
+		:param start: the index of the first element to present; clamped so that the window lies within the collection
+		:param first_visible: [optional] the index of the element that the client should keep in view
+		"""
+		start = window_start_for_move(start, self.__length, self.__window_size)
+		if first_visible is not None:
+			self.__scroll_to = max(0, min(first_visible - start, self.__window_size - 1))
+		else:
+			self.__scroll_to = None
+		self.__start.value = start
+
+
+	def __on_move(self, event):
+		self.move_window(event.data['start'], event.data.get('first_visible'))
+		return True
+
+
+	def __present_window(self):
+		start = self.__start.value
+		stop = min(start + self.__window_size, self.__length)
+		scroll_to = self.__scroll_to
+		self.__scroll_to = None
+
+		contents = ['<div class="pyprim_windowed">']
+		if start > 0:
+			contents.append('<div class="pyprim_windowed_more">{0} more...</div>'.format(start))
+		for i, x in enumerate(slice_items(self.__xs, start, stop)):
+			contents.append('<div class="pyprim_windowed_item">')
+			contents.extend(self.__present_item(start + i, x))
+			contents.append('</div>')
+		if stop < self.__length:
+			contents.append('<div class="pyprim_windowed_more">{0} more...</div>'.format(self.__length - stop))
+		contents.append('</div>')
+
+		p = Html(*contents)
+		p = p.js_function_call('larch.controls.initWindowedSequence', start, stop, self.__length, self.__step, scroll_to)
+		return p.with_event_handler('windowed_move', self.__on_move)
+
+
+	def pres(self, pres_ctx):
+		p = Html(self.__open_html, self.__window, self.__close_html,
+			 '<span class="pyprim_windowed_length">{0} items</span>'.format(self.__length))
+		return p.use_js('/files/static/larch/larch_ui.js')
+
+
+
+
+
+class Test_windowed (unittest.TestCase):
+	def test_window_start_for_move(self):
+		self.assertEqual(0, window_start_for_move(-50, 1000, 100))
+		self.assertEqual(250, window_start_for_move(250, 1000, 100))
+		self.assertEqual(900, window_start_for_move(950, 1000, 100))
+		self.assertEqual(0, window_start_for_move(20, 50, 100))
+
+
+	def test_slice_items(self):
+		self.assertEqual([2, 3], slice_items(range(10), 2, 4))
+		self.assertEqual([2, 3], slice_items(tuple(range(10)), 2, 4))
+		s = set(range(10))
+		self.assertEqual(list(s)[2:4], slice_items(s, 2, 4))
+		d = dict(zip(range(10), range(10)))
+		self.assertEqual(d.items()[8:], slice_items(d, 8, 12))
+
+
+	def test_move_window(self):
+		w = windowed_sequence(range(1000), 1000, lambda i, x: [x], '[', ']', window_size=100)
+		self.assertEqual((0, 100), (w.window_start, w.window_stop))
+		w.move_window(950, 960)
+		self.assertEqual((900, 1000), (w.window_start, w.window_stop))
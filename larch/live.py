@@ -9,10 +9,11 @@
 from copy import deepcopy
 import sys
 
-from larch.incremental import IncrementalValueMonitor, IncrementalFunctionMonitor
+from larch.incremental import IncrementalValueMonitor, IncrementalFunctionMonitor, _ListenerTable
 from larch.inspector import present_exception
 from larch.pres.pres import Pres, CompositePres, InnerFragment
 from larch.pres.obj_pres import error_box
+from larch.core.change_history import Change, CannotMergeChangeError
 
 
 class AbstractLive (CompositePres):
@@ -38,8 +39,8 @@ class AbstractLive (CompositePres):
 	def incremental_monitor(self):
 		raise NotImplementedError, 'abstract'
 
-	def add_listener(self, listener):
-		self.incremental_monitor.add_listener(listener)
+	def add_listener(self, listener, weak=False):
+		self.incremental_monitor.add_listener(listener, weak)
 
 	def remove_listener(self, listener):
 		self.incremental_monitor.remove_listener(listener)
@@ -100,10 +101,23 @@ class LiveValue (AbstractLive):
 
 
 class LiveFunction (AbstractLive):
-	def __init__(self, fn):
-		self.__incr = IncrementalFunctionMonitor(self)
+	def __init__(self, fn, cutoff=False):
+		"""
+		Create a live function
+
+		:param fn: the function to evaluate, of the form function() -> value
+		:param cutoff: [optional] enable early cutoff; if True, a re-computed value that compares equal (==) to the previous value is not treated as a change, so anything that depends upon this live function and nothing else that changed is not re-computed. Pass a function of the form function(a, b) -> bool to compare values with a custom comparator.
+		"""
+		if cutoff is True:
+			self.__eq_fn = lambda a, b: a == b
+		elif cutoff is False  or  cutoff is None:
+			self.__eq_fn = None
+		else:
+			self.__eq_fn = cutoff
+		self.__incr = IncrementalFunctionMonitor(self, self.__refresh_value   if self.__eq_fn is not None   else None)
 		self.__fn = fn
 		self.__value_cache = None
+		self.__has_value = False
 
 
 
@@ -150,11 +164,17 @@ class LiveFunction (AbstractLive):
 
 	def __refresh_value(self):
 		refresh_state = self.__incr.on_refresh_begin()
+		value_changed = True
 		try:
 			if refresh_state is not None:
-				self.__value_cache = self.__fn()
+				value = self.__fn()
+				if self.__eq_fn is not None  and  self.__has_value  and  self.__eq_fn(value, self.__value_cache):
+					value_changed = False
+				else:
+					self.__value_cache = value
+					self.__has_value = True
 		finally:
-			self.__incr.on_refresh_end(refresh_state)
+			self.__incr.on_refresh_end(refresh_state, value_changed)
 
 
 
@@ -162,49 +182,74 @@ class LiveFunction (AbstractLive):
 
 
 
-def _on_tracked_list_set_contents(changeHistory, ls, oldContents, newContents, description):
-	if changeHistory is not None:
-		for x in oldContents:
-			changeHistory.stop_tracking( x )
-		changeHistory.add_fn_change( lambda: ls._set_contents( newContents ), lambda: ls._set_contents( oldContents ), description )
-		for x in newContents:
-			changeHistory.track( x )
+class TrackedLiveListChange (Change):
+	"""
+	A change to a TrackedLiveList, recorded in a change history: the elements in old, starting at index, were replaced by
+	the elements in new. Only the affected range of elements is retained.
+	"""
+	def __init__(self, ls, index, old, new, description):
+		self.ls = ls
+		self.index = index
+		self.old = old
+		self.new = new
+		self._description = description
 
-def _on_tracked_list_set_item(changeHistory, ls, i, oldX, x, description):
-	if changeHistory is not None:
-		changeHistory.stop_tracking( oldX )
-		changeHistory.add_fn_change( lambda: ls.__setitem__( i, x ), lambda: ls.__setitem__( i, oldX ), description )
-		changeHistory.track( x )
 
+	def apply(self):
+		self.ls._splice( self.index, len( self.old ), self.new )
 
-def _on_tracked_list_append(changeHistory, ls, x, description):
-	if changeHistory is not None:
-		changeHistory.add_fn_change( lambda: ls.append( x ), lambda: ls.__delitem__( -1 ), description )
-		changeHistory.track( x )
+	def revert(self):
+		self.ls._splice( self.index, len( self.new ), self.old )
 
-def _on_tracked_list_extend(changeHistory, ls, xs, description):
-	if changeHistory is not None:
-		n = len( xs )
-		def _del():
-			del ls[-n:]
-		changeHistory.add_fn_change( lambda: ls.extend( xs ), _del, description )
-		for x in xs:
-			changeHistory.track( x )
 
-def _on_tracked_list_insert(changeHistory, ls, i, x, description):
-	if changeHistory is not None:
-		changeHistory.add_fn_change( lambda: ls.insert( i, x ), lambda: ls.__delitem__( i ), description )
-		changeHistory.track( x )
+	def journal_op(self, reverted):
+		if reverted:
+			return self.ls, ( self.index, len( self.new ), self.old )
+		else:
+			return self.ls, ( self.index, len( self.old ), self.new )
 
-def _on_tracked_list_pop(changeHistory, ls, x, description):
-	if changeHistory is not None:
-		changeHistory.add_fn_change( lambda: ls.pop(), lambda: ls.append( x ), description )
-		changeHistory.stop_tracking( x )
 
-def _on_tracked_list_remove(changeHistory, ls, i, x, description):
+	description = property(lambda self: self._description, doc='Get the description')
+
+
+	def can_compact_from(self, change):
+		# The range replaced by @change must overlap or adjoin the range of elements in self.new
+		if isinstance( change, TrackedLiveListChange )  and  change.ls is self.ls:
+			return change.index <= self.index + len( self.new )  and  change.index + len( change.old ) >= self.index
+		else:
+			return False
+
+	def compact_from(self, change):
+		if not self.can_compact_from( change ):
+			raise CannotMergeChangeError
+		i, j = self.index, change.index
+		end, change_end = i + len( self.new ), j + len( change.old )
+		# Elements replaced by @change that lie outside the range of self.new were present before self was applied
+		old_prefix = change.old[:i-j]   if j < i   else []
+		old_suffix = change.old[end-j:]   if change_end > end   else []
+		# Elements of self.new that lie outside the range replaced by @change remain after it is applied
+		new_prefix = self.new[:j-i]   if j > i   else []
+		new_suffix = self.new[change_end-i:]   if change_end < end   else []
+		self.index = min( i, j )
+		self.old = old_prefix + self.old + old_suffix
+		self.new = new_prefix + change.new + new_suffix
+		self._description = 'Live list changes'
+
+
+	def estimate_size(self):
+		# The removed elements are retained only by the history
+		return Change.estimate_size( self ) + sys.getsizeof( self.old ) + sys.getsizeof( self.new ) + \
+		       sum( [ sys.getsizeof( x )   for x in self.old ] )
+
+
+
+def _on_tracked_list_change(changeHistory, ls, index, old, new, description):
 	if changeHistory is not None:
-		changeHistory.add_fn_change( lambda: ls.__delitem__( i ), lambda: ls.insert( i, x ), description )
-		changeHistory.stop_tracking( x )
+		for x in old:
+			changeHistory.stop_tracking( x )
+		changeHistory.add_change( TrackedLiveListChange( ls, index, old, new, description ) )
+		for x in new:
+			changeHistory.track( x )
 
 def _on_tracked_list_reverse(changeHistory, ls, description):
 	if changeHistory is not None:
@@ -228,8 +273,66 @@ class _LiveListIter (object):
 		return self._it.next()
 
 
+class LiveListDelta (object):
+	"""
+	A change to the contents of a TrackedLiveList: the elements in old, starting at index, were replaced by the elements in new
+
+	op - 'insert' if old is empty, 'remove' if new is empty, otherwise 'replace'
+	"""
+	__slots__ = ['index', 'old', 'new']
+
+	def __init__(self, index, old, new):
+		self.index = index
+		self.old = old
+		self.new = new
+
+
+	@property
+	def op(self):
+		if len(self.old) == 0:
+			return 'insert'
+		elif len(self.new) == 0:
+			return 'remove'
+		else:
+			return 'replace'
+
+
+	def __eq__(self, other):
+		if isinstance(other, LiveListDelta):
+			return self.index == other.index  and  self.old == other.old  and  self.new == other.new
+		else:
+			return NotImplemented
+
+	def __ne__(self, other):
+		if isinstance(other, LiveListDelta):
+			return self.index != other.index  or  self.old != other.old  or  self.new != other.new
+		else:
+			return NotImplemented
+
+	def __repr__(self):
+		return 'LiveListDelta({0}, {1}, {2}, {3})'.format(self.op, self.index, self.old, self.new)
+
+
+
+class LiveListSnapshotAdapter (object):
+	"""
+	Adapts a listener of the form function(old_contents, new_contents), that receives complete copies of the contents of a
+	TrackedLiveList before and after each change, to the delta listener protocol. The copies make every change O(n) in the
+	length of the list; use a delta listener where possible.
+	"""
+	def __init__(self, listener):
+		self.listener = listener
+
+
+	def __call__(self, ls, delta):
+		new_contents = ls._items[:]
+		old_contents = new_contents[:delta.index] + delta.old + new_contents[delta.index+len(delta.new):]
+		self.listener( old_contents, new_contents )
+
+
+
 class TrackedLiveList (object):
-	__slots__ = [ '__change_history__', '_items', '_incr', '__change_listener']
+	__slots__ = [ '__change_history__', '_items', '_incr', '__change_listener', '__delta_listeners']
 
 	def __init__(self, xs=None):
 		self._items = []
@@ -238,15 +341,51 @@ class TrackedLiveList (object):
 		self.__change_history__ = None
 		self._incr = IncrementalValueMonitor()
 		self.__change_listener = None
+		self.__delta_listeners = None
 
 
 	@property
 	def change_listener(self):
-		return self.__change_listener
+		"""
+		A listener of the form function(old_contents, new_contents), notified with copies of the contents of the list before
+		and after each change. Retained for compatibility; it is attached as a delta listener via a LiveListSnapshotAdapter.
+		"""
+		return self.__change_listener.listener   if self.__change_listener is not None   else None
 
 	@change_listener.setter
 	def change_listener(self, x):
-		self.__change_listener = x
+		if self.__change_listener is not None:
+			self.remove_delta_listener( self.__change_listener )
+			self.__change_listener = None
+		if x is not None:
+			self.__change_listener = LiveListSnapshotAdapter( x )
+			self.add_delta_listener( self.__change_listener )
+
+
+	def add_delta_listener(self, listener, weak=False):
+		"""
+		Add a delta listener, that is notified of each change with a LiveListDelta describing the change
+
+		:param listener: a function of the form function(live_list, delta)
+		:param weak: [optional] if True, the listener is held by a weak reference (the object of a bound method is held weakly), and is removed once it has been garbage collected
+		"""
+		if self.__delta_listeners is None:
+			self.__delta_listeners = _ListenerTable()
+		self.__delta_listeners.add(listener, weak)
+
+	def remove_delta_listener(self, listener):
+		if self.__delta_listeners is not None:
+			self.__delta_listeners.remove(listener)
+			if len(self.__delta_listeners) == 0:
+				self.__delta_listeners = None
+
+
+	@property
+	def static_items(self):
+		"""
+		A copy of the contents, retrieved without registering an access with the incremental computation system
+		"""
+		return self._items[:]
 
 
 	def __getstate__(self):
@@ -258,6 +397,7 @@ class TrackedLiveList (object):
 		self.__change_history__ = None
 		self._incr = IncrementalValueMonitor()
 		self.__change_listener = None
+		self.__delta_listeners = None
 
 	def __copy__(self):
 		self._incr.on_access()
@@ -292,6 +432,17 @@ class TrackedLiveList (object):
 		return self._items
 
 
+	def __journal_state__(self):
+		return self._items[:]
+
+	def __journal_restore__(self, state):
+		self._splice( 0, len( self._items ), state )
+
+	def __journal_replay__(self, op):
+		index, n_removed, xs = op
+		self._splice( index, n_removed, xs )
+
+
 	def __clipboard_copy__(self, memo):
 		self._incr.on_access()
 		t = type( self )
@@ -343,104 +494,105 @@ class TrackedLiveList (object):
 	def __setitem__(self, index, x):
 		if isinstance( index, int )  or  isinstance( index, long ):
 			oldX = self._items[index]
-			if self.__change_listener is not None:
-				old_contents = self._items[:]
 			self._items[index] = x
-			_on_tracked_list_set_item( self.__change_history__, self, index, oldX, x, 'Live list set item' )
-			if self.__change_listener is not None:
-				self.__change_listener( old_contents, self._items[:] )
+			self.__on_change( index % len( self._items ), [ oldX ], [ x ], 'Live list set item' )
 		else:
-			old_contents = self._items[:]
-			self._items[index] = x
-			newContents = self._items[:]
-			_on_tracked_list_set_contents( self.__change_history__, self, old_contents, newContents, 'Live list set item' )
-			if self.__change_listener is not None:
-				self.__change_listener( old_contents, newContents )
-		self._incr.on_changed()
+			start, stop, step = index.indices( len( self._items ) )
+			if step == 1:
+				stop = max( start, stop )
+				old = self._items[start:stop]
+				new = list( x )
+				self._items[start:stop] = new
+				self.__on_change( start, old, new, 'Live list set item' )
+			else:
+				# Extended slice
+				old_contents = self._items[:]
+				self._items[index] = x
+				self.__on_change( 0, old_contents, self._items[:], 'Live list set item' )
 
 	def __delitem__(self, index):
-		oldContents = self._items[:]
-		del self._items[index]
-		newContents = self._items[:]
-		_on_tracked_list_set_contents( self.__change_history__, self, oldContents, newContents, 'Live list del item' )
-		if self.__change_listener is not None:
-			self.__change_listener( oldContents, newContents )
-		self._incr.on_changed()
+		if isinstance( index, int )  or  isinstance( index, long ):
+			x = self._items[index]
+			if index < 0:
+				index += len( self._items )
+			del self._items[index]
+			self.__on_change( index, [ x ], [], 'Live list del item' )
+		else:
+			start, stop, step = index.indices( len( self._items ) )
+			if step == 1:
+				stop = max( start, stop )
+				old = self._items[start:stop]
+				del self._items[start:stop]
+				self.__on_change( start, old, [], 'Live list del item' )
+			else:
+				# Extended slice
+				old_contents = self._items[:]
+				del self._items[index]
+				self.__on_change( 0, old_contents, self._items[:], 'Live list del item' )
 
 	def append(self, x):
-		if self.__change_listener is not None:
-			old_contents = self._items[:]
 		self._items.append( x )
-		_on_tracked_list_append( self.__change_history__, self, x, 'Live list append' )
-		if self.__change_listener is not None:
-			self.__change_listener( old_contents, self._items[:] )
-		self._incr.on_changed()
+		self.__on_change( len( self._items ) - 1, [], [ x ], 'Live list append' )
 
 	def extend(self, xs):
-		if self.__change_listener is not None:
-			old_contents = self._items[:]
+		n = len( self._items )
 		self._items.extend( xs )
-		_on_tracked_list_extend( self.__change_history__, self, xs, 'Live list extend' )
-		if self.__change_listener is not None:
-			self.__change_listener( old_contents, self._items[:] )
-		self._incr.on_changed()
+		self.__on_change( n, [], self._items[n:], 'Live list extend' )
 
 	def insert(self, i, x):
-		if self.__change_listener is not None:
-			old_contents = self._items[:]
+		n = len( self._items )
+		# Clamp the index in the same way as list.insert
+		i = max( i + n, 0 )   if i < 0   else min( i, n )
 		self._items.insert( i, x )
-		_on_tracked_list_insert( self.__change_history__, self, i, x, 'Live list insert' )
-		if self.__change_listener is not None:
-			self.__change_listener( old_contents, self._items[:] )
-		self._incr.on_changed()
+		self.__on_change( i, [], [ x ], 'Live list insert' )
 
 	def pop(self):
-		if self.__change_listener is not None:
-			old_contents = self._items[:]
 		x = self._items.pop()
-		_on_tracked_list_pop( self.__change_history__, self, x, 'Live list pop' )
-		if self.__change_listener is not None:
-			self.__change_listener( old_contents, self._items[:] )
-		self._incr.on_changed()
+		self.__on_change( len( self._items ), [ x ], [], 'Live list pop' )
 		return x
 
 	def remove(self, x):
-		if self.__change_listener is not None:
-			old_contents = self._items[:]
 		i = self._items.index( x )
 		xFromList = self._items[i]
 		del self._items[i]
-		_on_tracked_list_remove( self.__change_history__, self, i, xFromList, 'Live list remove' )
-		if self.__change_listener is not None:
-			self.__change_listener( old_contents, self._items[:] )
-		self._incr.on_changed()
+		self.__on_change( i, [ xFromList ], [], 'Live list remove' )
 
 	def reverse(self):
-		if self.__change_listener is not None:
-			old_contents = self._items[:]
 		self._items.reverse()
 		_on_tracked_list_reverse( self.__change_history__, self, 'Live list reverse' )
-		if self.__change_listener is not None:
-			self.__change_listener( old_contents, self._items[:] )
+		if self.__delta_listeners is not None:
+			new_contents = self._items[:]
+			self.__notify_delta( 0, new_contents[::-1], new_contents )
 		self._incr.on_changed()
 
 	def sort(self, cmp_fn=None, key=None, reverse=False):
 		old_contents = self._items[:]
 		self._items.sort( cmp=cmp_fn, key=key, reverse=reverse )
-		newContents = self._items[:]
-		_on_tracked_list_set_contents( self.__change_history__, self, old_contents, newContents, 'Live list sort' )
-		if self.__change_listener is not None:
-			self.__change_listener( old_contents, newContents )
-		self._incr.on_changed()
+		self.__on_change( 0, old_contents, self._items[:], 'Live list sort' )
 
 	def _set_contents(self, xs):
 		old_contents = self._items[:]
 		self._items[:] = xs
-		_on_tracked_list_set_contents( self.__change_history__, self, old_contents, xs, 'Live list set contents' )
-		if self.__change_listener is not None:
-			self.__change_listener( old_contents, self._items[:] )
+		self.__on_change( 0, old_contents, self._items[:], 'Live list set contents' )
+
+	def _splice(self, index, n_removed, xs):
+		old = self._items[index:index+n_removed]
+		new = list( xs )
+		self._items[index:index+n_removed] = new
+		self.__on_change( index, old, new, 'Live list splice' )
+
+
+	def __on_change(self, index, old, new, description):
+		_on_tracked_list_change( self.__change_history__, self, index, old, new, description )
+		if self.__delta_listeners is not None:
+			self.__notify_delta( index, old, new )
 		self._incr.on_changed()
 
+	def __notify_delta(self, index, old, new):
+		delta = LiveListDelta( index, old, new )
+		for listener in list( self.__delta_listeners ):
+			listener( self, delta )
+
 
 
 
@@ -450,6 +602,109 @@ import unittest
 import random
 
 from larch.core.change_history import ChangeHistory
+from larch.incremental import batch
+
+
+class Test_LiveValue (unittest.TestCase):
+	def test_batch(self):
+		a = LiveValue(1)
+		b = LiveValue(2)
+		f = LiveFunction(lambda: a.value + b.value)
+		self.assertEqual(3, f.value)
+
+		changes = []
+		f.add_listener(lambda incr: changes.append(incr))
+
+		with batch():
+			for i in xrange(100):
+				a.value = i
+				b.value = i
+			# Values read within the batch are up to date
+			self.assertEqual(198, f.value)
+			self.assertEqual(0, len(changes))
+
+		self.assertEqual(1, len(changes))
+		self.assertEqual(198, f.value)
+
+
+	def test_control_listeners_scoped_to_fragment(self):
+		from larch.core.dynamicpage.page import DynamicPage
+		from larch.core.incremental_view import IncrementalView
+		from larch.core.subject import Subject
+		from larch.controls.text_entry import live_text_entry
+		from larch.pres.html import Html
+
+		v = LiveValue('a')
+		counter = LiveValue(0)
+		root = LiveFunction(lambda: Html('<div>{0}</div>'.format(counter.value), live_text_entry(v)))
+		page = DynamicPage(None, 'x')
+		IncrementalView(Subject(root), page)
+		page.initial_content()
+		page.synchronize()
+
+		# Re-compute the enclosing fragment; the listeners of the previous controls are removed
+		for i in xrange(10):
+			counter.value = i + 1
+			page.synchronize()
+		self.assertEqual(1, len(v.incremental_monitor._listeners))
+
+
+
+
+class Test_LiveFunction (unittest.TestCase):
+	def test_cutoff(self):
+		x = LiveValue(1.1)
+		r = LiveFunction(lambda: int(round(x.value)), cutoff=True)
+		evals = [0]
+		def _double():
+			evals[0] += 1
+			return r.value * 2
+		d = LiveFunction(_double)
+
+		self.assertEqual(2, d.value)
+		self.assertEqual(1, evals[0])
+
+		x.value = 1.2
+		self.assertEqual(2, d.value)
+		self.assertEqual(1, evals[0])
+		self.assertFalse(d.incremental_monitor.refresh_required)
+
+		x.value = 2.2
+		self.assertEqual(4, d.value)
+		self.assertEqual(2, evals[0])
+
+
+	def test_cutoff_comparator(self):
+		x = LiveValue([1, 2])
+		l = LiveFunction(lambda: x.value, cutoff=lambda a, b: len(a) == len(b))
+		evals = [0]
+		def _len():
+			evals[0] += 1
+			return len(l.value)
+		n = LiveFunction(_len)
+
+		self.assertEqual(2, n.value)
+		x.value = [3, 4]
+		self.assertEqual(2, n.value)
+		self.assertEqual(1, evals[0])
+		self.assertEqual([1, 2], l.value)
+
+		x.value = [3, 4, 5]
+		self.assertEqual(3, n.value)
+		self.assertEqual(2, evals[0])
+
+
+	def test_cutoff_mixed_dependencies(self):
+		x = LiveValue(1.1)
+		y = LiveValue(10)
+		r = LiveFunction(lambda: int(round(x.value)), cutoff=True)
+		s = LiveFunction(lambda: r.value + y.value)
+
+		self.assertEqual(11, s.value)
+		x.value = 1.2
+		y.value = 20
+		self.assertEqual(21, s.value)
+
 
 
 class Test_TrackedLiveList (unittest.TestCase):
@@ -619,6 +874,30 @@ class Test_TrackedLiveList (unittest.TestCase):
 		self._test_changes( _rng[1:], [ _rng[1], _rng[4] ] )
 
 
+		del self.ls[-1]
+		self.assertEqual( self.ls[:], [ _rng[1] ] )
+		self._test_changes( [ _rng[1], _rng[4] ], [ _rng[1] ] )
+
+
+
+	def test_delitem_out_of_range(self):
+		_rng = [ Test_TrackedLiveList._Value( x )   for x in xrange( 5 ) ]
+		self.ls[:] = _rng
+		self._test_changes( [], _rng )
+
+		def del_item(i):
+			del self.ls[i]
+
+		self.assertRaises( IndexError, lambda: del_item( -100 ) )
+		self.assertRaises( IndexError, lambda: del_item( 5 ) )
+		self.assertEqual( self.ls[:], _rng )
+
+		self.ls[:] = []
+		self._test_changes( _rng, [] )
+		self.assertRaises( IndexError, lambda: del_item( -1 ) )
+		self.assertEqual( self.ls[:], [] )
+
+
 
 	def test_append(self):
 		self.assertEqual( self.ls[:], [] )
@@ -826,3 +1105,127 @@ class Test_TrackedLiveList (unittest.TestCase):
 		self.ls[:] = range( 0, 5 )
 
 		self.assertEqual( repr( self.ls ), 'LiveList( ' + repr( range( 0, 5 ) ) + ' )' )
+
+
+
+	def test_deltas(self):
+		mirror = []
+		deltas = []
+		def on_delta(ls, delta):
+			mirror[delta.index:delta.index+len(delta.old)] = delta.new
+			deltas.append(delta)
+		self.ls.add_delta_listener( on_delta )
+
+		self.ls.extend( range( 0, 5 ) )
+		self.ls.append( 5 )
+		self.ls.insert( 1, 10 )
+		self.ls.insert( -100, 11 )
+		self.ls[2] = 12
+		self.ls[-1] = 13
+		self.assertEqual( [ 'insert', 'insert', 'insert', 'insert', 'replace', 'replace' ],  [ d.op for d in deltas ] )
+		self.assertEqual( LiveListDelta( 0, [], [ 11 ] ), deltas[3] )
+		self.assertEqual( mirror, self.ls[:] )
+
+		self.ls[1:3] = [ 20, 21, 22 ]
+		self.ls[::2] = [ 30, 31, 32, 33, 34 ]
+		del self.ls[-1]
+		del self.ls[1:3]
+		self.ls.pop()
+		self.ls.remove( 33 )
+		self.ls.reverse()
+		self.ls.sort()
+		self.assertEqual( mirror, self.ls[:] )
+		self.assertEqual( LiveListDelta( 1, [ 0, 12 ], [ 20, 21, 22 ] ), deltas[6] )
+
+		self.history.undo()
+		self.history.undo()
+		self.history.undo()
+		self.assertEqual( mirror, self.ls[:] )
+
+		self.ls.remove_delta_listener( on_delta )
+		self.ls.append( 40 )
+		self.assertNotEqual( mirror, self.ls[:] )
+
+		# Removing a listener that is not registered has no effect
+		self.ls.remove_delta_listener( on_delta )
+
+
+
+	def test_weak_delta_listener(self):
+		class _Listener (object):
+			def __init__(self):
+				self.deltas = []
+
+			def on_delta(self, ls, delta):
+				self.deltas.append(delta)
+
+		listener = _Listener()
+		self.ls.add_delta_listener( listener.on_delta, weak=True )
+		self.ls.append( 1 )
+		self.assertEqual( [ LiveListDelta( 0, [], [ 1 ] ) ], listener.deltas )
+
+		del listener
+		self.ls.append( 2 )
+		self.assertEqual( self.ls[:], [ 1, 2 ] )
+
+
+
+	def test_history_records_range(self):
+		_rng = [ Test_TrackedLiveList._Value( x )   for x in xrange( 1000 ) ]
+		self.ls[:] = _rng
+		del self.ls[500]
+		self.ls[10:12] = [ Test_TrackedLiveList._Value( -1 ) ]
+
+		change = self.history._top_change()
+		self.assertIsInstance( change, TrackedLiveListChange )
+		self.assertEqual( ( 10, _rng[10:12], [ Test_TrackedLiveList._Value( -1 ) ] ),  ( change.index, change.old, change.new ) )
+
+		self.history.undo()
+		self.history.undo()
+		self.assertEqual( self.ls[:], _rng )
+		self.assertTrue( _rng[500].is_tracked() )
+
+
+
+	def test_compact_history(self):
+		rng = random.Random( 12345 )
+		self.ls[:] = [ Test_TrackedLiveList._Value( x )   for x in xrange( 20 ) ]
+		start = self.ls[:]
+		self.history.clear()
+
+		for x in xrange( 100 ):
+			op = rng.randint( 0, 2 )
+			if op == 0:
+				self.ls.append( Test_TrackedLiveList._Value( x ) )
+			elif op == 1  and  len( self.ls ) > 0:
+				del self.ls[rng.randint( 0, len( self.ls ) - 1 )]
+			else:
+				i = rng.randint( 0, len( self.ls ) )
+				self.ls[i:i+2] = [ Test_TrackedLiveList._Value( -x ) ]
+		end = self.ls[:]
+		n_steps = self.history.num_undo_changes
+		size = self.history.estimated_size
+
+		self.history.compact( keep_recent=10 )
+		self.assertTrue( self.history.num_undo_changes < n_steps )
+		self.assertTrue( self.history.estimated_size < size )
+
+		while self.history.can_undo():
+			self.history.undo()
+		self.assertEqual( self.ls[:], start )
+		while self.history.can_redo():
+			self.history.redo()
+		self.assertEqual( self.ls[:], end )
+
+
+	def test_compact_appends(self):
+		for x in xrange( 50 ):
+			self.ls.append( Test_TrackedLiveList._Value( x ) )
+		del self.ls[-1]
+		self.history.compact()
+		self.assertEqual( self.history.num_undo_changes, 1 )
+		self.assertEqual( 1, self.history.memory_usage()['changes'] )
+		self.history.undo()
+		self.assertEqual( self.ls[:], [] )
+		self.history.redo()
+		self.assertEqual( self.ls[:], [ Test_TrackedLiveList._Value( x )   for x in xrange( 49 ) ] )
@@ -8,14 +8,36 @@
 ##-*************************
 import json
 import os
+import mmap
+import hashlib
 
 import mimetypes
 
 from larch.core.dynamicpage.segment import HtmlContent
+from larch.core.dynamicpage.resource_stream import ResourceStream
+from larch.core.dynamicpage import serialization_cache
 from larch.live import LiveFunction
 from larch.pres import pres, html
 from larch import msg, js
 
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+
+def data_version(data):
+	"""
+	Compute a version for resource data from a hash of its contents
+
+	:param data: the data as a string
+	:return: the version as a string
+	"""
+	if isinstance(data, unicode):
+		data = data.encode('utf-8')
+	return hashlib.sha1(data).hexdigest()[:20]
+
+
 
 class AbstractResource (pres.Pres, js.JS):
 	requires_url = False
@@ -84,6 +106,8 @@ class MessageChannel (AbstractResource):
 
 class URLResource (AbstractResource):
 	requires_url = True
+	# True if the data and MIME type of the resource never change, so that they can be retrieved without locking the page
+	is_immutable = False
 
 	def __init__(self):
 		pass
@@ -92,29 +116,56 @@ class URLResource (AbstractResource):
 	def get_data(self):
 		raise NotImplementedError, 'abstract'
 
+	def get_stream(self):
+		"""
+		Get the data as a stream
+
+		Invoked with the page lock held for reading (unless the resource is immutable), while the chunks of the stream
+		are produced after the lock has been released. Override to produce the data incrementally; the chunks must then
+		be computed without relying on the state of the page remaining unchanged.
+
+		:return: a ResourceStream; by default, a single chunk consisting of the result of get_data
+		"""
+		return ResourceStream.from_data(self.get_data())
+
 	def get_mime_type(self):
 		raise NotImplementedError, 'abstract'
 
+	def get_version(self):
+		"""
+		Get the version of the data; a string that changes whenever the data does
+
+		The version is used as the ETag of the data and is embedded in its URL, so that clients can cache the data
+		and servers can answer conditional requests without retrieving it. It should be cheap to compute; it is
+		retrieved under the same locking conditions as the data.
+
+		:return: the version, or None if it is unknown, in which case the ETag is computed from a hash of the data each time that it is retrieved
+		"""
+		return None
+
 	def build(self, pres_ctx):
 		return HtmlContent([self._url(pres_ctx)])
 
 	def build_js(self, pres_ctx):
 		instance = self._get_instance(pres_ctx)
-		j = js.JSCall('larch.__createURLResource', [instance.id, instance.resource_url])
+		j = js.JSCall('larch.__createURLResource', [instance.id, instance.resource_url, instance.get_version()])
 		return j.build_js(pres_ctx)
 
 	def _url(self, pres_ctx):
 		rsc_instance = pres_ctx.fragment_view.get_resource_instance(self, pres_ctx)
-		return rsc_instance.resource_url
+		return rsc_instance.versioned_resource_url
 
 
 
 
 class ConstResource (URLResource):
+	is_immutable = True
+
 	def __init__(self, data, mime_type):
 		super(ConstResource, self).__init__()
 		self.__data = data
 		self.__mime_type = mime_type
+		self.__version = None
 
 
 	def get_data(self):
@@ -123,6 +174,11 @@ class ConstResource (URLResource):
 	def get_mime_type(self):
 		return self.__mime_type
 
+	def get_version(self):
+		if self.__version is None:
+			self.__version = data_version(self.__data)
+		return self.__version
+
 
 
 class JsonResource (ConstResource):
@@ -162,7 +218,226 @@ class JsonFnResource (FnResource):
 
 class CSVFnResource (FnResource):
 	def __init__(self, data_fn):
-		super(CSVFnResource, self).__init__(data_fn(), 'text/csv')
+		super(CSVFnResource, self).__init__(data_fn, 'text/csv')
+
+
+
+
+
+class StreamingFnResource (URLResource):
+	def __init__(self, chunks_fn, mime_type, content_length_fn=None):
+		"""
+		Constructor
+
+		:param chunks_fn: a function of the form function() that returns an iterable of strings (e.g. a generator); the data
+		:param mime_type: the MIME type
+		:param content_length_fn: [optional] a function of the form function() that returns the length of the data in bytes, if it is known in advance
+		"""
+		super(StreamingFnResource, self).__init__()
+		self.__chunks_fn = chunks_fn
+		self.__mime_type = mime_type
+		self.__content_length_fn = content_length_fn
+
+
+	def get_data(self):
+		return self.get_stream().read()
+
+	def get_stream(self):
+		content_length = self.__content_length_fn()   if self.__content_length_fn is not None   else None
+		return ResourceStream(self.__chunks_fn(), content_length)
+
+	def get_mime_type(self):
+		return self.__mime_type
+
+
+
+class CSVStreamingFnResource (StreamingFnResource):
+	def __init__(self, rows_fn):
+		"""
+		Constructor
+
+		:param rows_fn: a function of the form function() that returns an iterable of strings, each of which is a line of CSV, including the line terminator
+		"""
+		super(CSVStreamingFnResource, self).__init__(rows_fn, 'text/csv')
+
+
+
+
+
+class FileResource (URLResource):
+	def __init__(self, filename, mime_type=None, chunk_size=65536, use_mmap=False):
+		"""
+		Constructor
+
+		The file is read each time that the resource is retrieved, in chunks, so its contents are never held in memory
+		in their entirety.
+
+		:param filename: the path of the file
+		:param mime_type: [optional] the MIME type; guessed from the filename if None
+		:param chunk_size: [optional] the size of the chunks in which the file is sent
+		:param use_mmap: [optional] if True, the file is memory-mapped rather than read; the file must not be truncated while it is being sent
+		"""
+		super(FileResource, self).__init__()
+		self.__filename = filename
+		if mime_type is None:
+			mime_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+		self.__mime_type = mime_type
+		self.__chunk_size = chunk_size
+		self.__use_mmap = use_mmap
+
+
+	def get_data(self):
+		return self.get_stream().read()
+
+	def get_version(self):
+		# Derived from the modification time and size of the file, so that the file need not be read
+		try:
+			st = os.stat(self.__filename)
+		except OSError:
+			return None
+		return '{0:x}-{1:x}'.format(int(st.st_mtime * 1000), st.st_size)
+
+	def get_stream(self):
+		f = open(self.__filename, 'rb')
+		try:
+			# The length of the file when it is opened; any data appended later is not sent
+			size = os.fstat(f.fileno()).st_size
+			if self.__use_mmap  and  size > 0:
+				m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+				def close():
+					m.close()
+					f.close()
+				return ResourceStream(_mmap_chunks(m, size, self.__chunk_size), size, close)
+			else:
+				return ResourceStream(_file_chunks(f, size, self.__chunk_size), size, f.close)
+		except:
+			f.close()
+			raise
+
+	def get_mime_type(self):
+		return self.__mime_type
+
+
+
+def _file_chunks(f, size, chunk_size):
+	remaining = size
+	while remaining > 0:
+		chunk = f.read(min(chunk_size, remaining))
+		if chunk == '':
+			# The file has been truncated
+			break
+		remaining -= len(chunk)
+		yield chunk
+
+
+def _mmap_chunks(m, size, chunk_size):
+	for pos in xrange(0, size, chunk_size):
+		yield m[pos:pos+chunk_size]
+
+
+
+
+
+class NumpyArrayResource (URLResource):
+	# dtype kinds that map to JavaScript typed arrays: boolean, signed and unsigned integer and floating point
+	_SUPPORTED_KINDS = 'biuf'
+
+	def __init__(self, array, chunk_size=1<<20):
+		"""
+		Constructor
+
+		Serves the contents of a NumPy array as raw binary data, without copying it; the client reads it into a typed
+		array with fetchTypedArray. The dtype and shape of the array are passed to the client along with the URL.
+
+		Arrays that are not C-contiguous or not little-endian are copied, once, to put them in the form that the client
+		expects.
+
+		:param array: the array
+		:param chunk_size: [optional] the size of the chunks in which the data is streamed
+		"""
+		super(NumpyArrayResource, self).__init__()
+		self.__chunk_size = chunk_size
+		self.__instances = []
+		self.__version = 0
+		self.__set_array(array)
+
+
+	@property
+	def array(self):
+		return self.__array
+
+
+	def set_array(self, array):
+		"""
+		Replace the array and notify clients
+		"""
+		self.__set_array(array)
+		self.modified()
+
+
+	def modified(self):
+		"""
+		Notify clients that the contents of the array have changed
+
+		Since the buffer of the array is sent without copying it, modifying it in place while it is being sent results
+		in the client receiving a mix of the old and new contents; use set_array to replace the array instead.
+		"""
+		self.__version += 1
+		# Pass the dtype and shape, as set_array may have changed them
+		metadata = self.get_metadata()
+		modified_message = msg.message('modified', version=self.get_version(), dtype=metadata['dtype'], shape=metadata['shape'])
+		for instance in self.__instances:
+			instance.send_resource_message(modified_message)
+
+
+	def page_ref(self, pres_ctx, rsc_instance):
+		self.__instances.append(rsc_instance)
+
+	def page_unref(self, pres_ctx, rsc_instance):
+		self.__instances.remove(rsc_instance)
+
+
+	def get_data(self):
+		return self.__buffer
+
+	def get_stream(self):
+		buf = self.__buffer
+		chunks = (buf[pos:pos+self.__chunk_size]   for pos in xrange(0, len(buf), self.__chunk_size))
+		return ResourceStream(chunks, len(buf))
+
+	def get_mime_type(self):
+		return 'application/octet-stream'
+
+	def get_version(self):
+		return str(self.__version)
+
+
+	def get_metadata(self):
+		"""
+		:return: a dictionary describing the data; 'dtype' - the name of the dtype, 'shape' - the shape as a list
+		"""
+		return {'dtype': self.__array.dtype.name, 'shape': list(self.__array.shape)}
+
+
+	def build_js(self, pres_ctx):
+		instance = self._get_instance(pres_ctx)
+		metadata = self.get_metadata()
+		j = js.JSCall('larch.__createNumpyArrayResource', [instance.id, instance.resource_url, instance.get_version(),
+								    metadata['dtype'], metadata['shape']])
+		return j.build_js(pres_ctx)
+
+
+	def __set_array(self, array):
+		if array.dtype.kind not in self._SUPPORTED_KINDS:
+			raise TypeError, 'Arrays of dtype {0} cannot be served as typed arrays'.format(array.dtype)
+		# The client reads the data in little-endian C order
+		if not array.flags.c_contiguous:
+			array = numpy.ascontiguousarray(array)
+		if array.dtype.byteorder == '>'  or  (array.dtype.byteorder == '='  and  not numpy.little_endian):
+			array = array.astype(array.dtype.newbyteorder('<'))
+		self.__array = array
+		# A flat view of the bytes of the array; slicing it does not copy
+		self.__buffer = memoryview(array.reshape(-1).view(numpy.uint8))
 
 
 
@@ -174,11 +449,15 @@ class LiveFnResource (URLResource):
 		self.__mime_type = mime_type
 		self.__instances = []
 		self.__ref_count = 0
+		# Incremented each time that the data function is invalidated
+		self.__version = 0
 
 	def page_ref(self, pres_ctx, rsc_instance):
 		self.__instances.append(rsc_instance)
 		if self.__ref_count == 0:
 			self.__data_fn.add_listener(self.__live_listener)
+			# The data may have changed while there were no listeners to notice
+			self.__version += 1
 		self.__ref_count += 1
 
 
@@ -186,21 +465,28 @@ class LiveFnResource (URLResource):
 		self.__ref_count -= 1
 		if self.__ref_count == 0:
 			self.__data_fn.remove_listener(self.__live_listener)
+			serialization_cache.shared_cache.discard(self)
 		self.__instances.remove(rsc_instance)
 
 
 	def __live_listener(self, incr):
-		modified_message = msg.message('modified')
+		self.__version += 1
+		modified_message = msg.message('modified', version=self.get_version())
 		for instance in self.__instances:
 			instance.send_resource_message(modified_message)
 
 
 	def get_data(self):
+		# The live function caches its value until it is invalidated, so unchanged data is not recomputed. The page
+		# retrieves the data via the serialization cache, so that concurrent requests evaluate it only once.
 		return self.__data_fn()
 
 	def get_mime_type(self):
 		return self.__mime_type
 
+	def get_version(self):
+		return str(self.__version)
+
 
 
 class JsonLiveFnResource (LiveFnResource):
@@ -218,6 +504,8 @@ class CSVLiveFnResource (LiveFnResource):
 
 
 class ImageFromFile (URLResource):
+	is_immutable = True
+
 	def __init__(self, filename, width=None, height=None):
 		super(ImageFromFile, self).__init__()
 		self.__filename = filename
@@ -225,6 +513,7 @@ class ImageFromFile (URLResource):
 		self.__height = height
 		self.__data = None
 		self.__mime_type = ''
+		self.__version = None
 
 
 
@@ -232,14 +521,24 @@ class ImageFromFile (URLResource):
 		if self.__data is None:
 			if os.path.exists(self.__filename)  and  os.path.isfile(self.__filename):
 				f = open(self.__filename, 'rb')
-				self.__data = f.read()
-				self.__mime_type = mimetypes.guess_type(self.__filename)[0]
+				data = f.read()
 				f.close()
+				# May be retrieved concurrently without locking the page; assign the MIME type first so that it is
+				# available by the time that the data is
+				self.__mime_type = mimetypes.guess_type(self.__filename)[0]
+				self.__data = data
 		return self.__data
 
 	def get_mime_type(self):
 		return self.__mime_type
 
+	def get_version(self):
+		if self.__version is None:
+			data = self.get_data()
+			if data is not None:
+				self.__version = data_version(data)
+		return self.__version
+
 
 	def build(self, pres_ctx):
 		url = self._url(pres_ctx)
@@ -7,6 +7,8 @@
 ##-* (C)copyright Geoffrey French 2011-2014.
 ##-*************************
 import bisect
+import heapq
+import itertools
 
 __author__ = 'Geoff'
 
@@ -14,16 +16,81 @@ __author__ = 'Geoff'
 class PriorityList (object):
 	"""
 	Priority List
+
+	Items are popped in order of descending priority; items of equal priority are popped in the order in which they
+	were added. An item may be present at most once; adding an item that is already present moves it.
+
+	Implemented as a heap of entries with a dictionary that maps each item to its entry, so add, remove and pop are
+	O(log n). Items must be hashable. Removed entries are marked as dead and discarded when they reach the top of the heap.
 	"""
 	def __init__(self):
-		self.__priotities = []
-		self.__items = []
+		# Entries are lists of the form [-priority, sequence number, item, alive]
+		self.__heap = []
+		self.__item_to_entry = {}
+		self.__counter = itertools.count()
 
 
 	def add(self, priority, x):
 		"""
 		Add an item @x with a priority of @priority,
 		"""
+		entry = self.__item_to_entry.pop(x, None)
+		if entry is not None:
+			entry[3] = False
+		entry = [-priority, next(self.__counter), x, True]
+		self.__item_to_entry[x] = entry
+		heapq.heappush(self.__heap, entry)
+		self.__compact()
+
+	def remove(self, x):
+		try:
+			entry = self.__item_to_entry.pop(x)
+		except KeyError:
+			raise ValueError, 'PriorityList.remove(x): x not in list'
+		entry[3] = False
+		self.__compact()
+
+
+	def __len__(self):
+		return len(self.__item_to_entry)
+
+
+	def pop(self):
+		heap = self.__heap
+		while len(heap) > 0:
+			entry = heapq.heappop(heap)
+			if entry[3]:
+				del self.__item_to_entry[entry[2]]
+				return entry[2]
+		raise IndexError, 'pop from empty PriorityList'
+
+
+	def __iter__(self):
+		return iter([entry[2]   for entry in sorted(self.__item_to_entry.values())])
+
+
+	def __compact(self):
+		# Rebuild the heap when most of its entries are dead, so that it does not grow without bound when items are
+		# repeatedly re-added
+		heap = self.__heap
+		if len(heap) > 64  and  len(heap) > 2 * len(self.__item_to_entry):
+			self.__heap = self.__item_to_entry.values()
+			heapq.heapify(self.__heap)
+
+
+
+
+class _BisectPriorityList (object):
+	"""
+	The previous implementation of PriorityList, using sorted parallel lists; add and remove are O(n).
+	Retained for comparison by the tests and benchmark.
+	"""
+	def __init__(self):
+		self.__priotities = []
+		self.__items = []
+
+
+	def add(self, priority, x):
 		try:
 			self.remove(x)
 		except ValueError:
@@ -43,9 +110,8 @@ class PriorityList (object):
 
 
 	def pop(self):
-		p = self.__priotities.pop()
-		x = self.__items.pop()
-		return x
+		self.__priotities.pop()
+		return self.__items.pop()
 
 
 	def __iter__(self):
@@ -53,6 +119,27 @@ class PriorityList (object):
 
 
 
+def _benchmark(n=20000, n_priorities=10):
+	"""
+	Time queuing @n tasks - each of which is re-queued once, as happens when a control is modified twice before the page
+	is synchronized - followed by popping them all
+	"""
+	from timeit import default_timer
+	import random
+	rng = random.Random(12345)
+	ops = [(rng.randint(0, n_priorities - 1), rng.randint(0, n - 1))   for i in xrange(2 * n)]
+	for cls in [_BisectPriorityList, PriorityList]:
+		t1 = default_timer()
+		p = cls()
+		for priority, x in ops:
+			p.add(priority, x)
+		while len(p) > 0:
+			p.pop()
+		t2 = default_timer()
+		print '{0}: {1} adds and {2} pops in {3:.3f}s'.format(cls.__name__, len(ops), len(set(x for _, x in ops)), t2 - t1)
+
+
+
 import unittest
 
 class Test_PriorityList (unittest.TestCase):
@@ -124,3 +211,38 @@ class Test_PriorityList (unittest.TestCase):
 		p.add(1, 'd')
 
 		self.assertEqual(4, len(p))
+
+
+	def test_pop_empty(self):
+		p = PriorityList()
+		self.assertRaises(IndexError, p.pop)
+
+
+	def test_matches_bisect_implementation(self):
+		import random
+		rng = random.Random(12345)
+		p = PriorityList()
+		q = _BisectPriorityList()
+		for i in xrange(2000):
+			op = rng.randint(0, 3)
+			if op < 2:
+				priority, x = rng.randint(-3, 3), rng.randint(0, 50)
+				p.add(priority, x)
+				q.add(priority, x)
+			elif op == 2  and  len(q) > 0:
+				self.assertEqual(q.pop(), p.pop())
+			else:
+				x = rng.randint(0, 50)
+				if x in list(q):
+					q.remove(x)
+					p.remove(x)
+				else:
+					self.assertRaises(ValueError, lambda: p.remove(x))
+			self.assertEqual(len(q), len(p))
+		self.assertEqual(list(q), list(p))
+
+
+
+
+if __name__ == '__main__':
+	_benchmark()
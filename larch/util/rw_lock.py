@@ -0,0 +1,107 @@
+##-*************************
+##-* This program is free software; you can use it, redistribute it and/or
+##-* modify it under the terms of the GNU Affero General Public License
+##-* version 3 as published by the Free Software Foundation. The full text of
+##-* the GNU Affero General Public License version 3 can be found in the file
+##-* named 'LICENSE.txt' that accompanies this program. This source code is
+##-* (C)copyright Geoffrey French 2011-2014.
+##-*************************
+import threading
+import unittest
+
+
+class ReadWriteLock (object):
+	"""
+	Read/write lock
+
+	Any number of threads may hold the lock for reading at once, while only one may hold it for writing, to the exclusion
+	of readers. Writers take precedence; once a writer is waiting, new readers wait until it has released the lock, so
+	that a steady stream of readers cannot starve it. Not re-entrant.
+	"""
+	def __init__(self):
+		self.__cond = threading.Condition(threading.Lock())
+		self.__readers = 0
+		self.__writer = False
+		self.__writers_waiting = 0
+
+
+	def acquire_read(self):
+		with self.__cond:
+			while self.__writer  or  self.__writers_waiting > 0:
+				self.__cond.wait()
+			self.__readers += 1
+
+	def release_read(self):
+		with self.__cond:
+			self.__readers -= 1
+			if self.__readers == 0:
+				self.__cond.notify_all()
+
+
+	def acquire_write(self):
+		with self.__cond:
+			self.__writers_waiting += 1
+			while self.__writer  or  self.__readers > 0:
+				self.__cond.wait()
+			self.__writers_waiting -= 1
+			self.__writer = True
+
+	def release_write(self):
+		with self.__cond:
+			self.__writer = False
+			self.__cond.notify_all()
+
+
+
+
+class Test_ReadWriteLock (unittest.TestCase):
+	def test_concurrent_readers(self):
+		lock = ReadWriteLock()
+		lock.acquire_read()
+		acquired = threading.Event()
+
+		def reader():
+			lock.acquire_read()
+			acquired.set()
+			lock.release_read()
+
+		t = threading.Thread(target=reader)
+		t.start()
+		self.assertTrue(acquired.wait(5.0))
+		t.join()
+		lock.release_read()
+
+
+	def test_writer_excludes_readers(self):
+		lock = ReadWriteLock()
+		lock.acquire_read()
+		events = []
+		writer_waiting = threading.Event()
+
+		def writer():
+			writer_waiting.set()
+			lock.acquire_write()
+			events.append('write')
+			lock.release_write()
+
+		def reader():
+			lock.acquire_read()
+			events.append('read')
+			lock.release_read()
+
+		w = threading.Thread(target=writer)
+		w.start()
+		writer_waiting.wait(5.0)
+		# Wait until the writer is blocked on the lock
+		while lock._ReadWriteLock__writers_waiting == 0:
+			w.join(0.001)
+		# A new reader waits for the waiting writer
+		r = threading.Thread(target=reader)
+		r.start()
+		r.join(0.05)
+		self.assertEqual([], events)
+
+		lock.release_read()
+		w.join(5.0)
+		r.join(5.0)
+		self.assertEqual(['write', 'read'], events)
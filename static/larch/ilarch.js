@@ -24,6 +24,8 @@ require(["widgets/js/widget",
             var self = this;
 
             this.model.on('msg:custom', this._on_custom_msg, this);
+            // Message packets are decoded asynchronously; chain them so that they are applied in order
+            this.__packetQueue = Promise.resolve();
 
             var view_id = self.model.get('view_id_');
             var initial_content = self.model.get('initial_content_');
@@ -41,6 +43,9 @@ require(["widgets/js/widget",
             setTimeout(function() {
                     self.__larch.initialise(initialisers, doc_init_js);
                 }, 0);
+
+            // Tell the server which message packet encodings we can decode
+            this.send({msg_type: 'larch_transport', encodings: Larch.supportedPacketEncodings()});
         },
 
 
@@ -57,12 +62,24 @@ require(["widgets/js/widget",
         },
 
 
-        _on_custom_msg: function(msg) {
+        _on_custom_msg: function(msg, buffers) {
+            var self = this;
             if (msg.msg_type === "larch_msg_packet") {
-                this._on_larch_msg(msg.messages);
+                this.__packetQueue = this.__packetQueue.then(function() {
+                    return Larch.decodeMessagePacket(msg, buffers || []).then(function(messages) {
+                        self._on_larch_msg(messages);
+                    });
+                }).catch(function(e) {
+                    console.log("ILarch: error while handling message packet:");
+                    console.log(e);
+                });
             }
             else if (msg.msg_type === "larch_sync_request") {
-                this._send_larch_sync();
+                // Answer once the preceding packets have been applied, so that the server paces its updates
+                // to the rate at which we can apply them
+                this.__packetQueue = this.__packetQueue.then(function() {
+                    self._send_larch_sync();
+                });
             }
         }
     });
@@ -15,6 +15,7 @@ Larch = function(container_element, initial_content_html, view_id, send_events,
         __container_query: $(container_element),
         __view_id: undefined,
         __segment_table: {},
+        __segment_items: {},
         __send_events: send_events,
         __maxInflightMessages: maxInflightMessages
     };
@@ -185,6 +186,43 @@ Larch = function(container_element, initial_content_html, view_id, send_events,
 
 
 
+    self.__spliceSegment = function(segment_id, removed_ids, before_id, html) {
+        // Replace child segments of the segment identified by `segment_id`, whose content consists solely of child segments.
+        // The nodes of the segments identified by `removed_ids` are taken out of the DOM; they may be re-inserted later
+        // via a placeholder. The nodes built from `html` are inserted before the segment identified by `before_id`, or at
+        // the end of the segment if `before_id` is null. Placeholders and new segments within `html` are handled along
+        // with those of modified segments.
+        var segment_table = self.__segment_table;
+        var state = segment_table[segment_id];
+        if (state === undefined) {
+            console.log("larch.__spliceSegment: Cannot get segment " + segment_id);
+            return;
+        }
+        delete self.__segment_items[segment_id];
+
+        for (var i = 0; i < removed_ids.length; i++) {
+            var childState = segment_table[removed_ids[i]];
+            if (childState !== undefined) {
+                self.__buildConnectivity(childState);
+                self.__getNodesInActiveSegment(childState).forEach(function(n) {n.parentNode.removeChild(n);});
+            }
+        }
+
+        if (html.length > 0) {
+            var before = before_id !== null  ?  segment_table[before_id].start  :  state.end;
+            var parent = before.parentNode;
+            var elem = document.createElement("div");
+            elem.innerHTML = html;
+            while (elem.firstChild !== null) {
+                var n = elem.firstChild;
+                n.__lch_seg_id = segment_id;
+                parent.insertBefore(n, before);
+            }
+        }
+    };
+
+
+
     self.__createSegmentContentNodesFromSource = function(content) {
         // Create nodes to form the contents of a segment from HTML source
         // Creates a temporary <div> element containing the content and extracts its child nodes.
@@ -195,6 +233,51 @@ Larch = function(container_element, initial_content_html, view_id, send_events,
 
 
 
+    self.__decodeSegmentContent = function(segment_id, content) {
+        // Get the HTML source of a modified segment.
+        // `content` is either the HTML source itself or, if the server is diffing segment content, an object with either:
+        // - an items property: an array of strings that are joined to make the HTML source, or
+        // - a patch property: an array of operations that transforms the items previously received for the segment.
+        // Each operation is either a string - an item to insert - or a [start, count] pair that copies `count` items
+        // from the previous array, starting at index `start`.
+        // The items are retained so that subsequent patches can be applied.
+        if (typeof content === 'string') {
+            delete self.__segment_items[segment_id];
+            return content;
+        }
+
+        var items;
+        if (content.patch !== undefined) {
+            var prevItems = self.__segment_items[segment_id];
+            if (prevItems === undefined) {
+                console.log("larch.__decodeSegmentContent: no items to patch for segment " + segment_id);
+                prevItems = [];
+            }
+            var patch = content.patch;
+            items = [];
+            for (var i = 0; i < patch.length; i++) {
+                var op = patch[i];
+                if (typeof op === 'string') {
+                    items.push(op);
+                }
+                else {
+                    var end = op[0] + op[1];
+                    for (var j = op[0]; j < end; j++) {
+                        items.push(prevItems[j]);
+                    }
+                }
+            }
+        }
+        else {
+            items = content.items;
+        }
+
+        self.__segment_items[segment_id] = items;
+        return items.join('');
+    };
+
+
+
     self.__getPlaceHolderNodes = function() {
         // Find the placeholder nodes within the document
         return self.__container_query.find("span.__lch_seg_placeholder");
@@ -405,9 +488,11 @@ Larch = function(container_element, initial_content_html, view_id, send_events,
         // It takes the form of an object with the following properties:
         // - shutdown_scripts: an array of [segment_id, script_js] pairs that identify segments that need to have shutdown scripts
         // executed before they are removed from the DOM (see remove attribute below)
+        // - spliced: an array of [segment_id, removed_ids, before_id, html] arrays that identify segments whose child segments
+        // were replaced without replacing the segment itself (see __spliceSegment)
         // - removed: an array of segment IDs that are being removed from the DOM
         // - modified: an array of [segment_id, new_content] pairs that identify segments that are to be replaced
-        // along with the replacement HTML content
+        // along with the replacement HTML content (see __decodeSegmentContent)
         // - popups: an array of [segment_id, popup_content] pairs that provide content that is to be loaded into popups.
         // Since they are within popups, they are not parented to another node within the document, so they have to be
         // maintained separately.
@@ -419,6 +504,7 @@ Larch = function(container_element, initial_content_html, view_id, send_events,
         //
 
         //console.log("STARTING UPDATE");
+        var spliced = changes.spliced;
         var removed = changes.removed;
         var modified = changes.modified;
         var popups = changes.popups;
@@ -433,19 +519,28 @@ Larch = function(container_element, initial_content_html, view_id, send_events,
             self.__executeNodeScripts(shutdown_scripts);
         }
         finally {
+            // Handle splices; the removed child segments must still be in the segment table
+            if (spliced !== undefined) {
+                for (var i = 0; i < spliced.length; i++) {
+                    self.__spliceSegment(spliced[i][0], spliced[i][1], spliced[i][2], spliced[i][3]);
+                }
+            }
+
             // Handle removals
             for (var i = 0; i < removed.length; i++) {
                 // Just remove them from the table
                 // The DOM modifications will remove the nodes
                 //console.log("Removed " + removed[i]);
                 delete segment_table[removed[i]];
+                delete self.__segment_items[removed[i]];
             }
 
             // Handle modifications
             for (var i = 0; i < modified.length; i++) {
                 // Get the segment ID and content
                 var segment_id = modified[i][0];
-                var content = modified[i][1];
+                // Decode the content even if the segment is not in the table, so that subsequent patches can be applied
+                var content = self.__decodeSegmentContent(segment_id, modified[i][1]);
 
                 if (segment_id in segment_table) {
                     var state = segment_table[segment_id];
@@ -1284,29 +1379,39 @@ Larch = function(container_element, initial_content_html, view_id, send_events,
 
 
 
-    self.__createURLResource = function(rscId, rscUrl) {
+    self.__createURLResource = function(rscId, rscUrl, version) {
         var rsc = self.__createResource(rscId);
         rsc.url = rscUrl;
+        // The version of the data; null if the resource is not versioned
+        rsc.version = version;
         rsc.__listeners = [];
 
+        rsc.__fetchUrl = function() {
+            if (rsc.version !== null  &&  rsc.version !== undefined) {
+                // The URL identifies a version of the data, so the browser can use its cached copy
+                return rsc.url + '?v=' + encodeURIComponent(rsc.version);
+            }
+            else {
+                var x = self.__rscFetchCount;
+                self.__rscFetchCount++;
+                return rsc.url + '?_idx=' + x;        // Append an index to the URL; this seems to prevent the server from ignoring (!) the request. Why? don't know yet.... The server ignores _idx, so its not like it does anything...
+            }
+        };
+
         rsc.fetchString = function(handlerFn) {
-            var x = self.__rscFetchCount;
-            self.__rscFetchCount++;
             //console.log('Getting resource ');
             $.ajax({
                 type: 'GET',
-                url: rsc.url + '?_idx=' + x,        // Append an index to the URL; this seems to prevent the server from ignoring (!) the request. Why? don't know yet.... The server ignores _idx, so its not like it does anything...
+                url: rsc.__fetchUrl(),
                 success: handlerFn
             });
         };
 
         rsc.fetchJSON = function(handlerFn) {
-            var x = self.__rscFetchCount;
-            self.__rscFetchCount++;
-            //console.log('Getting JSON resource ' + x);
+            //console.log('Getting JSON resource ');
             $.ajax({
                 type: 'GET',
-                url: rsc.url + '?_idx=' + x,        // Append an index to the URL; this seems to prevent the server from ignoring (!) the request. Why? don't know yet.... The server ignores _idx, so its not like it does anything...
+                url: rsc.__fetchUrl(),
                 success: handlerFn,
                 dataType: 'json'
             });
@@ -1332,6 +1437,9 @@ Larch = function(container_element, initial_content_html, view_id, send_events,
         };
 
         rsc.__messageHandlers.modified = function(message) {
+            if (message.version !== undefined) {
+                rsc.version = message.version;
+            }
             for (var i = 0; i < rsc.__listeners.length; i++) {
                 rsc.__listeners[i]();
             }
@@ -1342,6 +1450,66 @@ Larch = function(container_element, initial_content_html, view_id, send_events,
 
 
 
+    self.__createNumpyArrayResource = function(rscId, rscUrl, version, dtype, shape) {
+        var rsc = self.__createURLResource(rscId, rscUrl, version);
+        rsc.dtype = dtype;
+        rsc.shape = shape;
+
+        var urlModified = rsc.__messageHandlers.modified;
+        rsc.__messageHandlers.modified = function(message) {
+            // Update the dtype and shape before the listeners fetch the new data
+            if (message.dtype !== undefined) {
+                rsc.dtype = message.dtype;
+            }
+            if (message.shape !== undefined) {
+                rsc.shape = message.shape;
+            }
+            urlModified(message);
+        };
+
+        rsc.fetchTypedArray = function(handlerFn) {
+            // jQuery cannot retrieve binary data, so use XMLHttpRequest directly
+            var xhr = new XMLHttpRequest();
+            xhr.open('GET', rsc.__fetchUrl(), true);
+            xhr.responseType = 'arraybuffer';
+            xhr.onload = function() {
+                if (xhr.status === 200) {
+                    handlerFn(self.typedArrayForDtype(xhr.response, rsc.dtype), rsc.shape, rsc.dtype);
+                }
+            };
+            xhr.send();
+        };
+
+        return rsc;
+    };
+
+    self.__dtypeToTypedArray = {
+        bool: 'Uint8Array',
+        int8: 'Int8Array',
+        uint8: 'Uint8Array',
+        int16: 'Int16Array',
+        uint16: 'Uint16Array',
+        int32: 'Int32Array',
+        uint32: 'Uint32Array',
+        int64: 'BigInt64Array',
+        uint64: 'BigUint64Array',
+        float32: 'Float32Array',
+        float64: 'Float64Array'
+    };
+
+    self.typedArrayForDtype = function(buffer, dtype) {
+        // Wrap the buffer in the typed array that corresponds to the NumPy dtype; the data is not copied
+        var name = self.__dtypeToTypedArray[dtype];
+        var ctor = name !== undefined  ?  window[name]  :  undefined;
+        if (ctor === undefined) {
+            // No typed array for this dtype (e.g. float16, or 64-bit integers in older browsers); access the bytes via a DataView
+            return new DataView(buffer);
+        }
+        return new ctor(buffer);
+    };
+
+
+
     self.__createChannelResource = function(rscId) {
         var rsc = self.__createResource(rscId);
         rsc.__listeners = [];
@@ -1442,6 +1610,85 @@ Larch.getLarchInstanceForElement = function(src_element) {
 };
 
 
+//
+//
+// MESSAGE PACKET TRANSPORT
+//
+// Packets of messages sent by the server may be encoded (see larch/core/dynamicpage/transport.py):
+// - json: packet.messages holds the messages
+// - binary: large strings are moved into binary buffers; they are replaced by objects of the form {__lch_buffer__: index}
+// - deflate: the JSON encoded messages are compressed into a single buffer
+//
+//
+
+Larch.supportedPacketEncodings = function() {
+    // The packet encodings that can be decoded by this browser
+    var encodings = [];
+    if (typeof TextDecoder !== 'undefined') {
+        encodings.push('binary');
+        if (typeof DecompressionStream !== 'undefined'  &&  typeof Response !== 'undefined') {
+            encodings.push('deflate');
+        }
+    }
+    encodings.push('json');
+    return encodings;
+};
+
+
+Larch.__bufferBytes = function(buffer) {
+    // Buffers may be received as DataView or ArrayBuffer instances
+    if (buffer instanceof ArrayBuffer) {
+        return new Uint8Array(buffer);
+    }
+    else {
+        return new Uint8Array(buffer.buffer, buffer.byteOffset, buffer.byteLength);
+    }
+};
+
+
+Larch.decodeMessagePacket = function(packet, buffers) {
+    // Decode a packet of messages
+    // Returns a promise that resolves to the array of messages
+    var encoding = packet.encoding || 'json';
+    if (encoding === 'json') {
+        return Promise.resolve(packet.messages);
+    }
+    else if (encoding === 'binary') {
+        var decoder = new TextDecoder('utf-8');
+        var strings = buffers.map(function(b) {return decoder.decode(Larch.__bufferBytes(b));});
+        var resolve = function(x) {
+            if (Array.isArray(x)) {
+                return x.map(resolve);
+            }
+            else if (x !== null  &&  typeof x === 'object') {
+                if (x.hasOwnProperty('__lch_buffer__')) {
+                    return strings[x.__lch_buffer__];
+                }
+                var y = {};
+                for (var key in x) {
+                    if (x.hasOwnProperty(key)) {
+                        y[key] = resolve(x[key]);
+                    }
+                }
+                return y;
+            }
+            else {
+                return x;
+            }
+        };
+        return Promise.resolve(resolve(packet.messages));
+    }
+    else if (encoding === 'deflate') {
+        var stream = new Blob([Larch.__bufferBytes(buffers[0])]).stream().pipeThrough(new DecompressionStream('deflate'));
+        return new Response(stream).text().then(function(text) {return JSON.parse(text);});
+    }
+    else {
+        return Promise.reject(new Error("Unknown packet encoding " + encoding));
+    }
+};
+
+
+
 Larch.addCSS = function(url) {
     var link = document.createElement("link");
     link.type = "text/css";
@@ -479,6 +479,45 @@ var LarchControls = function(larch) {
 
 
 
+    //
+    //
+    // Windowed sequence
+    //
+    //
+
+    larch.controls.initWindowedSequence = function(node, start, stop, length, step, scrollToIndex) {
+        var margin = 20;
+        var items = $(node).children('.pyprim_windowed_item');
+        var requested = false;
+
+        if (scrollToIndex !== null  &&  scrollToIndex < items.length) {
+            node.scrollTop = items[scrollToIndex].offsetTop;
+        }
+
+        var firstVisibleIndex = function() {
+            for (var i = 0; i < items.length; i++) {
+                if (items[i].offsetTop + items[i].offsetHeight > node.scrollTop) {
+                    return start + i;
+                }
+            }
+            return start;
+        };
+
+        $(node).scroll(function() {
+            if (!requested) {
+                if (stop < length  &&  node.scrollTop + node.clientHeight >= node.scrollHeight - margin) {
+                    requested = true;
+                    larch.postEvent(node, 'windowed_move', {start: start + step, first_visible: firstVisibleIndex()});
+                }
+                else if (start > 0  &&  node.scrollTop <= margin) {
+                    requested = true;
+                    larch.postEvent(node, 'windowed_move', {start: Math.max(start - step, 0), first_visible: firstVisibleIndex()});
+                }
+            }
+        });
+    };
+
+
     larch.controls.initObjectInspector = function(node) {
         // Pick up the click event
         $(node).mousedown(function(event) {